@@ -20,8 +20,7 @@
 import dash
 from dash import Dash, dcc, html
 import locale
-from src.utils import main_functions
-from src.data import data_store
+from src.utils import main_functions, config
 
 print("biHR Copyright (C) 2024 Joachim Nuyttens")
 print("This program comes with ABSOLUTELY NO WARRANTY.")
@@ -35,29 +34,11 @@ locale.setlocale(locale.LC_ALL, "nl_BE.utf8")
 
 ## LOAD ESSENTIAL DATA ##
 ###############################
-# load all global dataframes with data from SQL database
-main_functions.load_dataframes()
-
-# Initialize the dataframes and store them in the shared module
-(data_store.company_forecast, data_store.monthly_employee_data, data_store.monthly_freelance_data,
- data_store.temporary_projects) = main_functions.company_year_forecast()
-data_store.company_forecast.reset_index(inplace=True)
-
-# Initialize some lists and dictionaries
-data_store.month_mapping = {
-    'januari': 1,
-    'februari': 2,
-    'maart': 3,
-    'april': 4,
-    'mei': 5,
-    'juni': 6,
-    'juli': 7,
-    'augustus': 8,
-    'september': 9,
-    'oktober': 10,
-    'november': 11,
-    'december': 12
-}
+# load all global dataframes with data from SQL database, calculate the forecast and store them in the shared module,
+# when a shared store is configured this is only done by the first worker process and attached by all others
+main_functions.data_snapshot_install(main_functions.data_snapshot_get())
+# reload the data in the background whenever the data in the SQL database is refreshed
+main_functions.data_reloader_start(config.g_config.getint('PARAMETERS', 'reload_interval'))
 
 
 ### INITIALIZE DASH APP ###
@@ -15,11 +15,36 @@
 # the latest data from the Officient API and CSV files.
 #
 
+import argparse
 import locale
-from src.utils import main_functions
+from src.utils import main_functions, refresh_pipeline
+
+
+def parse_range(value: str) -> list:
+    """Parse a command line range like 3-5 (or a single value like 3) into a list [first, last]"""
+    first, _, last = value.partition('-')
+    try:
+        return [int(first), int(last or first)]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a range like 3-5")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Refresh the data in the SQL database")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume an interrupted refresh, skipping the stages and employees already done")
+    parser.add_argument('--stages', nargs='+', choices=list(refresh_pipeline.REFRESH_STAGES),
+                        help="only refresh these stages (default all)")
+    parser.add_argument('--employees', nargs='+', type=int,
+                        help="only refresh calendar, saldi and contracts of these employee ids")
+    parser.add_argument('--year', type=int,
+                        help="refresh the calendar of this year (default year in config), saldi are only refreshed "
+                             "for the year in config")
+    parser.add_argument('--months', type=parse_range, help="only refresh the calendar in these months, e.g. 3-5")
+    parser.add_argument('--backfill', type=parse_range,
+                        help="only refresh the calendar of this range of historical years, e.g. 2021-2023")
+    args = parser.parse_args()
+
     print("biHR Copyright (C) 2024 Joachim Nuyttens")
     print("This program comes with ABSOLUTELY NO WARRANTY.")
     print("This is free software, and you are welcome to redistribute it under version 3 of the GNU General Public"
@@ -32,12 +57,11 @@ def main():
 
     ### DATA RETRIEVAL FROM OFFICIENT API and CSV files###
     ######################################################
+    if args.backfill:
+        main_functions.backfill_calendar(args.backfill[0], args.backfill[1], args.employees)
+        return
     main_functions.load_dataframes()
-    main_functions.refresh_from_officient()
-    main_functions.refresh_from_csv()
-
-    # manual update of calendar for another year, e.g. 2023, normally this should not be executed
-    #db_retrieve.employee_calendar_compose(2023)
+    main_functions.refresh_all(args.resume, args.stages, args.employees, args.year, args.months)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -15,6 +15,15 @@
 #
 
 from dash import dcc, html
+from src.data import data_store
+
+def get_data_info():
+    """Return a short text showing which data version is loaded and how long the last (re)load took"""
+    reload_info = data_store.reload_info
+    if not reload_info:
+        return f"Data versie {data_store.version}"
+    return (f"Data versie {reload_info['version']}, geladen om {reload_info['loaded_at'].strftime('%H:%M:%S')} "
+            f"in {reload_info['build_seconds']} s")
 
 def get_navigation():
     return html.Div([
@@ -25,4 +34,7 @@ def get_navigation():
         dcc.Link('Temporary Projects', href='/temporary_projects'),
         html.Span(' | '),
         dcc.Link('Employee Simulation', href='/employee_simulation'),
+        html.Span(' | '),
+        dcc.Link('Scenario Sweep', href='/scenario_sweep'),
+        html.Span(get_data_info(), style={'float': 'right', 'color': '#6c757d'}),
     ], style={'padding': '10px', 'backgroundColor': '#f8f9fa', 'borderBottom': '1px solid #dee2e6'})
\ No newline at end of file
@@ -0,0 +1,56 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file is the shared module holding the data displayed by the Dash app. The data is replaced as a whole by
+# main_functions.data_snapshot_install, pages must read it from this module when used and not keep a copy.
+#
+import threading
+from collections import OrderedDict
+
+# lock held while the data is replaced, pages reading several of the data below must hold it to get a consistent set
+lock = threading.RLock()
+
+# forecast engine owning the loaded data, pages calculate with its methods and need not hold the lock
+engine = None
+
+# forecast engines of other years than the reference year, keyed by (data version, year) and least recently used
+# first, see main_functions.year_engine_get. The lock is held while a year is loaded.
+year_engines = OrderedDict()
+year_lock = threading.Lock()
+
+# version of the data in the SQL database which is loaded, and timing of the last (re)load
+version = None
+reload_info = {}
+
+# dataframes calculated at (re)load
+company_forecast = None
+monthly_employee_data = None
+monthly_freelance_data = None
+temporary_projects = None
+# dependency graph of the company forecast, to only calculate what changed at the next reload (see forecast_graph)
+forecast_graph = None
+
+month_mapping = {
+    'januari': 1,
+    'februari': 2,
+    'maart': 3,
+    'april': 4,
+    'mei': 5,
+    'juni': 6,
+    'juli': 7,
+    'augustus': 8,
+    'september': 9,
+    'oktober': 10,
+    'november': 11,
+    'december': 12
+}
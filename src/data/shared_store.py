@@ -0,0 +1,106 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the shared store in which one process publishes a data snapshot (see
+# main_functions.data_snapshot_build) as Arrow IPC files, to which all worker processes attach through memory-mapping.
+# Put the store on a memory filesystem such as /dev/shm, then the data is held in memory only once for all workers.
+# This module requires the pyarrow package.
+#
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.ipc
+
+
+@contextmanager
+def publish_lock(store_dir: str):
+    """Context manager holding an exclusive lock on the store across processes, so only one process builds and
+    publishes a snapshot while the others wait for it"""
+    os.makedirs(store_dir, exist_ok=True)
+    with open(f"{store_dir}/.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def manifest_get(store_dir: str) -> dict:
+    """Return the manifest of the snapshot currently published in the store, None if nothing is published"""
+    manifest_file = f"{store_dir}/current.json"
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'r') as file:
+        return json.load(file)
+
+
+def snapshot_frames(snapshot: dict) -> list:
+    """Return all dataframes of a snapshot as a list of (path, dataframe), the path being the keys to reach the
+    dataframe in the snapshot"""
+    frames = [(['globals', name], frame) for name, frame in snapshot['globals'].items()]
+    for key in ['company_forecast', 'temporary_projects']:
+        frames.append(([key], snapshot[key]))
+    for key in ['monthly_employee_data', 'monthly_freelance_data']:
+        frames.extend(([key, month], frame) for month, frame in snapshot[key].items())
+    return frames
+
+
+def publish(snapshot: dict, store_dir: str):
+    """Write all dataframes of a snapshot as Arrow IPC files in a new directory of the store, then make it the current
+    snapshot by replacing the manifest at once. Older snapshots are removed, processes still attached to them keep
+    their memory-mapping until they attach to the new snapshot."""
+    snapshot_dir = f"{store_dir}/{snapshot['version'] or 'unversioned'}_{snapshot['as_of'].strftime('%Y%m%d')}"
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.makedirs(snapshot_dir)
+    entries = []
+    for number, (path, frame) in enumerate(snapshot_frames(snapshot)):
+        # the index is stored as regular columns, a default range index is not stored
+        index = [name for name in frame.index.names if name is not None]
+        table = pa.Table.from_pandas(frame.reset_index() if index else frame, preserve_index=False)
+        file_name = f"{snapshot_dir}/frame_{number}.arrow"
+        with pa.OSFile(file_name, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        entries.append({'path': path, 'file': file_name, 'index': index})
+    manifest = {'version': snapshot['version'], 'as_of': snapshot['as_of'].isoformat(), 'frames': entries}
+    with open(f"{store_dir}/current.json.tmp", 'w') as file:
+        json.dump(manifest, file)
+    os.replace(f"{store_dir}/current.json.tmp", f"{store_dir}/current.json")
+    for name in os.listdir(store_dir):
+        if os.path.isdir(f"{store_dir}/{name}") and name != os.path.basename(snapshot_dir):
+            shutil.rmtree(f"{store_dir}/{name}", ignore_errors=True)
+
+
+def attach(store_dir: str) -> dict:
+    """Return the snapshot currently published in the store, with the dataframes backed by memory-mapped files.
+    Numeric columns are not copied, text columns are converted to Python objects. Attach while holding the
+    publish_lock, so the files are not removed by a process publishing a new snapshot meanwhile."""
+    manifest = manifest_get(store_dir)
+    if manifest is None:
+        raise ValueError(f"No data snapshot published in shared store {store_dir}")
+    snapshot = {'version': manifest['version'], 'as_of': datetime.fromisoformat(manifest['as_of']), 'globals': {},
+                'monthly_employee_data': {}, 'monthly_freelance_data': {}}
+    for entry in manifest['frames']:
+        table = pa.ipc.open_file(pa.memory_map(entry['file'], 'r')).read_all()
+        frame = table.to_pandas(split_blocks=True)
+        if entry['index']:
+            frame.set_index(entry['index'], inplace=True)
+        path = entry['path']
+        if len(path) == 2:
+            snapshot[path[0]][path[1]] = frame
+        else:
+            snapshot[path[0]] = frame
+    return snapshot
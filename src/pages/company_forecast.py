@@ -15,9 +15,9 @@
 #
 
 import dash
-from dash import dcc, html, dash_table, callback, Input, Output
+from dash import dcc, html, dash_table, callback, Input, Output, State
 import pandas as pd
-from src.utils import config
+from src.utils import config, main_functions, gen_helpers as gh
 from src.data import data_store
 from src.components.navigation import get_navigation
 
@@ -27,19 +27,15 @@ dash.register_page(__name__, path='/')
 g_config = config.g_config
 ref_date = config.g_ref_date
 
-# access dataframes, lists and dictionaries from the shared module
-company_forecast = data_store.company_forecast
-monthly_employee_data = data_store.monthly_employee_data
-monthly_freelance_data = data_store.monthly_freelance_data
-month_mapping = data_store.month_mapping
 
 def get_month_data(selected_month):
     if selected_month is None:
         return None, None
-    month_number = month_mapping.get(selected_month.lower())
-    # filter data for selected month
-    employee_data = monthly_employee_data[month_number]
-    freelance_data = monthly_freelance_data[month_number]
+    month_number = data_store.month_mapping.get(selected_month.lower())
+    # filter data for selected month, reading the data store at once so a reload in between has no effect
+    with data_store.lock:
+        employee_data = data_store.monthly_employee_data[month_number]
+        freelance_data = data_store.monthly_freelance_data[month_number]
     # calculate sum totals in final row
     employee_sum = employee_data.sum().round(2)
     employee_sum_series = pd.Series(employee_sum, name='Totaal')
@@ -52,39 +48,71 @@ def get_month_data(selected_month):
     freelance_data.reset_index(inplace=True)
     return employee_data, freelance_data
 
-# select the first month in company_forecast as default
-selected_month = company_forecast['index'].iloc[0]
-employee_data, freelance_data = get_month_data(selected_month)
 
-# layout of the page
-layout = html.Div([
-    get_navigation(),
-    html.H1("Simulatie bedrijf"),
-    dash_table.DataTable(
-        id='table-company_year',
-        columns=[{'name': col, 'id': col} for col in company_forecast.columns],
-        data=company_forecast.to_dict('records')
-    ),
-    html.Br(),
-    dcc.Dropdown(
-        id='month-dropdown',
-        options=[{'label': row[0], 'value': row[0]} for row in company_forecast.itertuples(index=False)],
-        value=selected_month
-    ),
-    html.H2(f"Detail voor de maand {selected_month}", id='month_title'),
-    html.H3("Werknemers"),
-    dash_table.DataTable(
-        id='employee_data-table',
-        columns=[{'name': col, 'id': col} for col in employee_data.columns],
-        data=employee_data.to_dict('records')
-    ),
-    html.H3("Freelancers"),
-    dash_table.DataTable(
-        id = 'freelance_data-table',
-        columns=[{'name': col, 'id': col} for col in freelance_data.columns],
-        data=freelance_data.to_dict('records')
-    )
-])
+# layout of the page, built on every page load so it always shows the latest loaded data
+def layout(**kwargs):
+    company_forecast = data_store.company_forecast
+    # select the first month in company_forecast as default
+    selected_month = company_forecast['index'].iloc[0]
+    employee_data, freelance_data = get_month_data(selected_month)
+    # the rolling forecast can start in any of the 12 months from the reference date
+    rolling_starts = [(data_store.engine.ref_date + pd.DateOffset(months=number)).to_pydatetime()
+                      for number in range(12)]
+    return html.Div([
+        get_navigation(),
+        html.H1("Simulatie bedrijf"),
+        dash_table.DataTable(
+            id='table-company_year',
+            columns=[{'name': col, 'id': col} for col in company_forecast.columns],
+            data=company_forecast.to_dict('records')
+        ),
+        html.Br(),
+        html.Button('Bereken spreiding', id='monte_carlo-button'),
+        dash_table.DataTable(
+            id='table-monte_carlo',
+            columns=[],
+            data=[]
+        ),
+        html.H2("Rollende prognose"),
+        dcc.Dropdown(
+            id='rolling_start-dropdown',
+            options=[{'label': f"{gh.get_month_name(month_date.month)} {month_date.year}",
+                      'value': month_date.strftime('%Y-%m-%d')} for month_date in rolling_starts],
+            value=rolling_starts[0].strftime('%Y-%m-%d')
+        ),
+        dcc.Dropdown(
+            id='rolling_months-dropdown',
+            options=[{'label': f"{months} maanden", 'value': months} for months in [12, 24]],
+            value=12
+        ),
+        html.Button('Bereken rollende prognose', id='rolling-button'),
+        dash_table.DataTable(
+            id='table-rolling',
+            columns=[],
+            data=[]
+        ),
+        html.Br(),
+        dcc.Dropdown(
+            id='month-dropdown',
+            options=[{'label': row[0], 'value': row[0]} for row in company_forecast.itertuples(index=False)],
+            value=selected_month
+        ),
+        html.H2(f"Detail voor de maand {selected_month}", id='month_title'),
+        html.H3("Werknemers"),
+        dash_table.DataTable(
+            id='employee_data-table',
+            columns=[{'name': col, 'id': col} for col in employee_data.columns],
+            data=employee_data.to_dict('records')
+        ),
+        html.H3("Freelancers"),
+        dash_table.DataTable(
+            id = 'freelance_data-table',
+            columns=[{'name': col, 'id': col} for col in freelance_data.columns],
+            data=freelance_data.to_dict('records')
+        )
+    ])
+
+
 @callback(
     [Output('month_title', 'children'),
      Output('employee_data-table', 'data'),
@@ -99,4 +127,32 @@ def update_monthly_data(selected_month):
     employee_data, freelance_data = get_month_data(selected_month)
     return (f"Detail voor de maand {selected_month}",
             employee_data.to_dict('records'),
-            freelance_data.to_dict('records'))
\ No newline at end of file
+            freelance_data.to_dict('records'))
+
+
+@callback(
+    [Output('table-monte_carlo', 'columns'),
+     Output('table-monte_carlo', 'data')],
+    Input('monte_carlo-button', 'n_clicks'),
+    prevent_initial_call=True
+)
+def update_monte_carlo(n_clicks):
+    print("Running update_monte_carlo")
+    # spread of revenue and margin over trials sampling the absences, calculated with the loaded data
+    spread = data_store.engine.monte_carlo_forecast().reset_index()
+    return [{'name': col, 'id': col} for col in spread.columns], spread.to_dict('records')
+
+
+@callback(
+    [Output('table-rolling', 'columns'),
+     Output('table-rolling', 'data')],
+    Input('rolling-button', 'n_clicks'),
+    [State('rolling_start-dropdown', 'value'),
+     State('rolling_months-dropdown', 'value')],
+    prevent_initial_call=True
+)
+def update_rolling(n_clicks, start, months):
+    print("Running update_rolling")
+    # months already calculated for a previous horizon are taken from the engines of their year
+    rolling = main_functions.rolling_forecast(pd.Timestamp(start).to_pydatetime(), months).reset_index()
+    return [{'name': col, 'id': col} for col in rolling.columns], rolling.to_dict('records')
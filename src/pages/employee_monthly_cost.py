@@ -15,7 +15,7 @@
 #
 import dash
 from dash import dcc, html, dash_table, callback, Input, Output
-from src.utils import config, main_functions
+from src.utils import config
 from src.data import data_store
 from src.components.navigation import get_navigation
 
@@ -24,31 +24,30 @@ dash.register_page(__name__, path='/employee_monthly_cost')
 # load configuration parameters
 ref_date = config.g_ref_date
 
-# access dataframes, lists and dictionaries from the shared module
-company_forecast = data_store.company_forecast
-month_mapping = data_store.month_mapping
 
-# select default month and calculate employee monthly cost
-selected_month = company_forecast['index'].iloc[0]
-employee_monthly_cost = main_functions.employee_month_forecast(ref_date)
+# layout of the page, built on every page load so it always shows the latest loaded data
+def layout(**kwargs):
+    company_forecast = data_store.company_forecast
+    # select default month and calculate employee monthly cost
+    selected_month = company_forecast['index'].iloc[0]
+    employee_monthly_cost = data_store.engine.employee_month_forecast(ref_date)
+    return html.Div([
+        get_navigation(),
+        html.H1("Detail werknemerskosten"),
+        html.Br(),
+        dcc.Dropdown(
+            id='month-dropdown',
+            options=[{'label': row[0], 'value': row[0]} for row in company_forecast.itertuples(index=False)],
+            value=selected_month),
+        html.P(id='month-info'),
+        html.Br(),
+        dash_table.DataTable(
+            id='table-employee_cost',
+            columns=[{'name': col, 'id': col} for col in employee_monthly_cost.columns],
+            data=employee_monthly_cost.to_dict('records')
+        )
+    ])
 
-# layout of the page
-layout = html.Div([
-    get_navigation(),
-    html.H1("Detail werknemerskosten"),
-    html.Br(),
-    dcc.Dropdown(
-        id='month-dropdown',
-        options=[{'label': row[0], 'value': row[0]} for row in company_forecast.itertuples(index=False)],
-        value=selected_month),
-    html.P(id='month-info'),
-    html.Br(),
-    dash_table.DataTable(
-        id='table-employee_cost',
-        columns=[{'name': col, 'id': col} for col in employee_monthly_cost.columns],
-        data=employee_monthly_cost.to_dict('records')
-    )
-])
 
 @callback(
     [Output('month-info', 'children'),
@@ -59,10 +58,11 @@ def update_employee_data(selected_month):
     if selected_month is None:
         return ("No month selected", [])
     # set ref_date to the selected month
-    month_number = month_mapping.get(selected_month.lower())
-    ref_date = config.g_ref_date.replace(month=month_number)
-    # calculate employee monthly cost for the selected month
-    employee_monthly_cost = main_functions.employee_month_forecast(ref_date)
+    month_number = data_store.month_mapping.get(selected_month.lower())
+    engine = data_store.engine
+    ref_date = engine.ref_date.replace(month=month_number)
+    # calculate employee monthly cost for the selected month with the data of the engine, unaffected by a reload
+    employee_monthly_cost = engine.employee_month_forecast(ref_date)
     return (f"Gedetailleerde data voor maand {selected_month}",
             employee_monthly_cost.to_dict('records'),
-            )
\ No newline at end of file
+            )
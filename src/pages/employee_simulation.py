@@ -15,16 +15,17 @@
 #
 
 import dash
-from dash import dcc, html, dash_table, Input, Output, callback
+from dash import dcc, html, dash_table, Input, Output, State, callback
 import pandas as pd
-from src.utils import config
-from src.utils import calculate_employee, db_supply
+from src.utils import config, main_functions
+from src.utils import db_supply
 from src.components.navigation import get_navigation
 
 dash.register_page(__name__, path='/employee_simulation')
 
-def get_employee_data(employee_id):
-    cost_overview, yearly_revenue, parameters = calculate_employee.yearly_cost_income(employee_id)
+def get_employee_data(employee_id, year):
+    # calculate with the data of the engine of the year, unaffected by a reload
+    cost_overview, yearly_revenue, parameters = main_functions.year_engine_get(year).yearly_cost_income(employee_id)
     # calculate yearly cost and margin
     yearly_cost = float(cost_overview.sum().sum())
     yearly_gross_margin = yearly_revenue - yearly_cost
@@ -41,63 +42,93 @@ def get_employee_data(employee_id):
     })
     return cost_overview_transposed, summary, parameters
 
+
+def get_employee_options(year):
+    # employees with a contract in the reference month of the year
+    employee_df = db_supply.worker_list_get('intern', main_functions.year_engine_get(year).ref_date)
+    employee_df.sort_values(by='name', inplace=True)
+    employee_df.reset_index(inplace=True) # Reset index to ensure 'id' column is accessible
+    return [{'label': str(row['id']) + ' - ' + row['name'], 'value': row['id']} for index, row in employee_df.iterrows()]
+
 # load configuration parameters
 g_config = config.g_config
 ref_date = config.g_ref_date
 
-# generate page specific dataframes
-employee_df = db_supply.worker_list_get('intern', ref_date)
-employee_df.sort_values(by='name', inplace=True)
-employee_df.reset_index(inplace=True) # Reset index to ensure 'id' column is accessible
-employee_id = employee_df['id'].iloc[0] # default employee id
+# layout of the page, built on every page load so it always shows the latest loaded data
+def layout(**kwargs):
+    # generate page specific data, the reference year is shown by default, other years are loaded when selected
+    year = ref_date.year
+    employee_options = get_employee_options(year)
+    employee_id = employee_options[0]['value'] # default employee id
 
-# initial data setup (showing default employee)
-cost_overview_transposed, summary, parameters = get_employee_data(employee_id)
+    # initial data setup (showing default employee)
+    cost_overview_transposed, summary, parameters = get_employee_data(employee_id, year)
 
-# layout of the page
-layout = html.Div([
-    get_navigation(),
-    html.H1("Simulatie werknemer"),
-    dcc.Dropdown(
-        id='employee-dropdown',
-        options=[{'label': str(row['id']) + ' - ' + row['name'], 'value': row['id']} for index, row in employee_df.iterrows()],
-        value=employee_id  # Default value
-    ),
-    html.P(id='employee-info'),
-    html.Br(),
-    html.H3("Parameters berekening"),
-    dash_table.DataTable(
-        id='table-parameters',
-        columns=[{'name': col, 'id': col} for col in parameters.columns],
-        data=parameters.to_dict('records')
-    ),
-    html.H3("Overzicht kosten"),
-    dash_table.DataTable(
-        id='table-cost_overview',
-        columns=[{'name': col, 'id': col} for col in cost_overview_transposed.columns],
-        data=cost_overview_transposed.to_dict('records'),
-    ),
-    html.H3("Synthese"),
-    dash_table.DataTable(
-        id='table-summary',
-        columns=[{'name': col, 'id': col} for col in summary.columns],
-        data=summary.to_dict('records'),
+    return html.Div([
+        get_navigation(),
+        html.H1("Simulatie werknemer"),
+        dcc.Dropdown(
+            id='year-dropdown',
+            options=[{'label': str(y), 'value': y} for y in sorted(set(db_supply.calendar_years_get()) | {year})],
+            value=year
+        ),
+        dcc.Dropdown(
+            id='employee-dropdown',
+            options=employee_options,
+            value=employee_id  # Default value
+        ),
+        html.P(id='employee-info'),
+        html.Br(),
+        html.H3("Parameters berekening"),
+        dash_table.DataTable(
+            id='table-parameters',
+            columns=[{'name': col, 'id': col} for col in parameters.columns],
+            data=parameters.to_dict('records')
+        ),
+        html.H3("Overzicht kosten"),
+        dash_table.DataTable(
+            id='table-cost_overview',
+            columns=[{'name': col, 'id': col} for col in cost_overview_transposed.columns],
+            data=cost_overview_transposed.to_dict('records'),
+        ),
+        html.H3("Synthese"),
+        dash_table.DataTable(
+            id='table-summary',
+            columns=[{'name': col, 'id': col} for col in summary.columns],
+            data=summary.to_dict('records'),
+        )
+    ])
+
+@callback(
+    [Output('employee-dropdown', 'options'),
+     Output('employee-dropdown', 'value')],
+    Input('year-dropdown', 'value'),
+    State('employee-dropdown', 'value')
     )
-])
+def update_employee_options(selected_year, selected_employee_id):
+    if selected_year is None:
+        return [], None
+    # keep the selected employee if employed in the selected year, else select the first employee
+    employee_options = get_employee_options(selected_year)
+    employee_ids = [option['value'] for option in employee_options]
+    if selected_employee_id not in employee_ids:
+        selected_employee_id = employee_ids[0] if employee_ids else None
+    return employee_options, selected_employee_id
 
 @callback(
     [Output('employee-info', 'children'),
      Output('table-parameters', 'data'),
      Output('table-cost_overview', 'data'),
      Output('table-summary', 'data')],
-    Input('employee-dropdown', 'value')
+    [Input('employee-dropdown', 'value'),
+     Input('year-dropdown', 'value')]
     )
-def update_employee_info(selected_employee_id):
-    if selected_employee_id is None:
+def update_employee_info(selected_employee_id, selected_year):
+    if selected_employee_id is None or selected_year is None:
         return ("No employee selected", [], [], "No revenue data")
     # get data for the selected employee
-    cost_overview_transposed, summary, parameters = get_employee_data(selected_employee_id)
-    return (f"Simulatie wordt getoond voor werknemer {selected_employee_id}",
+    cost_overview_transposed, summary, parameters = get_employee_data(selected_employee_id, selected_year)
+    return (f"Simulatie wordt getoond voor werknemer {selected_employee_id} in {selected_year}",
             parameters.to_dict('records'),
             cost_overview_transposed.to_dict('records'),
             summary.to_dict('records')
@@ -0,0 +1,87 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains structure and functions to display the what-if scenario sweep page.
+#
+
+import dash
+from dash import dcc, html, dash_table, Input, Output, State, callback
+from src.utils import scenario_sweep
+from src.components.navigation import get_navigation
+
+dash.register_page(__name__, path='/scenario_sweep')
+
+# labels of the parameters which can be varied
+parameter_labels = {
+    'inflator': 'Inflator',
+    'yearly_sick_days': 'Ziektedagen per jaar',
+    'yearly_training_days': 'Opleidingsdagen per jaar',
+    'yearly_workdays': 'Werkdagen per jaar',
+    'dayrate_factor': 'Factor dagtarieven',
+}
+
+
+def get_grid(values):
+    """Return the grid of parameter values from the comma separated values entered per parameter, parameters without
+    values are not varied"""
+    grid = {}
+    for name, text in zip(parameter_labels, values):
+        if text and text.strip():
+            grid[name] = [float(value) for value in text.split(',') if value.strip()]
+    return grid
+
+
+# layout of the page
+def layout(**kwargs):
+    return html.Div([
+        get_navigation(),
+        html.H1("Simulatie scenario's"),
+        html.P("Geef per parameter de te berekenen waarden, gescheiden door komma's (bv. 1.00, 1.03). Alle combinaties "
+               "worden berekend en vergeleken met het basisscenario."),
+        html.Div([
+            html.Div([
+                html.Label(label),
+                dcc.Input(id=f'scenario-{name}', type='text', placeholder='ongewijzigd', debounce=True)
+            ]) for name, label in parameter_labels.items()
+        ]),
+        html.Br(),
+        html.Button('Bereken', id='scenario-button'),
+        html.P(id='scenario-info'),
+        dash_table.DataTable(
+            id='table-scenarios',
+            columns=[],
+            data=[],
+            sort_action='native'
+        )
+    ])
+
+
+@callback(
+    [Output('scenario-info', 'children'),
+     Output('table-scenarios', 'columns'),
+     Output('table-scenarios', 'data')],
+    Input('scenario-button', 'n_clicks'),
+    [State(f'scenario-{name}', 'value') for name in parameter_labels],
+    prevent_initial_call=True
+    )
+def update_scenarios(n_clicks, *values):
+    try:
+        grid = get_grid(values)
+        scenario_sweep.scenario_grid(grid)
+    except ValueError:
+        return ("Ongeldige waarde, gebruik getallen gescheiden door komma's, de dagen zijn gehele getallen", [],
+                [])
+    comparison = scenario_sweep.scenario_sweep(grid)
+    return (f"{len(comparison) - 1} scenario's berekend",
+            [{'name': col, 'id': col} for col in comparison.columns],
+            comparison.to_dict('records'))
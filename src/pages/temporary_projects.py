@@ -24,18 +24,17 @@ dash.register_page(__name__, path='/temporary_projects')
 # load configuration parameters
 ref_date = config.g_ref_date
 
-# access dataframes, lists and dictionaries from the shared module
-temporary_projects = data_store.temporary_projects
-month_mapping = data_store.month_mapping
 
-# layout of the page
-layout = html.Div([
-    get_navigation(),
-    html.H1("Omzet tijdelijke projecten"),
-    html.Br(),
-    dash_table.DataTable(
-        id='table-temporary_projects',
-        columns=[{'name': col, 'id': col} for col in temporary_projects.columns],
-        data=temporary_projects.to_dict('records')
-    )
-])
\ No newline at end of file
+# layout of the page, built on every page load so it always shows the latest loaded data
+def layout(**kwargs):
+    temporary_projects = data_store.temporary_projects
+    return html.Div([
+        get_navigation(),
+        html.H1("Omzet tijdelijke projecten"),
+        html.Br(),
+        dash_table.DataTable(
+            id='table-temporary_projects',
+            columns=[{'name': col, 'id': col} for col in temporary_projects.columns],
+            data=temporary_projects.to_dict('records')
+        )
+    ])
@@ -13,15 +13,27 @@
 #
 # This function file contains functions which perform calendar specific calculations.
 #
+import json
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from src.utils import db_supply
+from datetime import datetime, timedelta
+from src.utils import config, data_context, db_supply
 
+# saldo categories of which the remaining absence is forecasted, when calculating billable or paid workhours
+BILLABLE_ABSENCES = ('training', 'vacation', 'holiday', 'adv', 'extralegal_vacation', 'sickness')
+PAID_ABSENCES = ('vacation', 'holiday', 'adv', 'extralegal_vacation', 'sickness')
 
+
+def __getattr__(name: str):
+    """The global dataframe global_workdays is the one of the active forecast engine, or of the process"""
+    return data_context.module_getattr(__name__, name)
+
+
+@data_context.memoised
 def get_workhours(employee_id: int, start_date: datetime, end_date: datetime, billable: bool) -> float:
     """Get the number of workhours forecasted for a specific employee over a specified period.
     If argument billable is set then training_time is excluded from the calculation.
-    Time that is returned is expressed in hours!"""
+    Time that is returned is expressed in hours! Absences after the as-of date are forecasted from the saldi."""
     if end_date.year > start_date.year:
         raise ValueError("Cannot forecast workhours with function get_workhours over multiple years")
     # get global dataframe with calendar
@@ -44,43 +56,69 @@ def get_workhours(employee_id: int, start_date: datetime, end_date: datetime, bi
                       .sum().sum())
 
     # correct vacation_time for future months, based on saldi
-    absence_forecast = 0
-    if end_date > datetime.now():
-        # get global dataframe with saldi
-        global_saldi = db_supply.global_saldi
-        if global_saldi is None:
-            raise ValueError("global_saldi cannot be accessed in function get_workhours")
-        if billable:
-            absence_minutes_left = global_saldi.loc[employee_id, ['training', 'vacation', 'holiday', 'adv',
-                                                              'extralegal_vacation', 'sickness']].sum().sum()
-        else:
-            absence_minutes_left = global_saldi.loc[employee_id, ['vacation', 'holiday', 'adv', 'extralegal_vacation',
-                                                                  'sickness']].sum().sum()
-
-        # if period ends in current month (which is not december), then no absence minutes are forecasted
-        if end_date.month == datetime.now().month and end_date.month != 12:
-            absence_forecast = 0
-        # else calculate forecasted absence for the period
-        else:
-            # calculate number of months left in the year and in the period for which we are calculating
-            months_left_in_year = 12 - datetime.now().month
-            months_left_in_period = end_date.month - max(datetime.now().month, start_date.month) + 1
-            # handle special cases to calculate months left
-            if start_date.year > datetime.now().year:
-                months_left_in_year = 12
-                months_left_in_period = end_date.month - start_date.month + 1
-            # in case we are in the last month of the year, we must consider all remaining days will be taken that month
-            if months_left_in_year == 0:
-                months_left_in_year = 1
-            # calculate expected absence per month
-            monthly_absence_forecast = round(absence_minutes_left / months_left_in_year, 0)
-            # calculate forecasted absence for the period
-            absence_forecast = months_left_in_period * monthly_absence_forecast
+    if billable:
+        absence_forecast = get_absence_forecast(employee_id, start_date, end_date, BILLABLE_ABSENCES)
+    else:
+        absence_forecast = get_absence_forecast(employee_id, start_date, end_date, PAID_ABSENCES)
 
     # calculate and return work hours in calendar
     return round((scheduled_time - leave_time - absence_forecast) / 60, 2)
 
 
+@data_context.memoised
+def absence_forecast_schedule() -> pd.DataFrame:
+    """Build the forecast of absence minutes per employee and month for each saldo category, spreading the saldi left
+    over the months after the as-of date according to the configured absence_profile (relative weights of the 12
+    months). Columns are (category, year, month), year being the year of the as-of date or the year after it, which
+    is used for all later years. Months up to the as-of date are not forecasted, except the month of the as-of date
+    which is forecasted at the same rate, as it is only excluded for periods ending in that month."""
+    global_saldi = db_supply.global_saldi
+    if global_saldi is None:
+        raise ValueError("global_saldi cannot be accessed in function absence_forecast_schedule")
+    as_of = data_context.as_of_get()
+    weights = np.array(json.loads(config.g_config.get('PARAMETERS', 'absence_profile')), dtype=float)
+    # weights of the months of the as-of year, the saldi left are spread over the months after the as-of month, or
+    # taken in december if the as-of date is in december
+    current_year = np.where(np.arange(1, 13) >= as_of.month, weights, 0)
+    current_year = current_year / (weights[as_of.month:].sum() or weights[as_of.month - 1])
+    next_year = weights / weights.sum()
+    categories = list(BILLABLE_ABSENCES)
+    minutes_left = global_saldi[categories].to_numpy(dtype=float)
+    # multiply saldi (employee x category) with month weights (month) into employee x category x month
+    schedule = minutes_left[:, :, np.newaxis] * np.concatenate([current_year, next_year])[np.newaxis, np.newaxis, :]
+    columns = pd.MultiIndex.from_product([categories, [as_of.year, as_of.year + 1], range(1, 13)],
+                                         names=['category', 'year', 'month'])
+    return pd.DataFrame(schedule.reshape(len(global_saldi), -1), index=global_saldi.index, columns=columns)
+
+
+@data_context.memoised
+def absence_forecast_months(categories: tuple) -> dict:
+    """Return the forecasted absence minutes of the given categories together per employee, as an array of 24 months
+    (the months of the as-of year followed by those of later years), rounded per month"""
+    schedule = absence_forecast_schedule()
+    totals = schedule[list(categories)].T.groupby(level=['year', 'month']).sum().T.round(0)
+    return dict(zip(totals.index, totals.to_numpy()))
+
+
+def get_absence_forecast(employee_id: int, start_date: datetime, end_date: datetime, categories: tuple) -> float:
+    """Get the forecasted absence minutes of the given saldo categories for an employee over a period, from the
+    absence forecast schedule. Nothing is forecasted for periods ending before the as-of date, or ending in the month of
+    the as-of date (unless december)."""
+    as_of = data_context.as_of_get()
+    if end_date <= as_of or (end_date.year == as_of.year and end_date.month == as_of.month
+                             and end_date.month != 12):
+        return 0
+    months = absence_forecast_months(categories)[employee_id]
+    absence_forecast = 0
+    for year in range(max(start_date.year, as_of.year), end_date.year + 1):
+        first_month = start_date.month if year == start_date.year else 1
+        last_month = end_date.month if year == end_date.year else 12
+        offset = 0 if year == as_of.year else 12
+        absence_forecast += months[offset + first_month - 1:offset + last_month].sum()
+    return float(absence_forecast)
+
+
+@data_context.memoised
 def get_fte_ratios(employee_id: int, start_date: datetime, end_date: datetime, use_company_workdays: bool)\
         -> (float, float):
     """Get correction factors on fte, return these as two floats
@@ -92,6 +130,7 @@ def get_fte_ratios(employee_id: int, start_date: datetime, end_date: datetime, u
     factor for vacation saldi.
     Note that for an employee with a part-time contract, the contractual FTE is already reflected in the scheduled time.
     So for an employee on an 80% contract the first calculated factor can be 1.0, if there is no other unpaid leave.
+    Vacation after the as-of date is forecasted from the saldi.
     """
     # get global dataframe with multiyear calendar
     global_multiyear_calendar = db_supply.global_multiyear_calendar
@@ -107,33 +146,7 @@ def get_fte_ratios(employee_id: int, start_date: datetime, end_date: datetime, u
     scheduled_time = filtered_calendar['scheduled_time'].sum()
     unpaid_leave = filtered_calendar[['unpaid_leave_time_total', 'unpaid_sick_time']].sum().sum()
     vacation_time = filtered_calendar['vacation_time'].sum()
-    absence_forecast = 0
-
-    if end_date > datetime.now():
-        # get global dataframe with saldi
-        global_saldi = db_supply.global_saldi
-        if global_saldi is None:
-            raise ValueError("global_saldi cannot be accessed in function get_fte_ratios")
-        absence_minutes_left = global_saldi.loc[employee_id, ['vacation']].sum()
-
-        # if period ends in current month (which is not december), then no absence minutes are forecasted
-        if end_date.month == datetime.now().month and end_date.month != 12:
-            absence_forecast = 0
-        # else calculate forecasted absence for the period
-        else:
-            # calculate number of months left in the year and in the period for which we are calculating
-            months_left_in_year = 12 - datetime.now().month
-            months_left_in_period = end_date.month - max(datetime.now().month, start_date.month) + 1
-            # handle special cases to calculate months left
-            if start_date.year > datetime.now().year:
-                months_left_in_year = 12
-                months_left_in_period = end_date.month - start_date.month + 1
-            if months_left_in_year == 0:
-                months_left_in_year = 1
-            # calculate expected absence per month
-            monthly_absence_forecast = round(absence_minutes_left / months_left_in_year, 0)
-            # calculate forecasted absence for the period
-            absence_forecast = months_left_in_period * monthly_absence_forecast
+    absence_forecast = get_absence_forecast(employee_id, start_date, end_date, ('vacation',))
 
     vacation_time = round(vacation_time + absence_forecast, 0)
 
@@ -161,6 +174,17 @@ def get_fte_ratios(employee_id: int, start_date: datetime, end_date: datetime, u
     return float(company_paid_ratio), float(vacation_time_ratio)
 
 
+def get_fte_ratios_batch(periods: pd.DataFrame, use_company_workdays: bool) -> pd.DataFrame:
+    """Get the fte correction factors of function get_fte_ratios for a batch of periods, given as a dataframe with
+    columns employee_id, start_date and end_date. Each distinct period is calculated only once. The result is indexed
+    on these three columns and has columns company_paid_ratio and vacation_time_ratio."""
+    unique_periods = periods[['employee_id', 'start_date', 'end_date']].drop_duplicates()
+    ratios = [get_fte_ratios(employee_id, start_date, end_date, use_company_workdays)
+              for employee_id, start_date, end_date in unique_periods.itertuples(index=False)]
+    return pd.DataFrame(ratios, columns=['company_paid_ratio', 'vacation_time_ratio'],
+                        index=pd.MultiIndex.from_frame(unique_periods))
+
+
 def get_first_day(employee_id: int, year: int) -> datetime:
     """Return the first workday, the day on which there is scheduled time, for an employee in the given year"""
     calendar = db_supply.employee_calendar_get(employee_id, year)
@@ -168,37 +192,90 @@ def get_first_day(employee_id: int, year: int) -> datetime:
     return pd.to_datetime(filtered_df.index[0][1])
 
 
-def calculate_work_time(date: datetime) -> float:
-    """Calculate the number of work minutes in a day"""
-    # legacy code, to remove
-    # Define Belgian holidays
-    #be_holidays = holidays.BE(years=date.year)
-    #if date.weekday() >= 5 or date in be_holidays:
-    #    return 0
-    if date.weekday() >= 5:
-        return 0
-    else:
-        return 480
+def easter_sunday(year: int) -> datetime:
+    """Return the date of Easter Sunday in a year (Gregorian calendar)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    return datetime(year, month, (h + l - 7 * m + 33 * month + 19) % 32)
 
 
-def build_workday_calendar(year: int):
-    """Build a workday calendar defining all official workdays INCLUDING the legal holidays in belgium in a given year
-    and the previous year"""
-    global global_workdays
-    # Generate date range for the entire year
-    start_date = datetime(year - 1, 1, 1)
-    end_date = datetime(year, 12, 31)
-    date_range = pd.date_range(start_date, end_date)
+def belgian_holidays(year: int) -> list:
+    """Return the ten legal holidays in Belgium in a year"""
+    easter = easter_sunday(year)
+    return [datetime(year, 1, 1), easter + timedelta(days=1), datetime(year, 5, 1), easter + timedelta(days=39),
+            easter + timedelta(days=50), datetime(year, 7, 21), datetime(year, 8, 15), datetime(year, 11, 1),
+            datetime(year, 11, 11), datetime(year, 12, 25)]
+
+
+def build_workday_calendar(year: int, first_year: int = None):
+    """Build a workday calendar defining all official workdays in a given year and the previous year (or all years
+    from first_year). The legal holidays in belgium are flagged, and counted as workdays when parameter holidays_paid
+    is set. Column cumulative_work_time holds the work minutes up to and including each day, so the work minutes of a
+    period are the difference of two lookups."""
+    first_year = year - 1 if first_year is None else first_year
+    date_range = pd.date_range(datetime(first_year, 1, 1), datetime(year, 12, 31))
+    holidays = np.array([holiday for y in range(first_year, year + 1) for holiday in belgian_holidays(y)],
+                        dtype='datetime64[D]')
+
+    # weekdays are workdays of 480 minutes, legal holidays only if they are paid workdays in the company calendar
+    dates = date_range.values.astype('datetime64[D]')
+    is_holiday = np.isin(dates, holidays)
+    is_workday = np.is_busday(dates)
+    if not config.g_config.getboolean('PARAMETERS', 'holidays_paid'):
+        is_workday &= ~is_holiday
+    work_time = np.where(is_workday, 480, 0)
 
     # Create dataframe
-    global_workdays = pd.DataFrame(date_range, columns=['date'])
-    global_workdays['work_time'] = global_workdays['date'].apply(calculate_work_time)
+    workdays = pd.DataFrame({'date': date_range, 'holiday': is_holiday, 'work_time': work_time,
+                             'cumulative_work_time': work_time.cumsum()})
+    data_context.data_set('global_workdays', workdays)
+
+
+def complete_calendar(year: int):
+    """Complete the calendar and multiyear calendar of a year with the employees having a contract in that year but no
+    calendar, e.g. in a future year of which the calendar is not in the database yet. Their scheduled time is the work
+    time of the workday calendar times the FTE of their contract, without leave, as the leave is forecasted from the
+    saldi."""
+    global_calendar = db_supply.global_calendar
+    contracts = pd.concat([db_supply.employee_contracts_get(datetime(year, month, 1)) for month in range(1, 13)])
+    contracts = contracts[~contracts.index.duplicated()]
+    missing = contracts[~contracts['employee_id'].isin(global_calendar.index.get_level_values('employee_id'))]
+    if missing.empty:
+        return
+    print(f"No calendar of {year} for employees {sorted(missing['employee_id'].unique().tolist())}, scheduling them "
+          f"from the workday calendar and the FTE of their contracts")
+    # one row per day of the year on which a contract of the employee runs
+    workdays = data_context.data_get('global_workdays')
+    workdays = workdays.loc[workdays['date'].dt.year == year, ['date', 'work_time']]
+    days = missing[['employee_id', 'start_date', 'end_date', 'fte']].merge(workdays, how='cross')
+    start_date = pd.to_datetime(days['start_date'])
+    end_date = pd.to_datetime(days['end_date']).fillna(pd.Timestamp(year, 12, 31))
+    days = days[(days['date'] >= start_date) & (days['date'] <= end_date)]
+    days = days.drop_duplicates(['employee_id', 'date'], keep='last')
+    rows = pd.DataFrame(0, index=pd.MultiIndex.from_frame(days[['employee_id', 'date']]),
+                        columns=global_calendar.columns)
+    rows['scheduled_time'] = (days['work_time'] * days['fte']).round(0).astype(int).to_numpy()
+    data_context.data_set('global_calendar', pd.concat([global_calendar, rows]).sort_index())
+    data_context.data_set('global_multiyear_calendar',
+                          pd.concat([db_supply.global_multiyear_calendar, rows]).sort_index())
 
 
 def get_workday_worktime(start_date: datetime, end_date: datetime) -> float:
-    """Get the number of work minutes in a specific period"""
-    global global_workdays
+    """Get the number of work minutes in a specific period, from the cumulative work time of the workday calendar"""
+    global_workdays = data_context.data_get('global_workdays')
     if global_workdays is None:
         raise ValueError("global_workdays cannot be accessed in function get_workday_workhours")
-    return global_workdays[(global_workdays['date'] >= start_date) & (global_workdays['date']
-                                                                      <= end_date)]['work_time'].sum()
+    # positions of the first and last day of the period in the calendar, which has one row per day
+    first_day = global_workdays['date'].iat[0]
+    first = max(int(np.ceil((pd.Timestamp(start_date) - first_day) / pd.Timedelta(days=1))), 0)
+    last = min(int(np.floor((pd.Timestamp(end_date) - first_day) / pd.Timedelta(days=1))), len(global_workdays) - 1)
+    if last < first:
+        return 0
+    cumulative_work_time = global_workdays['cumulative_work_time'].to_numpy()
+    return cumulative_work_time[last] - (cumulative_work_time[first - 1] if first > 0 else 0)
@@ -14,10 +14,19 @@
 # This function file contains functions which perform employee specific calculations.
 #
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import json
 import calendar
-from src.utils import calculate_calendar, config, db_supply, calculate_project, gen_helpers as gh
+import contextlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from src.utils import calculate_calendar, config, data_context, db_supply, calculate_project, gen_helpers as gh
+
+# forecast engine and contracts and workers per month of a process of the fan-out, see fanout_init
+fanout_engine = None
+fanout_months = {}
 
 
 def get_bonus(contract_id: int, contract_frame: pd.DataFrame, hr_values: pd.DataFrame) -> float:
@@ -170,7 +179,8 @@ def monthly_revenue(employee_id: int, ref_date: datetime) -> (float, float):
     project_id, project_start, project_end = calculate_project.get_consultant_project(employee_id, ref_date)
     dayrate, msp_fee = calculate_project.get_project_dayrate(project_id)
     if project_id == 99999:
-        gh.logger(f"No project found for employee {employee_id} in month {ref_date.month}, setting dayrate to 0.00.")
+        gh.logger(f"No project found for employee {employee_id} {gh.get_consultant_name(employee_id)} in month "
+                  f"{ref_date.month}, setting dayrate to 0.00.")
         return 0.00, 0.00
     # define actual date range for reference period, from the first until the last of the month
     period_start = ref_date.replace(day=1)
@@ -184,48 +194,97 @@ def monthly_revenue(employee_id: int, ref_date: datetime) -> (float, float):
     return revenue, revenue * (1 - msp_fee)
 
 
+def employee_month_rows(ref_date: datetime, contract_ids: list, empl_contracts: pd.DataFrame,
+                        worker_list: pd.DataFrame) -> (list, list):
+    """Calculate the cost and revenue rows of the given employee contracts in a month, see get_monthly_summary_data"""
+    cost_list = []
+    revenue_list = []
+    for contract_id in contract_ids:
+        employee_id = empl_contracts.loc[contract_id, 'employee_id']
+        revenue, revenue_msp = monthly_revenue(employee_id, ref_date)
+        cost_empl = monthly_cost(contract_id, ref_date, empl_contracts, worker_list, revenue)
+        cost_list.append(cost_empl)
+        revenue_empl = {'Medewerker': cost_empl['Medewerker'], 'Inkomsten na MSP': revenue_msp}
+        revenue_list.append(revenue_empl)
+    return cost_list, revenue_list
+
+
 def get_monthly_summary_data(ref_date: datetime) -> (pd.DataFrame, pd.DataFrame):
     """Create two dataframes showing all different costs and incomes for all employees in a month
     These dataframe only include individual costs (salary package, ICT of individual employee, training,
     etc.) and income but do NOT include general company costs, management and administration cost
     """
     worker_list = db_supply.worker_list_get('intern')
-    cost_list = []
-    revenue_list = []
     # get all employee contracts valid on ref_date
     empl_contracts = db_supply.employee_contracts_get(ref_date)
-    # loop over all employee contracts
-    for index, row in empl_contracts.iterrows():
-        contract_id = index
-        employee_id = row['employee_id']
-        revenue, revenue_msp = monthly_revenue(employee_id, ref_date)
-        cost_empl = monthly_cost(contract_id, ref_date, empl_contracts, worker_list, revenue)
-        cost_list.append(cost_empl)
-        revenue_empl = {'Medewerker': cost_empl['Medewerker'], 'Inkomsten na MSP': revenue_msp}
-        revenue_list.append(revenue_empl)
+    # calculate all employee contracts
+    cost_list, revenue_list = employee_month_rows(ref_date, empl_contracts.index, empl_contracts, worker_list)
     return (pd.DataFrame.from_records(cost_list).set_index(['Medewerker']),
             pd.DataFrame.from_records(revenue_list).set_index(['Medewerker']))
 
 
+def fanout_init(engine, months: dict):
+    """Initialize a process of the fan-out of employee_month_rows_parallel with the forecast engine (None for the data
+    of the process) and the work per month. The process is forked, so these are inherited and not copied."""
+    global fanout_engine, fanout_months
+    fanout_engine, fanout_months = engine, months
+
+
+def employee_month_unit(month_date: datetime, contract_ids: list) -> (list, list):
+    """Work unit of the fan-out of employee_month_rows_parallel: the cost and revenue rows of some employee contracts
+    in a month"""
+    month_contract_ids, empl_contracts, worker_list = fanout_months[month_date]
+    with fanout_engine.activate() if fanout_engine is not None else contextlib.nullcontext():
+        return employee_month_rows(month_date, contract_ids, empl_contracts, worker_list)
+
+
+def employee_month_rows_parallel(months: dict, workers: int) -> dict:
+    """Calculate employee_month_rows for several months in a pool of forked processes sharing the loaded dataframes of
+    the parent process. Months is a dictionary of month date to the contract ids to calculate, the employee contracts
+    and the worker list of the month. The contracts of all months are divided in work units over the processes. Returns
+    the cost and revenue rows per month, in the order of the contract ids."""
+    units = [(month_date, list(contract_ids)) for month_date, (month_contract_ids, empl_contracts, worker_list)
+             in months.items() for contract_ids in np.array_split(np.asarray(month_contract_ids), workers)
+             if len(contract_ids)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=fanout_init, initargs=(data_context.active_engine.get(), months)) as executor:
+        results = list(executor.map(employee_month_unit, *zip(*units)))
+    # merge the rows of the work units per month, in the order of the contracts
+    rows = {month_date: ([], []) for month_date in months}
+    for (month_date, contract_ids), (cost_list, revenue_list) in zip(units, results):
+        rows[month_date][0].extend(cost_list)
+        rows[month_date][1].extend(revenue_list)
+    return rows
+
+
+def get_monthly_summary_data_parallel(month_dates: list, workers: int) -> dict:
+    """Get the result of get_monthly_summary_data for several months, per month in a dictionary. The employee
+    contracts of all months are calculated by a pool of processes, see employee_month_rows_parallel."""
+    worker_list = db_supply.worker_list_get('intern')
+    months = {}
+    for month_date in month_dates:
+        empl_contracts = db_supply.employee_contracts_get(month_date)
+        months[month_date] = (empl_contracts.index, empl_contracts, worker_list)
+    rows = employee_month_rows_parallel(months, workers)
+    return {month_date: (pd.DataFrame.from_records(cost_list).set_index(['Medewerker']),
+                         pd.DataFrame.from_records(revenue_list).set_index(['Medewerker']))
+            for month_date, (cost_list, revenue_list) in rows.items()}
+
+
 def monthly_summary(cost_overview: pd.DataFrame, revenue_overview: pd.DataFrame) -> pd.DataFrame:
     """Create summary dataframe showing employee cost, income and margin for month or year"""
     ignore_list = json.loads(config.g_config.get('PARAMETERS', 'ignore_list'))
-    overview = []
     # list of columns from the cost_overview dataframe that we want to include in the summary
     costs_to_include = ['Bezoldiging', 'Provisie vakantiegeld', 'Provisie eindejaarspremie', 'RSZ werkgever',
                         'Premie-PC200', 'Bonus', 'Nettovergoeding', 'Maaltijdcheques', 'ECO-cheques',
                         'Hospitalisatieverz.', 'Groepsverz.', 'Administratie Securex', 'Verzekering BA',
                         'Verzekering AO', 'Mobiliteitskost', 'Opleiding', 'Attenties en activiteiten', 'Preventie',
                         'ICT']
-    for i in cost_overview.index.tolist():
-        cost = cost_overview.loc[i, costs_to_include].sum(axis=0)
-        income = revenue_overview.loc[i].sum(axis=0)
-        margin = income - cost
-        # if summary dataframe is not for full year, then do not include margin percentage
-        overview_one_empl = {'Medewerker': i, 'Kostprijs': round(cost, 2), 'Omzet': round(income, 2),
-                             'Bruto marge': round(margin, 2)}
-        overview.append(overview_one_empl)
-    overview_frame = pd.DataFrame.from_records(overview).set_index(['Medewerker'])
+    # cost, income and margin of all employees at once
+    cost = cost_overview[costs_to_include].sum(axis=1)
+    income = revenue_overview.sum(axis=1).reindex(cost_overview.index)
+    overview_frame = pd.DataFrame({'Kostprijs': cost.round(2), 'Omzet': income.round(2),
+                                   'Bruto marge': (income - cost).round(2)})
     # drop employees in ignore list
     try:
         overview_frame.drop(ignore_list, inplace=True)
@@ -240,6 +299,13 @@ def monthly_summary(cost_overview: pd.DataFrame, revenue_overview: pd.DataFrame)
 def get_year_of_monthly_summaries():
     """Get all monthly employee summaries, starting with current month of ref_date, for the whole year"""
     ref_date = config.g_ref_date
+    # number of processes calculating the months in parallel, 0 for the number of cores
+    workers = config.g_config.getint('PARAMETERS', 'forecast_workers') or os.cpu_count()
+    if workers > 1:
+        month_dates = [datetime(ref_date.year, month, 1) for month in range(ref_date.month, 13)]
+        monthly_data = get_monthly_summary_data_parallel(month_dates, workers)
+        return {month_date.month: monthly_summary(monthly_cost, monthly_income)
+                for month_date, (monthly_cost, monthly_income) in monthly_data.items()}
     # create dictionary to store the monthly employee summaries
     monthly_employee_summaries = {}
     # loop over all months of the year, starting from the current month
@@ -271,99 +337,136 @@ def evaluate_contract_start_end(contract_id: int, contract_frame: pd.DataFrame,
 def yearly_cost_income(employee_id: int, real_calendar: bool = False) -> (pd.DataFrame, float, pd.DataFrame):
     """Simulates yearly cost, income and margin for a single employee. This function looks at the project and
     employment situation on ref_date and assumes this situation is constant for the whole year. The calculations are the
-    same as those done by the loonberekening Excel file
+    same as those done by the loonberekening Excel file, see yearly_cost_income_batch
     The real_calendar parameter is used to determine if the actual workdays and billable days should be used, or if the
     configured "average" billable days are used
     Function returns the calculation results as well as the parameters for display by a reporting function.
     """
+    cost_overview, yearly_revenue, parameters = yearly_cost_income_batch([employee_id], real_calendar)
+    if cost_overview.empty:
+        raise ValueError(f"No contract found for employee {employee_id} on {config.g_ref_date.strftime('%Y-%m-%d')}")
+    return cost_overview, yearly_revenue.iloc[0], parameters
+
+
+def yearly_cost_income_batch(employee_ids: list = None, real_calendar: bool = False) \
+        -> (pd.DataFrame, pd.Series, pd.DataFrame):
+    """Simulates yearly cost, income and margin for all employees with a contract on ref_date (or the given employees)
+    at once. Like yearly_cost_income the project and employment situation on ref_date is assumed constant for the whole
+    year. Returns the cost overview, the yearly revenue and the parameters, all indexed by employee."""
     ref_date = config.g_ref_date
-    # get global hr values
-    global_hr_values = db_supply.global_hr_values
-    # get contract data
+    year_start = ref_date.replace(month=1, day=1)
+    year_end = ref_date.replace(month=12, day=31)
+    inflator = config.g_config.getfloat('PARAMETERS', 'inflator')
+    # get global hr values as a series of values by code
+    hr = db_supply.global_hr_values['waarde']
+    # get contract data, the first contract of each employee valid on ref_date
     contract_frame = db_supply.employee_contracts_get(ref_date)
-    contract_id = contract_frame[contract_frame['employee_id'] == employee_id].index[0]
-
-    # evaluate if contract is starting or ending in the current year
-    contract_change = evaluate_contract_start_end(contract_id, contract_frame, ref_date, 'y')
-    if contract_change:
-        gh.logger(f"Contract for {employee_id} is starting or ending in year {ref_date.year}.")
+    contracts = contract_frame.reset_index().drop_duplicates('employee_id').set_index('employee_id')
+    if employee_ids is not None:
+        contracts = contracts[contracts.index.isin(employee_ids)]
+    contracts.index.name = 'Employee'
+
+    # evaluate if contracts are starting or ending in the current year
+    for employee_id in contracts.index:
+        if evaluate_contract_start_end(contracts.loc[employee_id, 'id'], contract_frame, ref_date, 'y'):
+            gh.logger(f"Contract for {employee_id} is starting or ending in year {ref_date.year}.")
+
+    # calculate correction factors FTE for the year and the reference periods of bonus, ECO cheques and PC200 premium
+    def ratios(start_date: datetime, end_date: datetime, use_company_workdays: bool) -> pd.Series:
+        periods = pd.DataFrame({'employee_id': contracts.index, 'start_date': start_date, 'end_date': end_date})
+        batch = calculate_calendar.get_fte_ratios_batch(periods, use_company_workdays)
+        return pd.Series(batch['company_paid_ratio'].to_numpy(), index=contracts.index)
+    company_paid_ratio = ratios(year_start, year_end, False)
+    bonus_ratio = ratios(ref_date.replace(year=ref_date.year - 1, month=12, day=1),
+                         ref_date.replace(month=11, day=30), True)
+    cheques_ratio = ratios(ref_date.replace(year=ref_date.year - 1, month=6, day=1),
+                           ref_date.replace(month=5, day=31), True)
 
-    # calculate correction factor FTE, to take into the actual fte time that are paid hours
-    company_paid_ratio, vacation_time_ratio = calculate_calendar.get_fte_ratios(
-        employee_id,
-        ref_date.replace(month=1, day=1),
-        ref_date.replace(month=12, day=31),
-        False)
     # calculate workdays and billable days
     if real_calendar:
-        yearly_workdays = calculate_calendar.get_workhours(employee_id, ref_date.replace(month=1, day=1),
-                                                           ref_date.replace(month=12, day=31), False) / 8
-        yearly_billable_days = calculate_calendar.get_workhours(employee_id, ref_date.replace(month=1, day=1),
-                                                                ref_date.replace(month=12, day=31), True) / 8
+        yearly_workdays = pd.Series([calculate_calendar.get_workhours(employee_id, year_start, year_end, False) / 8
+                                     for employee_id in contracts.index], index=contracts.index)
+        yearly_billable_days = pd.Series([calculate_calendar.get_workhours(employee_id, year_start, year_end, True) / 8
+                                          for employee_id in contracts.index], index=contracts.index)
     else:
-        yearly_billable_days = (int(config.g_config.get('PARAMETERS', 'yearly_workdays')) *
-                                contract_frame.loc[contract_id, 'fte'] * company_paid_ratio)
+        yearly_billable_days = (int(config.g_config.get('PARAMETERS', 'yearly_workdays')) * contracts['fte'] *
+                                company_paid_ratio)
         # to stay aligned with tool in Excel we simplify by assuming workdays equals billable days
         yearly_workdays = yearly_billable_days
 
     # get FTE correction factors
-    actual_fte = contract_frame.loc[contract_id, 'fte'] * company_paid_ratio
-
-    # calculate yearly revenue
-    project_id, project_start, project_end = calculate_project.get_consultant_project(employee_id, ref_date)
-    dayrate, msp_fee = calculate_project.get_project_dayrate(project_id)
+    actual_fte = contracts['fte'] * company_paid_ratio
+
+    # calculate yearly revenue, from the first project of each employee running in the month of ref_date
+    global_projects = db_supply.global_projects
+    month_end = ref_date.replace(day=calendar.monthrange(ref_date.year, ref_date.month)[1])
+    projects = (global_projects[(global_projects['start_date'] <= month_end) &
+                                (global_projects['end_date'] >= ref_date.replace(day=1))]
+                .drop_duplicates('employee_id').set_index('employee_id'))
+    for employee_id in contracts.index.difference(projects.index):
+        gh.logger(f"No project found for employee {employee_id} {gh.get_consultant_name(employee_id)} in month "
+                  f"{ref_date.month}, setting dayrate to 0.00.")
+    project_index = calculate_project.get_project_index()
+    project_ids = projects['id'].reindex(contracts.index)
+    dayrate = project_ids.map(project_index['hourly_rate'] * 8).fillna(0.0)
+    msp_fee = project_ids.map(project_index['msp_percentage']).fillna(0.0)
     yearly_revenue = yearly_billable_days * dayrate * (1 - msp_fee)
 
     # calculate gross salary
-    bezoldiging = (contract_frame.loc[contract_id, 'monthly_salary'] * company_paid_ratio
-                   * config.g_config.getfloat('PARAMETERS', 'inflator'))
+    bezoldiging = contracts['monthly_salary'] * company_paid_ratio * inflator
+
+    # bonus depends on the function category, net allowance on the mobility type
+    category = contracts['function_category']
+    bonus = (hr['HR020'] * category.str.startswith('JUN') + hr['HR021'] * category.str.startswith('EXP') +
+             hr['HR022'] * (category.str.startswith('SEN') | category.str.startswith('BUS'))) * bonus_ratio
+    net_allowance = (contracts['mobility_type'] == 'car').map({True: hr['HR030'], False: hr['HR031']})
 
     # calculate full cost matrix
-    cost_overview = {
-        'Employee': employee_id,
-        'Bezoldiging': round(bezoldiging * 12, 2),
-        'Maaltijdcheques': round((global_hr_values.loc['HR010', 'waarde'] * global_hr_values.loc['HR012', 'waarde'] *
-                                  yearly_workdays), 2),
-        'RSZ werkgever': round(bezoldiging * 12 * global_hr_values.loc['HR401', 'waarde'], 2),
-        'Eindejaarspremie': round(bezoldiging * (1 + global_hr_values.loc['HR401', 'waarde']), 2),
-        'Premie-PC200': round(get_pc200_premium(employee_id, global_hr_values), 2),
-        'Bonus': round(get_bonus(contract_id, contract_frame, global_hr_values), 2),
-        'Dubbel vakantiegeld': round(get_vakantiegeld(bezoldiging, 1), 2),
-        'Nettovergoeding': round(get_net_allowance(contract_id, contract_frame, global_hr_values) * 12, 2),
-        'ECO-cheques': round(get_eco_cheques(employee_id, global_hr_values), 2),
-        'Hospitalisatieverz.': round(global_hr_values.loc['HR041', 'waarde'] * 1.25, 2),
-        'Groepsverz.': round(global_hr_values.loc['HR113', 'waarde'] * contract_frame.loc[contract_id, 'fte'] *
-                             company_paid_ratio, 2),
-        'Administratie Securex': round(global_hr_values.loc['HR100', 'waarde'], 2),
-        'Verzekering BA': round(global_hr_values.loc['HR110', 'waarde'] * yearly_revenue, 2),
-        'Verzekering AO': round(global_hr_values.loc['HR111', 'waarde'], 2),
-        'Mobiliteitskost': round(contract_frame.loc[contract_id, 'monthly_mobility'] * 12, 2),
-        'Opleiding, attenties en activiteiten': round(global_hr_values.loc['HR120', 'waarde'] +
-                                                      global_hr_values.loc['HR140', 'waarde'] +
-                                                      global_hr_values.loc['HR141', 'waarde'], 2),
-        'Preventie': round((global_hr_values.loc['HR130', 'waarde'] + global_hr_values.loc['HR101', 'waarde']), 2),
-        'ICT': round((global_hr_values.loc['HR150', 'waarde'] + global_hr_values.loc['HR151', 'waarde'] +
-                     global_hr_values.loc['HR152', 'waarde'] + global_hr_values.loc['HR153', 'waarde']), 2),
-        'Management tijd': round(global_hr_values.loc['HR080', 'waarde'], 2),
-        'Administratie': round(global_hr_values.loc['HR081', 'waarde'], 2),
-        'Algemene kosten': round(global_hr_values.loc['HR200', 'waarde'], 2),
-    }
+    cost_overview = pd.DataFrame({
+        'Bezoldiging': bezoldiging * 12,
+        'Maaltijdcheques': hr['HR010'] * hr['HR012'] * yearly_workdays,
+        'RSZ werkgever': bezoldiging * 12 * hr['HR401'],
+        'Eindejaarspremie': bezoldiging * (1 + hr['HR401']),
+        'Premie-PC200': hr['HR025'] * cheques_ratio,
+        'Bonus': bonus,
+        'Dubbel vakantiegeld': bezoldiging * 0.92,
+        'Nettovergoeding': net_allowance * 12,
+        'ECO-cheques': hr['HR011'] * hr['HR013'] * cheques_ratio,
+        'Hospitalisatieverz.': hr['HR041'] * 1.25,
+        'Groepsverz.': hr['HR113'] * contracts['fte'] * company_paid_ratio,
+        'Administratie Securex': hr['HR100'],
+        'Verzekering BA': hr['HR110'] * yearly_revenue,
+        'Verzekering AO': hr['HR111'],
+        'Mobiliteitskost': contracts['monthly_mobility'] * 12,
+        'Opleiding, attenties en activiteiten': hr['HR120'] + hr['HR140'] + hr['HR141'],
+        'Preventie': hr['HR130'] + hr['HR101'],
+        'ICT': hr['HR150'] + hr['HR151'] + hr['HR152'] + hr['HR153'],
+        'Management tijd': hr['HR080'],
+        'Administratie': hr['HR081'],
+        'Algemene kosten': hr['HR200'],
+    }, index=contracts.index).astype(float).round(2)
 
     # parameters
-    parameters = {
-        'Employee': employee_id,
-        'Level': contract_frame.loc[contract_id, 'function_category'],
-        'Mobility': contract_frame.loc[contract_id, 'mobility_type'],
-        'Maandloon': contract_frame.loc[contract_id, 'monthly_salary']
-                     * config.g_config.getfloat('PARAMETERS', 'inflator'),
+    parameters = pd.DataFrame({
+        'Level': category,
+        'Mobility': contracts['mobility_type'],
+        'Maandloon': contracts['monthly_salary'] * inflator,
         'FTE': actual_fte,
         'Billable dagen': yearly_billable_days,
         'Dayrate': dayrate,
         'MSP fee': msp_fee,
-    }
-
-    table_cost_overview = pd.DataFrame.from_records([cost_overview], index='Employee')
-    table_parameters = pd.DataFrame.from_records([parameters], index='Employee')
+    }, index=contracts.index)
 
     # return results
-    return table_cost_overview, yearly_revenue, table_parameters
+    return cost_overview, yearly_revenue, parameters
+
+
+def yearly_margin_ranking(cost_overview: pd.DataFrame, yearly_revenue: pd.Series) -> pd.DataFrame:
+    """Summarize the results of yearly_cost_income_batch as yearly cost, revenue and margin per employee, ranked from
+    the highest to the lowest margin. The margin percentage is missing for employees without revenue."""
+    yearly_cost = cost_overview.sum(axis=1)
+    margin = yearly_revenue - yearly_cost
+    margin_percentage = margin / yearly_revenue.where(yearly_revenue != 0) * 100
+    ranking = pd.DataFrame({'Kostprijs': yearly_cost.round(2), 'Omzet': yearly_revenue.round(2),
+                            'Bruto marge': margin.round(2), 'Brutowinstpercentage': margin_percentage.round(2)})
+    return ranking.sort_values('Bruto marge', ascending=False)
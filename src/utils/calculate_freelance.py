@@ -13,70 +13,65 @@
 #
 # This function file contains functions which perform freelancer specific calculations.
 #
+import calendar
 import pandas as pd
 from datetime import datetime
-from src.utils import db_supply, config, calculate_project
+from src.utils import db_supply, config, calculate_calendar, gen_helpers as gh
 
 
-def monthly_project_revenue(project_id: int, workdays: float) -> (float, float):
-    """Calculate expected monthly project revenue before and after substracting MSP fee"""
-    # todo: in the future add to this function a monthly variable average number of days or use actual calendar to
-    # calculate the number of days that can be worked in a month
-    dayrate, msp_fee = calculate_project.get_project_dayrate(project_id)
-    revenue = dayrate * workdays
-    return revenue, revenue * (1 - msp_fee)
-
-
-def monthly_cost(employee_id, monthly_revenue, days) -> (float, float):
-    """Calculate expected monthly cost of a freelancer"""
-    # todo: in the future add to this function the possibility to get the right contract of a freelancer linked to a
-    # specific project. Now we can only select one project and one contract. If we want to have multiple simultaneous
-    # projects we need to change in the database that there is a link between a project and a contract.
-    # get global hr values and global freelance contracts
+def monthly_summary(ref_date: datetime) -> pd.DataFrame:
+    """Create one dataframe giving a list of all projects executed by freelancers in the month of ref_date, including
+    name of the freelancer, project monthly revenue, project monthly cost and gross margin. Freelancers, their projects
+    active in the month and their contract are joined in one pass, a freelancer working on multiple projects has one
+    row per project. The workdays of a project are the company workdays of the month during which the project runs,
+    times the percentage of the project.
+    """
     global_hr_values = db_supply.global_hr_values
+    global_projects = db_supply.global_projects
     global_freelance_contracts = db_supply.global_freelance_contracts
-    # get hourly rate of freelancer
-    freelancer_contracts = global_freelance_contracts[global_freelance_contracts['employee_id'] == employee_id]
-    if len(freelancer_contracts) == 0:
-        raise ValueError(f"No contracts found for freelancer {employee_id}")
-    elif len(freelancer_contracts) > 1:
-        raise ValueError(f"Multiple contracts found for freelancer {employee_id}")
-    # calculate dayrate cost and operational cost
-    dayrate_cost = freelancer_contracts['hourly_rate'].values[0] * 8 * days
-    operational_cost = round((monthly_revenue * global_hr_values.loc['HR110', 'waarde']) / 12, 2)
-    return dayrate_cost + operational_cost
+    worker_list = db_supply.worker_list_get('Freelance')
+    start_window = ref_date.replace(day=1)
+    end_window = ref_date.replace(day=calendar.monthrange(ref_date.year, ref_date.month)[1])
 
+    # projects of freelancers active in the month, one row per project
+    projects = global_projects[global_projects['employee_id'].isin(worker_list.index) &
+                               (global_projects['start_date'] <= end_window) &
+                               (global_projects['end_date'] >= start_window)]
+    for employee_id in worker_list.index.difference(projects['employee_id']):
+        gh.logger(f"No project found for employee {employee_id} {worker_list.loc[employee_id, 'name']} in month "
+                  f"{ref_date.month}, skipping this freelancer.")
 
-def monthly_summary(ref_date: datetime) -> pd.DataFrame:
-    """Create one dataframe giving a list of all projects executed by freelancers, including name of the freelancer,
-    project monthly revenue, project monthly cost and gross margin.
-    """
-    worker_list = db_supply.worker_list_get('Freelance')
-    project_data = []
-    # loop over all freelance workers
-    for index, row in worker_list.iterrows():
-        # get projects active on ref date for this freelancer
-        # todo: this function currently only retrieves one project, if working on multiple projects this will
-        # include only one project
-        project_id, start_date, end_date = calculate_project.get_consultant_project(index, ref_date)
-        # if no project found, skip this freelancer
-        if project_id == 99999:
-            continue
-        workdays = calculate_project.get_project_fte(project_id) * 217 / 12
-        revenue, revenue_msp = monthly_project_revenue(project_id, workdays)
-        # calculate monthly cost: hourly fee and expenses
-        monthly_cost_freelance = monthly_cost(index, revenue, workdays)
-        # add to list of projects
-        project = {'Medewerker': row['name'],
-                   'Kostprijs': round(monthly_cost_freelance, 2),
-                   'Omzet': round(revenue_msp, 2),
-                   'Bruto marge': round(revenue_msp - monthly_cost_freelance, 2)
-                   }
-        project_data.append(project)
-    project_frame = pd.DataFrame.from_records(project_data).set_index(['Medewerker'])
+    # hourly rate of the contract of each freelancer, a freelancer may have several contract rows (one per project line
+    # in older data) but they must all have the same hourly rate
+    contract_rates = global_freelance_contracts.groupby('employee_id')['hourly_rate']
+    rate_count = contract_rates.nunique()
+    for employee_id in projects['employee_id'].unique():
+        if employee_id not in rate_count.index:
+            raise ValueError(f"No contracts found for freelancer {employee_id}")
+        elif rate_count[employee_id] > 1:
+            raise ValueError(f"Contracts with different hourly rates found for freelancer {employee_id}")
+    contracts = contract_rates.first().rename('contract_hourly_rate')
+    project_frame = projects.join(contracts, on='employee_id').join(worker_list['name'], on='employee_id')
+
+    # workdays of the project in the month, from the company workday calendar
+    project_start = project_frame['start_date'].clip(lower=pd.Timestamp(start_window))
+    project_end = project_frame['end_date'].clip(upper=pd.Timestamp(end_window))
+    worktime = [calculate_calendar.get_workday_worktime(start_date, end_date)
+                for start_date, end_date in zip(project_start, project_end)]
+    workdays = pd.Series(worktime, index=project_frame.index, dtype=float) / 480 * project_frame['percentage']
+
+    # monthly revenue before and after MSP fee, and cost being hourly fee and operational cost
+    revenue = project_frame['hourly_rate'] * 8 * workdays
+    revenue_msp = revenue * (1 - project_frame['msp_percentage'])
+    operational_cost = (revenue * global_hr_values.loc['HR110', 'waarde'] / 12).round(2)
+    cost = project_frame['contract_hourly_rate'] * 8 * workdays + operational_cost
+
+    # return one dataframe which is a list of projects with 4 columns: Medewerker, Kostprijs, Omzet, Bruto marge
+    project_frame = pd.DataFrame({'Medewerker': project_frame['name'],
+                                  'Kostprijs': cost.round(2),
+                                  'Omzet': revenue_msp.round(2),
+                                  'Bruto marge': (revenue_msp - cost).round(2)}).set_index(['Medewerker'])
     project_frame.sort_index(inplace=True)
-    # return one dataframe which is a list of projects with 3 columns: Medewerker, Kostprijs, Omzet, Bruto marge
-    # todo: if a freelancer is working on two projects this is shown on two separate lines
     return project_frame
 
 
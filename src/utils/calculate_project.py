@@ -15,8 +15,9 @@
 #
 from datetime import datetime
 import calendar
+import numpy as np
 import pandas as pd
-from src.utils import db_supply, gen_helpers as gh
+from src.utils import db_supply, data_context, gen_helpers as gh
 
 
 def get_consultant_project(consultant_id: int, ref_date: datetime) -> (int, datetime, datetime):
@@ -38,12 +39,17 @@ def get_consultant_project(consultant_id: int, ref_date: datetime) -> (int, date
     return 99999, datetime(2100, 1, 1), datetime(2100, 1, 1)
 
 
+@data_context.memoised
+def get_project_index() -> pd.DataFrame:
+    """Return the projects indexed by project id, for direct lookup of a project"""
+    return db_supply.global_projects.drop_duplicates('id').set_index('id')
+
+
 def get_project_dayrate(project_id: int) -> (float, float):
     """Retrieve current dayrate of project and applicable MSP fee"""
-    global_projects = db_supply.global_projects
-    for x in global_projects.index:
-        if global_projects.loc[x, 'id'] == project_id:
-            return global_projects.loc[x, 'hourly_rate'] * 8, global_projects.loc[x, 'msp_percentage']
+    project_index = get_project_index()
+    if project_id in project_index.index:
+        return project_index.at[project_id, 'hourly_rate'] * 8, project_index.at[project_id, 'msp_percentage']
     # no project found, means dayrate is 0
     gh.logger(f'No dayrate for project {project_id}, setting dayrate to 0.00.')
     return 0.00, 0.00
@@ -51,10 +57,9 @@ def get_project_dayrate(project_id: int) -> (float, float):
 
 def get_project_fte(project_id: int) -> float:
     """Retrieve current FTE of project"""
-    global_projects = db_supply.global_projects
-    for x in global_projects.index:
-        if global_projects.loc[x, 'id'] == project_id:
-            return global_projects.loc[x, 'percentage']
+    project_index = get_project_index()
+    if project_id in project_index.index:
+        return project_index.at[project_id, 'percentage']
     # no project found, defaulting to 1
     print(f'No percentage defined for project {project_id}, setting FTE to 1.00.')
     return 1.00
@@ -64,31 +69,33 @@ def temporary_project_compose(csvfile: str) -> pd.DataFrame:
     """Get a list of projects from csv file into a dataframe"""
     dtype = {'Offerte': str, 'Eindklant': str, 'Klant': str, 'Bedrag ex. BTW': float, 'Status': str, 'Periode': str,
              '25 procent': float, '50 procent': float, '100 procent': float}
-    csv_project_frame = pd.read_csv(csvfile, dtype=dtype, decimal=',', sep=';')
+    csv_project_frame = gh.csv_read(csvfile, dtype, decimal=',')
     # Convert percentage columns back to integers, handling NA values
-    csv_project_frame['25 procent'] = csv_project_frame['25 procent'].fillna(0).astype(int)
-    csv_project_frame['50 procent'] = csv_project_frame['50 procent'].fillna(0).astype(int)
-    csv_project_frame['100 procent'] = csv_project_frame['100 procent'].fillna(0).astype(int)
+    percentage_columns = ['25 procent', '50 procent', '100 procent']
+    csv_project_frame[percentage_columns] = csv_project_frame[percentage_columns].fillna(0).astype(int)
     # create frome the CSV file a temporary project dataframe with general info columns, total amount and depending on
     # the month indicated in 25, 50 and 100 procent columns a split of the invoice amount over the months
     temporary_project_frame = csv_project_frame[['Offerte', 'Eindklant', 'Bedrag ex. BTW', 'Status']].copy()
 
+    # Distribute the "Bedrag ex. BTW" amount based on the percentages, scattering the parts of all projects at once
+    # into a matrix of projects by months. The 100 procent part is the amount left after the 25 and 50 procent parts.
+    amount = csv_project_frame['Bedrag ex. BTW'].to_numpy()
+    months = csv_project_frame[['25 procent', '50 procent', '100 procent']].to_numpy()
+    valid = (months >= 1) & (months <= 12)
+    parts = np.column_stack([amount * 0.25, amount * 0.50, amount])
+    parts[:, 2] -= parts[:, 0] * valid[:, 0] + parts[:, 1] * valid[:, 1]
+    month_matrix = np.zeros((len(csv_project_frame), 12))
+    rows = np.broadcast_to(np.arange(len(csv_project_frame))[:, np.newaxis], months.shape)
+    np.add.at(month_matrix, (rows[valid], months[valid] - 1), parts[valid])
+
     # Add 12 columns named 1 to 12
-    for month in range(1, 13):
-        temporary_project_frame[str(month)] = 0.0
+    month_columns = pd.DataFrame(month_matrix, columns=[str(month) for month in range(1, 13)],
+                                 index=temporary_project_frame.index)
+    return pd.concat([temporary_project_frame, month_columns], axis=1)
+
 
-    # Distribute the "Bedrag ex. BTW" amount based on the percentages
-    for index, row in csv_project_frame.iterrows():
-        amount = row['Bedrag ex. BTW']
-        if row['25 procent'] in range(1, 13):
-            temporary_project_frame.at[index, str(row['25 procent'])] += amount * 0.25
-        if row['50 procent'] in range(1, 13):
-            temporary_project_frame.at[index, str(row['50 procent'])] += amount * 0.50
-        if row['100 procent'] in range(1, 13):
-            remaining_amount = amount
-            if row['25 procent'] in range(1, 13):
-                remaining_amount -= temporary_project_frame.at[index, str(row['25 procent'])]
-            if row['50 procent'] in range(1, 13):
-                remaining_amount -= temporary_project_frame.at[index, str(row['50 procent'])]
-            temporary_project_frame.at[index, str(row['100 procent'])] += remaining_amount
-    return temporary_project_frame
\ No newline at end of file
+def temporary_project_month_totals(temporary_projects: pd.DataFrame) -> pd.Series:
+    """Return the revenue of all temporary projects per month (index 1 to 12), negative amounts are not counted"""
+    month_totals = temporary_projects[[str(month) for month in range(1, 13)]].clip(lower=0).sum()
+    month_totals.index = range(1, 13)
+    return month_totals
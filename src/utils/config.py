@@ -19,10 +19,31 @@
 
 import configparser
 from datetime import datetime
+from src.utils import data_context
+
+
+class EngineConfigParser(configparser.ConfigParser):
+    """Configuration in which the parameters (section PARAMETERS) can be overridden by the active forecast engine, so
+    scenarios with other parameters are calculated with the same code (see ForecastEngine.scenario)"""
+
+    def get(self, section: str, option: str, **kwargs):
+        engine = data_context.active_engine.get()
+        if section == 'PARAMETERS' and engine is not None and option in engine.parameters:
+            return str(engine.parameters[option])
+        return super().get(section, option, **kwargs)
+
 
 # Define and initialize the global configuration object
-g_config = configparser.ConfigParser(allow_no_value=True, inline_comment_prefixes=";")
+g_config = EngineConfigParser(allow_no_value=True, inline_comment_prefixes=";")
 g_config.read('config.ini')
 
-# Define and initialize the global reference date
-g_ref_date = datetime(g_config.getint('PARAMETERS', 'year'), g_config.getint('PARAMETERS', 'month'), 1)
\ No newline at end of file
+# Define and initialize the reference date of the process
+process_ref_date = datetime(g_config.getint('PARAMETERS', 'year'), g_config.getint('PARAMETERS', 'month'), 1)
+
+
+def __getattr__(name: str):
+    """The global reference date g_ref_date is the one of the active forecast engine, or of the process"""
+    if name == 'g_ref_date':
+        engine = data_context.active_engine.get()
+        return process_ref_date if engine is None else engine.ref_date
+    raise AttributeError(f"module {__name__} has no attribute {name}")
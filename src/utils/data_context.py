@@ -0,0 +1,136 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the data context of the calculations: the global dataframes (db_supply.global_calendar, ...) and
+# the reference date (config.g_ref_date). By default these are the data of the process, set by the loaders in db_supply
+# and by main_functions.data_snapshot_install. While a forecast engine is active (see ForecastEngine.activate) they
+# are the data of that engine instead. The active engine is kept per thread, so threads can calculate with different
+# data or reference dates side by side.
+# The calculations on the global dataframes can be memoised per engine (or for the process) with decorator memoised.
+#
+import collections
+import contextvars
+import functools
+import os
+import threading
+from datetime import datetime
+
+# names of the global dataframes, which are read as attributes of the modules db_supply and calculate_calendar
+DATA_NAMES = ['global_calendar', 'global_multiyear_calendar', 'global_saldi', 'global_projects',
+              'global_freelance_contracts', 'global_hr_values', 'global_workdays']
+
+# maximum number of results memoised for the process, the least recently used results are dropped first
+PROCESS_MEMO_SIZE = 100000
+
+# global dataframes of the process, used when no forecast engine is active, their data version and memoised results.
+# The generation is increased when the memoised results are dropped, so results still being calculated on the previous
+# data are not stored.
+process_data = {}
+process_version = None
+process_memo = collections.OrderedDict()
+process_memo_generation = 0
+
+# lock protecting the memoised results of the process and of the forecast engines
+memo_lock = threading.Lock()
+
+
+def memo_lock_reset():
+    """Replace the memo lock in a forked process, as it may have been held by another thread of the parent"""
+    global memo_lock
+    memo_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=memo_lock_reset)
+
+# forecast engine active in the current thread, None if the data of the process is used
+active_engine = contextvars.ContextVar('active_engine', default=None)
+
+
+def data_get(name: str):
+    """Return a global dataframe of the active forecast engine or of the process, None if it is not loaded"""
+    engine = active_engine.get()
+    return (process_data if engine is None else engine.data).get(name)
+
+
+def data_set(name: str, value):
+    """Set a global dataframe of the active forecast engine, or of the process if no engine is active. Memoised results
+    calculated on the previous data are dropped."""
+    engine = active_engine.get()
+    (process_data if engine is None else engine.data)[name] = value
+    memo_clear(engine)
+
+
+def process_data_install(data: dict, version: str):
+    """Replace the global dataframes of the process by those of the given data version"""
+    global process_version
+    process_data.update(data)
+    process_version = version
+    memo_clear(None)
+
+
+def memo_clear(engine):
+    """Drop the memoised results of a forecast engine, or of the process if engine is None"""
+    global process_memo_generation
+    with memo_lock:
+        if engine is None:
+            process_memo.clear()
+            process_memo_generation += 1
+        else:
+            engine.memo.clear()
+            engine.memo_generation += 1
+
+
+def as_of_get() -> datetime:
+    """Return the as-of date of the calculations: the date up to which the calendar holds actual data, after which
+    absences are forecasted from the saldi. This is the as-of date of the active forecast engine, or else today."""
+    engine = active_engine.get()
+    if engine is None:
+        return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return engine.as_of
+
+
+def memoised(function):
+    """Decorator memoising a calculation on the global dataframes by its arguments, the data version and the as-of
+    date. Results are kept per forecast engine, or for the process if no engine is active, so repeated calls with the
+    same arguments on the same data return the result calculated before. Arguments must be hashable.
+    A result is not stored if the memoised results were dropped while it was calculated, as it may be calculated on
+    the previous data. The results of the process are limited to PROCESS_MEMO_SIZE."""
+    @functools.wraps(function)
+    def wrapper(*args):
+        engine = active_engine.get()
+        as_of = as_of_get()
+        with memo_lock:
+            if engine is None:
+                memo, version, generation = process_memo, process_version, process_memo_generation
+            else:
+                memo, version, generation = engine.memo, engine.version, engine.memo_generation
+            key = (function.__name__, args, version, as_of)
+            if key in memo:
+                if engine is None:
+                    memo.move_to_end(key)
+                return memo[key]
+        result = function(*args)
+        with memo_lock:
+            if generation == (process_memo_generation if engine is None else engine.memo_generation):
+                memo[key] = result
+                while engine is None and len(memo) > PROCESS_MEMO_SIZE:
+                    memo.popitem(last=False)
+        return result
+    return wrapper
+
+
+def module_getattr(module_name: str, name: str):
+    """Resolve attribute access on the global dataframes of a module, used as module level __getattr__"""
+    if name in DATA_NAMES:
+        return data_get(name)
+    raise AttributeError(f"module {module_name} has no attribute {name}")
@@ -18,7 +18,7 @@ import configparser
 import pandas as pd
 from typing import Dict
 from datetime import datetime
-from src.utils import calculate_calendar, officient_api_queries, db_supply, config, gen_helpers as gh
+from src.utils import calculate_calendar, officient_api_queries, db_supply, config, validation, gen_helpers as gh
 
 
 def employee_list_get() -> pd.DataFrame:
@@ -36,7 +36,7 @@ def freelance_list_get(freelancefile: str) -> pd.DataFrame:
     """Get dictionary?? from Excel file with freelancers"""
     # define freelance dataframe from csv file
     dtype = {'Freelancer': str, 'Name': str, 'Id': int}
-    freelance_list = pd.read_csv(freelancefile, dtype=dtype, sep=';')
+    freelance_list = gh.csv_read(freelancefile, dtype)
     # add new column to contract_frame for storing initials
     freelance_list.insert(2, "Role", 'Freelance', True)
     # put columns in right order
@@ -44,12 +44,13 @@ def freelance_list_get(freelancefile: str) -> pd.DataFrame:
     return freelance_list
 
 
-def worker_list_db_exec(workers: pd.DataFrame):
+def worker_list_db_exec(workers: pd.DataFrame, table_name: str = "people_workers"):
     """Helper function inserting a dataframe with workers in the database
     ON DUPLICATE KEY UPDATE ensures that when id already exists the value
-    is updated instead of added to the database"""
-    query = """
-    INSERT INTO people_workers (id, name, role_name)
+    is updated instead of added to the database
+    Optional argument table_name can be set to insert in a staging copy of the table"""
+    query = f"""
+    INSERT INTO {table_name} (id, name, role_name)
     VALUES (%s, %s, %s)
     ON DUPLICATE KEY UPDATE
     name = VALUES(name),
@@ -62,8 +63,9 @@ def worker_list_db_exec(workers: pd.DataFrame):
             conn.commit()
 
 
-def workers_list_compose(freelancefile: str):
-    """Compose a unified list of all employees and freelancers and insert into SQL"""
+def workers_list_compose(freelancefile: str, table_name: str = "people_workers"):
+    """Compose a unified list of all employees and freelancers and insert into SQL
+    Optional argument table_name can be set to load a staging copy of the table"""
     freelance_list = freelance_list_get(freelancefile)
     employee_list = employee_list_get()
     # check required columns exist
@@ -74,10 +76,10 @@ def workers_list_compose(freelancefile: str):
     if missing_values.any():
         raise ValueError('Input dataframe is missing required values: freelance_list')
     # empty table
-    gh.truncate_table("people_workers")
+    gh.truncate_table(table_name)
     # insert into SQL
-    worker_list_db_exec(freelance_list)
-    worker_list_db_exec(employee_list)
+    worker_list_db_exec(freelance_list, table_name)
+    worker_list_db_exec(employee_list, table_name)
 
 
 def employee_calendar_get(employee_id: int, year: int) -> Dict[str, any]:
@@ -85,8 +87,65 @@ def employee_calendar_get(employee_id: int, year: int) -> Dict[str, any]:
     return officient_api_queries.get_json(f"https://api.officient.io/1.0/calendar/{employee_id}/{year}")
 
 
-def employee_calendar_db_exec(employee_id: int, date: str, scheduled_time: int, absence_durations: Dict[str, int]):
-    """Helper function inserting one record in the database
+# absence columns of the calendar_workday table, in the order of the insert query
+CALENDAR_ABSENCE_COLUMNS = ['training_time', 'vacation_time', 'holiday_time', 'adv_time', 'extralegal_vacation_time',
+                            'paid_leave_time_total', 'unpaid_leave_time_total', 'paid_sick_time', 'unpaid_sick_time',
+                            'sick_time_total']
+
+
+def calendar_event_catalog_get(catalogfile: str) -> pd.DataFrame:
+    """Get the catalog mapping Officient event names on absence columns from csv file into a dataframe
+    An event counting towards multiple columns has one line per column, an event with an empty column is known but
+    not counted as absence (e.g. Thuiswerk)"""
+    dtype = {'Event': str, 'Column': str}
+    catalog = gh.csv_read(catalogfile, dtype, keep_default_na=False)
+    unknown_columns = set(catalog['Column']) - set(CALENDAR_ABSENCE_COLUMNS) - {''}
+    if unknown_columns:
+        raise ValueError(f"Unknown absence columns in calendar event catalog: {sorted(unknown_columns)}")
+    return catalog
+
+
+def employee_calendar_transform(calendar_data: Dict[int, Dict[str, any]], catalog: pd.DataFrame) -> pd.DataFrame:
+    """Transform the JSON calendars of a batch of employees, as a dictionary with the employee_id as key, into one
+    dataframe with a row per employee per day, ready to be inserted in the calendar_workday table.
+    Events not in the catalog are reported for the whole batch and not counted."""
+    # flatten days and events of all employees into columnar frames
+    days = pd.DataFrame(
+        [(employee_id, day['date'], day['scheduled_minutes'])
+         for employee_id, calendar in calendar_data.items() for day in calendar['data']['time_off']],
+        columns=['employee_id', 'date', 'scheduled_time'])
+    events = pd.DataFrame(
+        [(employee_id, day['date'], event['name'], event['duration_minutes'])
+         for employee_id, calendar in calendar_data.items() for day in calendar['data']['time_off']
+         for event in day['events']],
+        columns=['employee_id', 'date', 'Event', 'duration_minutes'])
+    company_days_off = pd.DataFrame(
+        [(employee_id, day['date'])
+         for employee_id, calendar in calendar_data.items() for day in calendar['data']['company_days_off']],
+        columns=['employee_id', 'date']).drop_duplicates()
+
+    # map events on absence columns, collecting events which are not in the catalog
+    events = events.merge(catalog, on='Event', how='left', indicator=True)
+    unknown_events = events[events['_merge'] == 'left_only']
+    if not unknown_events.empty:
+        for event_name, employee_ids in unknown_events.groupby('Event')['employee_id'].unique().items():
+            print(f"Unknown event name: {event_name}, not counted for employees {sorted(employee_ids.tolist())}")
+    events = events[(events['_merge'] == 'both') & (events['Column'] != '')]
+
+    # sum durations per employee, day and absence column in one step
+    absence = (events.groupby(['employee_id', 'date', 'Column'])['duration_minutes'].sum()
+               .unstack(fill_value=0)
+               .reindex(columns=CALENDAR_ABSENCE_COLUMNS, fill_value=0))
+    workdays = days.set_index(['employee_id', 'date']).join(absence).fillna(0)
+
+    # add company days off to paid_leave_time if there are scheduled minutes
+    company_day_off = workdays.index.isin(pd.MultiIndex.from_frame(company_days_off))
+    workdays.loc[company_day_off, 'paid_leave_time_total'] += workdays.loc[company_day_off, 'scheduled_time']
+    return workdays[['scheduled_time'] + CALENDAR_ABSENCE_COLUMNS].astype(int).reset_index()
+
+
+def employee_calendar_db_exec(workdays: pd.DataFrame):
+    """Helper function inserting a dataframe with calendar records in the database
     ON DUPLICATE KEY UPDATE ensures that when combination employee_id with date already exists the value
     is updated instead of added to the database
     """
@@ -108,76 +167,19 @@ def employee_calendar_db_exec(employee_id: int, date: str, scheduled_time: int,
     unpaid_sick_time = VALUES(unpaid_sick_time),
     sick_time_total = VALUES(sick_time_total)
     """
+    records = workdays[['employee_id', 'date', 'scheduled_time'] + CALENDAR_ABSENCE_COLUMNS].values.tolist()
     with gh.get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(query, (
-                employee_id, date, scheduled_time,
-                absence_durations.get('training_time', 0),
-                absence_durations.get('vacation_time', 0),
-                absence_durations.get('holiday_time', 0),
-                absence_durations.get('adv_time', 0),
-                absence_durations.get('extralegal_vacation_time', 0),
-                absence_durations.get('paid_leave_time_total', 0),
-                absence_durations.get('unpaid_leave_time_total', 0),
-                absence_durations.get('paid_sick_time', 0),
-                absence_durations.get('unpaid_sick_time', 0),
-                absence_durations.get('sick_time_total', 0)
-            ))
+            cursor.executemany(query, records)
             conn.commit()
 
 
 def employee_calendar_insert(calendar_data: Dict[str, any], employee_id: int):
-    """Append JSON data to SQL database"""
-    # retrieve company holidays
-    company_days_off = {day['date']: day['name'] for day in calendar_data['data']['company_days_off']}
-    # Insert time off data
-    for day in calendar_data['data']['time_off']:
-        date = day['date']
-        scheduled_time = day['scheduled_minutes']
-        absence_durations = {
-            "training_time": 0,
-            "vacation_time": 0,
-            "holiday_time": 0,
-            "adv_time": 0,
-            "extralegal_vacation_time": 0,
-            "paid_leave_time_total": 0,
-            "unpaid_leave_time_total": 0,
-            "paid_sick_time": 0,
-            "unpaid_sick_time": 0,
-            "sick_time_total": 0
-        }
-        for event in day['events']:
-            if event['name'] == "Training Day":
-                absence_durations["training_time"] += event['duration_minutes']
-            elif event['name'] in ("Vakantie", "Inhaalrust", "Vervangingsfeestdag", "Conventionele vakantiedagen",
-                                   "klein verlet"):
-                absence_durations["paid_leave_time_total"] += event['duration_minutes']
-                # for those absence types which have a saldi, add them to separate counters
-                if event['name'] == "Vakantie":
-                    absence_durations["vacation_time"] += event['duration_minutes']
-                if event['name'] == "Inhaalrust":
-                    absence_durations["adv_time"] += event['duration_minutes']
-                if event['name'] == "Vervangingsfeestdag":
-                    absence_durations["holiday_time"] += event['duration_minutes']
-                if event['name'] == "Conventionele vakantiedagen":
-                    absence_durations["extralegal_vacation_time"] += event['duration_minutes']
-            elif event['name'] in ("Verlof zonder wedde", "Jeugdvakantie", "Ouderschapsverlof", "Ouderschapsverlof-5",
-                                   "Dringende familiale reden", "Dwingende familiale reden", "Geboorteverlof",
-                                   "Aanvullende Vakantie (Eu) - Bedienden - Betaald"):
-                absence_durations["unpaid_leave_time_total"] += event['duration_minutes']
-            elif event['name'] == "Sick day":
-                absence_durations["paid_sick_time"] += event['duration_minutes']
-                absence_durations["sick_time_total"] += event['duration_minutes']
-            elif event['name'] in ("Thuiswerk", "Vrijwillige overuren zonder recup", "Recuperatie overuren",
-                                   "Overuren zonder recuperatie", "Netto Relance-overuren zonder recuperatie"):
-                pass
-            else:
-                raise ValueError(f"Unknown event name: {event['name']}")
-        # Add company days off to paid_leave_time if there are scheduled minutes
-        if day['date'] in company_days_off and day['scheduled_minutes'] > 0:
-            absence_durations['paid_leave_time_total'] += day['scheduled_minutes']
-        # Use helper function to insert into database
-        employee_calendar_db_exec(employee_id, date, scheduled_time, absence_durations)
+    """Append JSON data of one employee to SQL database"""
+    catalog = calendar_event_catalog_get(config.g_config.get('FILES', 'calendar_events'))
+    workdays = employee_calendar_transform({employee_id: calendar_data}, catalog)
+    employee_calendar_validate(workdays)
+    employee_calendar_db_exec(workdays)
 
 
 def employee_calendar_delete(employee_id: int, year: int):
@@ -192,17 +194,53 @@ def employee_calendar_delete(employee_id: int, year: int):
             conn.commit()
 
 
-def employee_calendar_compose(year: int):
-    """Compose the full calendar of all listed non-freelance employees for the current year in SQL"""
-    worker_list = db_supply.worker_list_get('intern')
-    for i in worker_list.index.tolist():
-        calendar = employee_calendar_get(i, year)
-        employee_calendar_insert(calendar, i)
-
-
-def employee_saldi_get(employee_id: int, year: int) -> Dict:
-    """Get JSON object from Officient API with all saldi and get year saldi, then correct by saldi already taken from
-    SQL database. All times are expressed in minutes!"""
+def employee_calendar_fetch(year: int, employee_ids: list, months: tuple = None) -> pd.DataFrame:
+    """Retrieve the calendars of the given employees and transform them into one dataframe ready to be inserted in SQL
+    Optional argument months can be set to a tuple (first month, last month) to only keep the days in these months"""
+    catalog = calendar_event_catalog_get(config.g_config.get('FILES', 'calendar_events'))
+    calendar_data = {i: employee_calendar_get(i, year) for i in employee_ids}
+    workdays = employee_calendar_transform(calendar_data, catalog)
+    if months is not None:
+        month = pd.to_datetime(workdays['date']).dt.month
+        workdays = workdays[(month >= months[0]) & (month <= months[1])]
+    employee_calendar_validate(workdays)
+    return workdays
+
+
+def employee_calendar_validate(workdays: pd.DataFrame):
+    """Check all calendar rows against the calendar sanity rules at once, raising an error reporting all violations if
+    any of the rules is violated"""
+    calendar = workdays[['employee_id', 'date', 'scheduled_time']].copy()
+    calendar['leave_time'] = (workdays[['paid_leave_time_total', 'unpaid_leave_time_total', 'sick_time_total']]
+                              .sum(axis=1))
+    calendar['unscheduled_leave'] = calendar['leave_time'] - calendar['scheduled_time']
+    validation.validation_check(calendar, validation.CALENDAR_RULES, ['employee_id', 'date'], 'calendar')
+
+
+def employee_calendar_compose(year: int, employee_ids: list = None, months: tuple = None):
+    """Compose the full calendar of all listed non-freelance employees for the current year in SQL
+    Optional argument employee_ids can be set to only compose the calendar of these employees, optional argument months
+    can be set to a tuple (first month, last month) to only update the days in these months"""
+    if employee_ids is None:
+        employee_ids = db_supply.worker_list_get('intern').index.tolist()
+    # retrieve the calendars of all employees, then transform and insert them as one batch
+    employee_calendar_db_exec(employee_calendar_fetch(year, employee_ids, months))
+
+
+# mapping of the saldi columns in SQL on the Officient limit name and the calendar column holding the used time
+SALDI_COMPONENTS = {
+    'training': ('Training', 'training_time'),
+    'vacation': ('Vakantie', 'vacation_time'),
+    'holiday': ('Vervangingsfeestdag', 'holiday_time'),
+    'adv': ('Inhaalrust', 'adv_time'),
+    'extralegal_vacation': ('Conventionele vakantiedagen', 'extralegal_vacation_time'),
+    'sickness': ('Ziekte', 'sick_time_total'),
+}
+
+
+def employee_saldi_limits_get(employee_id: int, year: int) -> Dict[str, int]:
+    """Get JSON object from Officient API with all saldi and return the year limits per absence type, including the
+    configured historical averages for sickness and training. All times are expressed in minutes!"""
     # retrieve year limits of employee for year from Officient API
     year_limit_data = officient_api_queries.get_json(f"https://api.officient.io/1.0/calendar/{employee_id}"
                                                      f"/events/types/{year}/limits")
@@ -218,32 +256,48 @@ def employee_saldi_get(employee_id: int, year: int) -> Dict:
     # for sickness and training days, retrieve from config the historical average values
     year_limits['Ziekte'] = config.g_config.getint('PARAMETERS', 'yearly_sick_days') * 8 * 60
     year_limits['Training'] = config.g_config.getint('PARAMETERS', 'yearly_training_days') * 8 * 60
-    # get employee calendar for this year from SQL
-    calendar = db_supply.employee_calendar_get(employee_id, year)
-    # calculate remaining saldi of the year by substracting from year limits the days already used (as in calendar)
-    saldi = {}
-    saldi['employee_id'] = employee_id
-    saldi['training'] = int(max(0, year_limits['Training'] - calendar['training_time'].sum()))
-    saldi['vacation'] = int(year_limits['Vakantie'] - calendar['vacation_time'].sum())
-    saldi['holiday'] = int(year_limits['Vervangingsfeestdag'] - calendar['holiday_time'].sum())
-    saldi['adv'] = int(year_limits['Inhaalrust'] - calendar['adv_time'].sum())
-    saldi['extralegal_vacation'] = int(year_limits['Conventionele vakantiedagen'] -
-                                       calendar['extralegal_vacation_time'].sum())
-    saldi['sickness'] = int(max(0, year_limits['Ziekte'] - calendar['sick_time_total'].sum()))
-    for absence_saldi in saldi:
-        if saldi[absence_saldi] < 0:
-            saldi[absence_saldi] = 0
-            print(f'Calculated remaining saldi for employee {employee_id} of type {absence_saldi} is below'
-                             f'zero. Setting to zero.')
-    return saldi
-
-
-def employee_saldi_db_exec(saldi_dict: Dict):
-    """Helper function inserting a dataframe with absence saldi in the database
+    return year_limits
+
+
+def employee_saldi_calculate(year_limits: pd.DataFrame, calendar: pd.DataFrame) -> pd.DataFrame:
+    """Calculate the remaining saldi of all employees at once, by substracting from the year limits (one row per
+    employee_id, one column per Officient limit name) the time already used in the calendar of that year.
+    All times are expressed in minutes!"""
+    limit_names = [limit for limit, used in SALDI_COMPONENTS.values()]
+    used_columns = [used for limit, used in SALDI_COMPONENTS.values()]
+    missing_limits = year_limits.reindex(columns=limit_names).isnull().any(axis=1)
+    if missing_limits.any():
+        raise ValueError(f"Year limits missing for employees {missing_limits[missing_limits].index.tolist()}")
+    # aggregate used time per employee in one pass, employees without calendar records have used nothing yet
+    used_time = (calendar.groupby(level='employee_id')[used_columns].sum()
+                 .reindex(year_limits.index, fill_value=0))
+    saldi = pd.DataFrame(year_limits[limit_names].to_numpy() - used_time[used_columns].to_numpy(),
+                         index=year_limits.index, columns=list(SALDI_COMPONENTS.keys()))
+    saldi.index.name = 'employee_id'
+    # training and sickness are historical averages, so using more than the average is expected and not reported
+    for absence_saldi in ['vacation', 'holiday', 'adv', 'extralegal_vacation']:
+        for employee_id in saldi.index[saldi[absence_saldi] < 0]:
+            print(f'Calculated remaining saldi for employee {employee_id} of type {absence_saldi} is below '
+                  f'zero. Setting to zero.')
+    return saldi.clip(lower=0).astype(int)
+
+
+def employee_saldi_yearly(saldi: pd.DataFrame, calendar: pd.DataFrame) -> pd.DataFrame:
+    """Return the saldi of a whole year of all employees, being their remaining saldi plus the time already used in the
+    calendar of the year of the saldi, i.e. the year limits of employee_saldi_calculate. These are the saldi of the
+    forecast of a later year, in which the leave of the whole year is still to be taken.
+    All times are expressed in minutes!"""
+    used_columns = [used for limit, used in SALDI_COMPONENTS.values()]
+    used_time = calendar.groupby(level='employee_id')[used_columns].sum().reindex(saldi.index, fill_value=0)
+    yearly_saldi = saldi.copy()
+    yearly_saldi[list(SALDI_COMPONENTS)] = saldi[list(SALDI_COMPONENTS)].to_numpy() + used_time.to_numpy()
+    return yearly_saldi
+
+
+def employee_saldi_db_exec(saldi: pd.DataFrame):
+    """Helper function inserting a dataframe with absence saldi, indexed by employee_id, in the database
     ON DUPLICATE KEY UPDATE ensures that when id already exists the value
     is updated instead of added to the database"""
-    record_tuple = (saldi_dict['employee_id'], saldi_dict['training'], saldi_dict['vacation'], saldi_dict['holiday'],
-                    saldi_dict['adv'], saldi_dict['extralegal_vacation'], saldi_dict['sickness'])
     query = """
     INSERT INTO calendar_saldi (employee_id, training, vacation, holiday, adv, extralegal_vacation, sickness)
     VALUES (%s, %s, %s, %s, %s, %s, %s)
@@ -255,20 +309,27 @@ def employee_saldi_db_exec(saldi_dict: Dict):
     extralegal_vacation = VALUES(extralegal_vacation),
     sickness = VALUES(sickness)
     """
+    records = saldi.reset_index()[['employee_id', 'training', 'vacation', 'holiday', 'adv', 'extralegal_vacation',
+                                   'sickness']].values.tolist()
     with gh.get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(query, record_tuple)
+            cursor.executemany(query, records)
             conn.commit()
 
 
-def employee_saldi_compose(year: int):
-    """Compose a unified list of all employee absence saldi"""
-    # loop over employees
-    worker_list = db_supply.worker_list_get('intern')
-    for i in worker_list.index.tolist():
-        saldi_line = employee_saldi_get(i, year)
-        # insert into SQL
-        employee_saldi_db_exec(saldi_line)
+def employee_saldi_compose(year: int, employee_ids: list = None):
+    """Compose a unified list of all employee absence saldi
+    Optional argument employee_ids can be set to only compose the saldi of these employees"""
+    if employee_ids is None:
+        employee_ids = db_supply.worker_list_get('intern').index.tolist()
+    # retrieve year limits of all employees from Officient API
+    year_limits = pd.DataFrame.from_dict(
+        {i: employee_saldi_limits_get(i, year) for i in employee_ids}, orient='index')
+    # load the calendar of all employees for the year with one query, the used time is aggregated on this frame
+    db_supply.calendar_get(year)
+    saldi = employee_saldi_calculate(year_limits, db_supply.global_calendar)
+    # insert into SQL in one batch
+    employee_saldi_db_exec(saldi)
 
 
 def employee_contract_get(employee_id: int) -> Dict[str, any]:
@@ -276,45 +337,88 @@ def employee_contract_get(employee_id: int) -> Dict[str, any]:
     return officient_api_queries.get_json(f"https://api.officient.io/1.0/wages/{employee_id}/history")
 
 
+# Officient budget payloads per (employee_id, year), filled on first request and cleared on every contract refresh
+budget_cache = {}
+
+
 def employee_budget_get(employee_id: int, year: int) -> Dict[str, any]:
-    """Get JSON object from Officient API with all budgets of an employee"""
-    return officient_api_queries.get_json(f"https://api.officient.io/1.0/budgets/people/{employee_id}/{year}/list")
+    """Get JSON object from Officient API with all budgets of an employee, each employee and year is only fetched once
+    until the cache is cleared"""
+    if (employee_id, year) not in budget_cache:
+        budget_cache[(employee_id, year)] = officient_api_queries.get_json(
+            f"https://api.officient.io/1.0/budgets/people/{employee_id}/{year}/list")
+    return budget_cache[(employee_id, year)]
+
 
+def employee_mobility_budget_exists(employee_id: int, year: int) -> bool:
+    """Return True if the employee has a LEGAL budget (= mobiliteitsbudget) in the given year"""
+    return any(budget['budget_type'] == 'LEGAL' for budget in employee_budget_get(employee_id, year)['data'])
 
-def employee_mobility_cost(employee_id: int, start_date: datetime, contract: list)\
+
+def employee_contract_end_date(contract: Dict[str, any]) -> str:
+    """Return the end date of a contract, if end date is empty it is set to a very high value"""
+    return contract['end_date'] if contract['end_date'] != '' else "2100-12-31"
+
+
+def employee_contracts_active(contract_data: Dict[str, any]) -> list:
+    """Return the contracts of an employee which did not end before today"""
+    return [contract for contract in contract_data['data']
+            if datetime.strptime(employee_contract_end_date(contract), "%Y-%m-%d") >= datetime.now()]
+
+
+def employee_mobility_fte_ratios_get(contract_data: Dict[int, Dict[str, any]]) -> pd.DataFrame:
+    """Precompute in one batch the fte ratios needed for the mobility budget of all active contracts, with contract
+    data given as a dictionary with the employee_id as key. Only contracts without car and with a mobility budget need
+    a ratio, see function employee_mobility_cost for the period used."""
+    periods = []
+    for employee_id, employee_contract_data in contract_data.items():
+        for contract in employee_contracts_active(employee_contract_data):
+            if contract['estimated_monthly_cost']['base_components']['car'] != 0:
+                continue
+            start_date = datetime.strptime(contract['start_date'], "%Y-%m-%d")
+            if employee_mobility_budget_exists(employee_id, start_date.year):
+                periods.append((employee_id, start_date, datetime(start_date.year, 12, 31)))
+    periods = pd.DataFrame(periods, columns=['employee_id', 'start_date', 'end_date'])
+    return calculate_calendar.get_fte_ratios_batch(periods, True)
+
+
+def employee_mobility_cost(employee_id: int, start_date: datetime, contract: list, fte_ratios: pd.DataFrame = None)\
         -> tuple:
-    """Calculate the actual monthly mobility cost"""
+    """Calculate the actual monthly mobility cost
+    Optional argument fte_ratios can be set to the precomputed ratios of function employee_mobility_fte_ratios_get,
+    otherwise the ratio is calculated from the calendar"""
     # if contract stipulates a car, just return the monthly car cost as in the contract
     if contract['estimated_monthly_cost']['base_components']['car'] != 0:
         return "car", contract['estimated_monthly_cost']['base_components']['car']
+    # if no car, then see if there is a LEGAL budget (= mobiliteitsbudget)
+    elif employee_mobility_budget_exists(employee_id, start_date.year):
+        # take into account real fte to factor in part-time work, start_date is date the contract starts (to
+        # avoid doing the calculations over periods before the contract starts) and end_date is the 31st of
+        # december in the same year as start_date
+        end_date = datetime(start_date.year, 12, 31)
+        if fte_ratios is None:
+            company_paid_ratio, vacation_time_ratio = calculate_calendar.get_fte_ratios(employee_id, start_date,
+                                                                                        end_date, True)
+        else:
+            company_paid_ratio = fte_ratios.loc[(employee_id, start_date, end_date), 'company_paid_ratio']
+        # if there is a budget, then calculate monthly cost based on 20% year salary and contract fte
+        return "budget", 13 * contract['rate'] * 0.2 * company_paid_ratio / 12
+    # if no car and no budget, return fixed allowance
     else:
-        # if no car, then see if there is a LEGAL budget (= mobiliteitsbudget)
-        budget_data = employee_budget_get(employee_id, start_date.year)
-        for budget in budget_data['data']:
-            if budget['budget_type'] == 'LEGAL':
-                # take into account real fte to factor in part-time work, start_date is date the contract starts (to
-                # avoid doing the calculations over periods before the contract starts) and end_date is the 31st of
-                # december in the same year as start_date
-                end_date = datetime(start_date.year, 12, 31)
-                company_paid_ratio, vacation_time_ratio = calculate_calendar.get_fte_ratios(employee_id, start_date,
-                                                                                            end_date,
-                                                                                            True)
-                # if there is a budget, then calculate monthly cost based on 20% year salary and contract fte
-                return "budget", 13 * contract['rate'] * 0.2 * company_paid_ratio / 12
-        # if no car and no budget, return fixed allowance
         return "allowance", 80
 
 
 def employee_contract_db_exec(contract_id: int, employee_id: int, function_category: str, start_date: str,
                               end_date: str, monthly_salary: float, mobility_type: str, monthly_mobility: float,
-                              fte: float):
+                              fte: float, table_name: str = "people_employee_contracts"):
     """Helper function inserting one record (one contract) in the database
     ON DUPLICATE KEY UPDATE ensures that when contract_id exists the value
     is updated instead of added to the database
+    Optional argument table_name can be set to insert in a staging copy of the table
     """
     # SQL query to insert contracts
-    query = """
-    INSERT INTO people_employee_contracts (id, employee_id, function_category, start_date, end_date, monthly_salary,
+    query = f"""
+    INSERT INTO {table_name} (id, employee_id, function_category, start_date, end_date, monthly_salary,
     mobility_type, monthly_mobility, fte)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
     ON DUPLICATE KEY UPDATE
@@ -338,56 +442,95 @@ def employee_contract_db_exec(contract_id: int, employee_id: int, function_categ
             conn.commit()
 
 
-def employee_contract_insert(contract_data: Dict[str, any], employee_id: int):
-    """"This function inserts the contract list of an employee into SQL
-    All costs of the contract are expressed on a monthly basis, based on the contractual fte (i.e. not taking
-    into account parental leave or parental part-time work)
-    """
-    # loop over contracts and insert them into the database
-    for contract in contract_data['data']:
-        end_date = contract['end_date']
-        # if end date is empty, set it to a very high value
-        if end_date == '':
-            end_date = "2100-12-31"
-        end_datetime = datetime.strptime(end_date, "%Y-%m-%d")
-        # skip contracts which ended before today
-        if end_datetime < datetime.now():
-            continue
+# columns of the employee contracts in SQL, in the order of function employee_contract_db_exec
+CONTRACT_COLUMNS = ['id', 'employee_id', 'function_category', 'start_date', 'end_date', 'monthly_salary',
+                    'mobility_type', 'monthly_mobility', 'fte']
+
+
+def employee_contract_rows(contract_data: Dict[str, any], employee_id: int, fte_ratios: pd.DataFrame = None) -> list:
+    """Return the contracts of an employee which did not end before today as rows to insert into SQL, in the order of
+    CONTRACT_COLUMNS. All costs of the contract are expressed on a monthly basis, based on the contractual fte (i.e. not
+    taking into account parental leave or parental part-time work)
+    Optional argument fte_ratios can be set to the precomputed ratios for the mobility budget"""
+    rows = []
+    for contract in employee_contracts_active(contract_data):
+        end_date = employee_contract_end_date(contract)
         # get rest of the data
         start_date = contract['start_date']
         start_datetime = datetime.strptime(start_date, "%Y-%m-%d")
         fte = contract['custom_payroll_data']['avg_working_hours_per_week'] / 40
         # get mobility type and monthly amount
-        mobility = employee_mobility_cost(employee_id, start_datetime, contract)
-        # do some sanity checks before proceeding
-        if mobility[1] < 1:
-            raise ValueError(f"Mobility cost missing for {employee_id}")
-        if mobility[1] > 2000:
-            print(f"Mobility cost suspiciously of {mobility[1]} high for {employee_id}")
-        if contract['rate'] < 1:
-            raise ValueError(f"Monthly salary missing for {employee_id}")
-        if contract['rate'] > 10000:
-            raise ValueError(f"Monthly salary of {contract['rate']} impossibly high for employee {employee_id}")
-        if not 0 <= fte <= 1:
-            raise ValueError(f"Impossible FTE value of {fte} for {employee_id}")
-        if not 1 <= contract['id'] <= 9999999999:
-            raise ValueError(f"Impossible contract id value of {contract['id']} for {employee_id}")
-
-        # Use helper function to insert into database
-        employee_contract_db_exec(
-            contract['id'], employee_id, contract['custom_payroll_data']['professional_details']['function'],
-            start_date, end_date, contract['rate'], mobility[0], mobility[1], fte)
-
-
-def employee_contract_compose():
-    """Compose a unified list of all employee contracts and insert into SQL"""
-    # first empty table
-    gh.truncate_table("people_employee_contracts")
-    # then create and loop over worker list
-    worker_list = db_supply.worker_list_get('intern')
-    for employee_id in worker_list.index.tolist():
-        contract_data = employee_contract_get(employee_id)
-        employee_contract_insert(contract_data, employee_id)
+        mobility = employee_mobility_cost(employee_id, start_datetime, contract, fte_ratios)
+        rows.append([contract['id'], employee_id, contract['custom_payroll_data']['professional_details']['function'],
+                     start_date, end_date, contract['rate'], mobility[0], mobility[1], fte])
+    return rows
+
+
+def employee_contracts_validate(contract_rows: list) -> pd.DataFrame:
+    """Check all contract rows against the contract sanity rules at once, raising an error reporting all violations
+    if any of the rules is violated. The contracts are returned as a dataframe."""
+    contracts = pd.DataFrame(contract_rows, columns=CONTRACT_COLUMNS)
+    validation.validation_check(contracts, validation.CONTRACT_RULES, ['employee_id', 'id'], 'contract')
+    return contracts
+
+
+def employee_contracts_db_exec(contracts: pd.DataFrame, table_name: str = "people_employee_contracts"):
+    """Insert a dataframe with validated contracts in the database, see employee_contract_db_exec"""
+    for record in contracts.values.tolist():
+        employee_contract_db_exec(*record, table_name)
+
+
+def employee_contract_insert(contract_data: Dict[str, any], employee_id: int, fte_ratios: pd.DataFrame = None,
+                             table_name: str = "people_employee_contracts"):
+    """"This function inserts the contract list of an employee into SQL, after checking them, see
+    employee_contract_rows
+    Optional argument fte_ratios can be set to the precomputed ratios for the mobility budget, optional argument
+    table_name can be set to insert in a staging copy of the table
+    """
+    contracts = employee_contracts_validate(employee_contract_rows(contract_data, employee_id, fte_ratios))
+    employee_contracts_db_exec(contracts, table_name)
+
+
+def employee_contract_delete(employee_id: int, table_name: str = "people_employee_contracts"):
+    """Remove all contracts of given employee from the table"""
+    query = f"""
+    DELETE FROM {table_name}
+    WHERE employee_id = %s
+    """
+    with gh.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, (employee_id,))
+            conn.commit()
+
+
+def employee_contract_compose(table_name: str = "people_employee_contracts", employee_ids: list = None,
+                              contract_data: Dict[int, Dict[str, any]] = None):
+    """Compose a unified list of all employee contracts and insert into SQL
+    Optional argument table_name can be set to load a staging copy of the table, optional argument employee_ids can be
+    set to only replace the contracts of these employees. Optional argument contract_data can be set to contracts
+    already retrieved from Officient, as a dictionary with the employee_id as key."""
+    # budgets are fetched again for every refresh, but only once per employee and year within the refresh
+    budget_cache.clear()
+    # retrieve contracts of all employees, unless already given
+    if contract_data is None:
+        if employee_ids is None:
+            contract_ids = db_supply.worker_list_get('intern').index.tolist()
+        else:
+            contract_ids = employee_ids
+        contract_data = {employee_id: employee_contract_get(employee_id) for employee_id in contract_ids}
+    # precompute the fte ratios needed for the mobility budgets of all contracts in one batch, then check all
+    # contracts at once before anything is changed
+    fte_ratios = employee_mobility_fte_ratios_get(contract_data)
+    contracts = employee_contracts_validate(
+        [row for employee_id, employee_contract_data in contract_data.items()
+         for row in employee_contract_rows(employee_contract_data, employee_id, fte_ratios)])
+    # then empty table, or only remove the contracts of the given employees
+    if employee_ids is None:
+        gh.truncate_table(table_name)
+    else:
+        for employee_id in employee_ids:
+            employee_contract_delete(employee_id, table_name)
+    employee_contracts_db_exec(contracts, table_name)
 
 
 def project_get(csvfile: str) -> pd.DataFrame:
@@ -395,28 +538,43 @@ def project_get(csvfile: str) -> pd.DataFrame:
     dtype = {'Consultant': str, 'Consultant id': int, 'Categorie': str, 'Klant': str, 'MSP Fee': float,
              'Startdatum': str, 'Einddatum': str, 'Percentage': float, 'Uurtarief': float, 'Dagtarief': float,
              'Freelance uurtarief': float, 'Freelance dagtarief': float}
-    project_frame = pd.read_csv(csvfile, dtype=dtype, decimal=',', sep=';')
+    # read csv file, checking all columns exist
+    project_frame = gh.csv_read(csvfile, dtype, decimal=',')
     project_frame.fillna({
         'Einddatum': '2100/12/31',
         'Freelance uurtarief': 0,
         'Freelance dagtarief': 0
     }, inplace=True)
-    project_frame['Uurtarief'] = project_frame['Uurtarief'].apply(lambda x: round(x, 2))
-    project_frame['Freelance uurtarief'] = project_frame['Freelance uurtarief'].apply(lambda x: round(x, 2))
-    # check all columns exist in contract_frame
-    col_list = list(dtype.keys())
-    gh.check_col_exists(project_frame, col_list)
+    project_frame[['Uurtarief', 'Freelance uurtarief']] = project_frame[['Uurtarief', 'Freelance uurtarief']].round(2)
     return project_frame
 
 
-def project_db_exec(projects: pd.DataFrame):
+def projects_validate(projects_freelancers: pd.DataFrame):
+    """Check all projects against the project sanity rules at once, raising an error reporting all violations if any
+    of the rules is violated"""
+    projects = projects_freelancers.copy()
+    projects['start_date'] = pd.to_datetime(projects['Startdatum'], errors='coerce', format='mixed')
+    end_date = pd.to_datetime(projects['Einddatum'], errors='coerce', format='mixed')
+    projects['duration_days'] = (end_date - projects['start_date']).dt.days
+    validation.validation_check(projects, validation.PROJECT_RULES, ['Consultant id', 'Klant'], 'project')
+    # a freelancer has one contract, so all project lines of a freelancer must have the same freelance hourly rate
+    freelancers = projects[projects['Categorie'].str.contains("Freelance")]
+    rate_count = freelancers.groupby('Consultant id')['Freelance uurtarief'].nunique()
+    conflicting = rate_count[rate_count > 1].index.tolist()
+    if conflicting:
+        raise ValueError(f"Validation of project failed: different freelance hourly rates for freelancers "
+                         f"{conflicting}")
+
+
+def project_db_exec(projects: pd.DataFrame, table_name: str = "projects"):
     """Helper function inserting a dataframe with projects in the database
     ON DUPLICATE KEY UPDATE ensures that when id already exists the value
-    is updated instead of added to the database"""
+    is updated instead of added to the database
+    Optional argument table_name can be set to insert in a staging copy of the table"""
 
     # SQL query to insert new records into the table
-    query = """
-    INSERT INTO projects (client, msp_percentage, start_date, end_date, percentage, hourly_rate, employee_id)
+    query = f"""
+    INSERT INTO {table_name} (client, msp_percentage, start_date, end_date, percentage, hourly_rate, employee_id)
     VALUES (%s, %s, %s, %s, %s, %s, %s)
     ON DUPLICATE KEY UPDATE
     client = VALUES(client),
@@ -435,7 +593,7 @@ def project_db_exec(projects: pd.DataFrame):
             conn.commit()
 
 
-def project_insert(projects_freelancers: pd.DataFrame):
+def project_insert(projects_freelancers: pd.DataFrame, table_name: str = "projects"):
     # compose dataframe with correct columns and order
     projects = projects_freelancers[['Klant', 'MSP Fee', 'Startdatum', 'Einddatum', 'Percentage', 'Uurtarief',
                                      'Consultant id']]
@@ -453,15 +611,16 @@ def project_insert(projects_freelancers: pd.DataFrame):
     gh.check_col_exists(projects_renamed, ['client', 'msp_percentage', 'start_date', 'end_date', 'percentage',
                                            'hourly_rate', 'employee_id'])
     # insert into SQL
-    project_db_exec(projects_renamed)
+    project_db_exec(projects_renamed, table_name)
 
 
-def freelance_contract_db_exec(freelancers: pd.DataFrame):
+def freelance_contract_db_exec(freelancers: pd.DataFrame, table_name: str = "people_freelance_contracts"):
     """Helper function inserting a dataframe with freelancers in the database
     ON DUPLICATE KEY UPDATE ensures that when id already exists the value
-    is updated instead of added to the database"""
-    query = """
-    INSERT INTO people_freelance_contracts (employee_id, hourly_rate)
+    is updated instead of added to the database
+    Optional argument table_name can be set to insert in a staging copy of the table"""
+    query = f"""
+    INSERT INTO {table_name} (employee_id, hourly_rate)
     VALUES (%s, %s)
     ON DUPLICATE KEY UPDATE
     employee_id = VALUES(employee_id),
@@ -474,11 +633,12 @@ def freelance_contract_db_exec(freelancers: pd.DataFrame):
             conn.commit()
 
 
-def freelance_contract_insert(projects_freelancers: pd.DataFrame):
+def freelance_contract_insert(projects_freelancers: pd.DataFrame, table_name: str = "people_freelance_contracts"):
     """"This function inserts the list of freelance contracts into SQL"""
     # compose dataframe with correct columns and order
     freelancers_filtered = projects_freelancers[projects_freelancers["Categorie"].str.contains("Freelance")]
-    freelancers = freelancers_filtered[['Consultant id', 'Freelance uurtarief']]
+    # one contract per freelancer, also when the freelancer has several project lines
+    freelancers = freelancers_filtered[['Consultant id', 'Freelance uurtarief']].drop_duplicates('Consultant id')
 
     # rename columns
     freelancers_renamed = freelancers.rename(columns={
@@ -488,15 +648,18 @@ def freelance_contract_insert(projects_freelancers: pd.DataFrame):
     # check required columns exist
     gh.check_col_exists(freelancers_renamed, ['employee_id', 'hourly_rate'])
     # insert into SQL
-    freelance_contract_db_exec(freelancers_renamed)
+    freelance_contract_db_exec(freelancers_renamed, table_name)
 
 
-def project_list_compose(projects_csv: str):
-    """Compose a list of freelance contracts and a list of projects into SQL."""
-    # first empty projects and freelance contracts table
-    gh.truncate_table("projects")
-    gh.truncate_table("people_freelance_contracts")
-    # then get the data and insert into SQL
+def project_list_compose(projects_csv: str, projects_table: str = "projects",
+                         freelance_contracts_table: str = "people_freelance_contracts"):
+    """Compose a list of freelance contracts and a list of projects into SQL.
+    Optional arguments projects_table and freelance_contracts_table can be set to load staging copies of the tables"""
+    # first get and check the data
     projects_freelancers = project_get(projects_csv)
-    project_insert(projects_freelancers)
-    freelance_contract_insert(projects_freelancers)
+    projects_validate(projects_freelancers)
+    # then empty projects and freelance contracts table and insert into SQL
+    gh.truncate_table(projects_table)
+    gh.truncate_table(freelance_contracts_table)
+    project_insert(projects_freelancers, projects_table)
+    freelance_contract_insert(projects_freelancers, freelance_contracts_table)
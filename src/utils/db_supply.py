@@ -18,7 +18,12 @@ import configparser
 
 import pandas as pd
 from datetime import datetime
-from src.utils import config, gen_helpers as gh
+from src.utils import config, data_context, gen_helpers as gh
+
+
+def __getattr__(name: str):
+    """The global dataframes (global_calendar, ...) are those of the active forecast engine, or of the process"""
+    return data_context.module_getattr(__name__, name)
 
 
 def worker_list_get(scope: str = "all", ref_date: datetime = False) -> pd.DataFrame:
@@ -101,7 +106,6 @@ def employee_calendar_get(employee_id: int, year: int) -> pd.DataFrame:
 
 def calendar_get(year: int):
     """Get dataframe with calendar for year of all employees"""
-    global global_calendar
     query = f"""
     SELECT * FROM calendar_workday WHERE YEAR(date) = {year};
     """
@@ -110,14 +114,26 @@ def calendar_get(year: int):
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
-            global_calendar = pd.DataFrame(rows, columns=columns)
-    global_calendar['date'] = pd.to_datetime(global_calendar['date'])
-    global_calendar.set_index(['employee_id', 'date'], inplace=True)
+            df = pd.DataFrame(rows, columns=columns)
+    df['date'] = pd.to_datetime(df['date'])
+    df.set_index(['employee_id', 'date'], inplace=True)
+    data_context.data_set('global_calendar', df)
+
+
+def calendar_years_get() -> list:
+    """Get list of all years of which the calendar is in SQL"""
+    query = f"""
+    SELECT DISTINCT YEAR(date) FROM calendar_workday ORDER BY 1;
+    """
+    with gh.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            rows = cursor.fetchall()
+    return [row[0] for row in rows]
 
 
 def calendar_multiyear_get(start_year: int, end_year: int):
     """Get dataframe with calendar for multiple years"""
-    global global_multiyear_calendar
     query = f"""
     SELECT * FROM calendar_workday WHERE YEAR(date) >= {start_year} AND YEAR(date) <= {end_year};
     """
@@ -126,14 +142,14 @@ def calendar_multiyear_get(start_year: int, end_year: int):
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
-            global_multiyear_calendar = pd.DataFrame(rows, columns=columns)
-    global_multiyear_calendar['date'] = pd.to_datetime(global_multiyear_calendar['date'])
-    global_multiyear_calendar.set_index(['employee_id', 'date'], inplace=True)
+            df = pd.DataFrame(rows, columns=columns)
+    df['date'] = pd.to_datetime(df['date'])
+    df.set_index(['employee_id', 'date'], inplace=True)
+    data_context.data_set('global_multiyear_calendar', df)
 
 
 def saldi_get():
     """Get dataframe with saldi for year of all employees"""
-    global global_saldi
     query = f"""
     SELECT * FROM calendar_saldi;
     """
@@ -142,13 +158,13 @@ def saldi_get():
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
-            global_saldi = pd.DataFrame(rows, columns=columns)
-    global_saldi.set_index('employee_id', inplace=True)
+            df = pd.DataFrame(rows, columns=columns)
+    df.set_index('employee_id', inplace=True)
+    data_context.data_set('global_saldi', df)
 
 
 def projects_get():
     """Get DataFrame with all projects"""
-    global global_projects
     query = f"""
     SELECT * FROM projects
     """
@@ -157,14 +173,14 @@ def projects_get():
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
-            global_projects = pd.DataFrame(rows, columns=columns)
-            global_projects['end_date'] = pd.to_datetime(global_projects['end_date'])
-            global_projects['start_date'] = pd.to_datetime(global_projects['start_date'])
+            df = pd.DataFrame(rows, columns=columns)
+            df['end_date'] = pd.to_datetime(df['end_date'])
+            df['start_date'] = pd.to_datetime(df['start_date'])
+    data_context.data_set('global_projects', df)
 
 
 def freelance_contracts_get():
     """Get DataFrame with all freelance contracts"""
-    global global_freelance_contracts
     query = f"""
     SELECT * FROM people_freelance_contracts
     """
@@ -173,12 +189,13 @@ def freelance_contracts_get():
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
-            global_freelance_contracts = pd.DataFrame(rows, columns=columns)
-    global_freelance_contracts.set_index('id', inplace=True)
+            df = pd.DataFrame(rows, columns=columns)
+    df.set_index('id', inplace=True)
+    data_context.data_set('global_freelance_contracts', df)
 
 
 def hr_values_get():
     """Get DataFrame with hr values"""
-    global global_hr_values
-    global_hr_values = pd.read_csv(config.g_config.get('FILES', 'hrvalues'), decimal=',', sep=';')
-    global_hr_values = global_hr_values.set_index(['Code'])
+    df = gh.csv_read(config.g_config.get('FILES', 'hrvalues'), {'Code': str, 'waarde': float}, decimal=',')
+    df = df.set_index(['Code'])
+    data_context.data_set('global_hr_values', df)
@@ -0,0 +1,148 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the forecast engine, a forecast context owning its global dataframes, reference date and cached
+# results. The existing calculations are available as methods of the engine, they run with the data of the engine
+# while it is active (see module data_context). Engines never change each other's data, so several reference dates or
+# scenarios can be calculated side by side in threads, e.g. by the callbacks of the Dash app.
+#
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import pandas as pd
+from src.utils import calculate_calendar, calculate_employee, calculate_freelance, config, data_context, \
+    forecast_graph, main_functions, monte_carlo
+
+
+class ForecastEngine:
+    """Forecast context with its own global dataframes (data), reference date and cache of calculated results.
+    The dataframes may be shared with other engines and are never modified, neither are the cached results which are
+    returned to the caller."""
+
+    def __init__(self, ref_date: datetime = None, data: dict = None, version: str = None, as_of: datetime = None,
+                 parameters: dict = None):
+        """Create an engine for ref_date (default the reference date of the process) with the given global dataframes
+        (default the dataframes of the process) of the given data version. The as-of date (default today) is the date
+        up to which the calendar is taken as actual, it is fixed for the engine so its results are reproducible.
+        Parameters overrides the values of section PARAMETERS of config.ini, e.g. {'inflator': 1.03}."""
+        self.ref_date = config.process_ref_date if ref_date is None else ref_date
+        self.data = dict(data_context.process_data if data is None else data)
+        self.version = version
+        self.as_of = data_context.as_of_get() if as_of is None else as_of
+        self.parameters = dict(parameters or {})
+        self.cache = {}
+        self.memo = {}
+        self.memo_generation = 0
+        self.cache_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, ref_date: datetime = None, version: str = None, as_of: datetime = None) -> 'ForecastEngine':
+        """Create an engine for ref_date and load its global dataframes from the SQL database, the data of the
+        process is not touched"""
+        engine = cls(ref_date, {}, version, as_of)
+        with engine.activate():
+            main_functions.load_dataframes()
+        return engine
+
+    def scenario(self, ref_date: datetime = None, as_of: datetime = None, parameters: dict = None,
+                 **data) -> 'ForecastEngine':
+        """Create a new engine sharing the dataframes of this engine, with another reference date, as-of date, some
+        parameters overridden and/or some global dataframes replaced, e.g. scenario(global_saldi=adjusted_saldi). The
+        new engine starts with an empty cache."""
+        return ForecastEngine(self.ref_date if ref_date is None else ref_date, {**self.data, **data}, self.version,
+                              self.as_of if as_of is None else as_of, {**self.parameters, **(parameters or {})})
+
+    @contextmanager
+    def activate(self):
+        """Context manager making this the active engine of the current thread, the calculations called within read
+        the global dataframes and config.g_ref_date of this engine"""
+        token = data_context.active_engine.set(self)
+        try:
+            yield self
+        finally:
+            data_context.active_engine.reset(token)
+
+    def cached(self, key: tuple, function, *args):
+        """Return the cached result for key, or call function with args within this engine and cache the result.
+        Threads requesting the same key at the same time may both calculate it, the result is the same."""
+        with self.cache_lock:
+            if key in self.cache:
+                return self.cache[key]
+        with self.activate():
+            result = function(*args)
+        with self.cache_lock:
+            return self.cache.setdefault(key, result)
+
+    def company_year_forecast(self, graph: dict = None) -> (pd.DataFrame, dict, dict, pd.DataFrame):
+        """Forecast of the year for the whole company, see main_functions.company_year_forecast. The monthly summaries
+        are taken from the dependency graph of this engine if given, see forecast_graph."""
+        return self.cached(('company_year_forecast',), main_functions.company_year_forecast, graph)
+
+    def forecast_graph(self, previous: dict = None) -> dict:
+        """Monthly summaries of the forecast of the year with their dependency graph, taking over the results of which
+        the inputs did not change from the previous graph, see forecast_graph.graph_build"""
+        return self.cached(('forecast_graph',), forecast_graph.graph_build, previous)
+
+    def company_month_forecast(self, month_date: datetime) -> dict:
+        """Forecast of one month for the whole company, see main_functions.company_month_forecast"""
+        return self.cached(('company_month_forecast', month_date), main_functions.company_month_forecast,
+                           month_date)
+
+    def monte_carlo_forecast(self, trials: int = None, seed: int = None) -> pd.DataFrame:
+        """Spread of the forecast of the year for the whole company, see monte_carlo.monte_carlo_forecast"""
+        company_forecast, monthly_employee_data, monthly_freelance_data, temporary_projects = \
+            self.company_year_forecast()
+        return self.cached(('monte_carlo_forecast', trials, seed), monte_carlo.monte_carlo_forecast,
+                           company_forecast, monthly_employee_data, trials, seed)
+
+    def employee_month_forecast(self, month_date: datetime) -> pd.DataFrame:
+        """Forecast of one month for all employees, see main_functions.employee_month_forecast"""
+        return self.cached(('employee_month_forecast', month_date), main_functions.employee_month_forecast,
+                           month_date)
+
+    def monthly_summary_data(self, month_date: datetime) -> (pd.DataFrame, pd.DataFrame):
+        """Costs and incomes of all employees in one month, see calculate_employee.get_monthly_summary_data"""
+        return self.cached(('monthly_summary_data', month_date), calculate_employee.get_monthly_summary_data,
+                           month_date)
+
+    def freelance_monthly_summary(self, month_date: datetime) -> pd.DataFrame:
+        """Costs and revenue of all freelance projects in one month, see calculate_freelance.monthly_summary"""
+        return self.cached(('freelance_monthly_summary', month_date), calculate_freelance.monthly_summary,
+                           month_date)
+
+    def yearly_simulation(self, real_calendar: bool = False) -> (pd.DataFrame, pd.Series, pd.DataFrame):
+        """Yearly cost, income and parameters of all employees, see calculate_employee.yearly_cost_income_batch"""
+        return self.cached(('yearly_simulation', real_calendar), calculate_employee.yearly_cost_income_batch, None,
+                           real_calendar)
+
+    def yearly_cost_income(self, employee_id: int, real_calendar: bool = False) \
+            -> (pd.DataFrame, float, pd.DataFrame):
+        """Yearly cost, income and parameters of one employee, taken from the yearly simulation of all employees"""
+        cost_overview, yearly_revenue, parameters = self.yearly_simulation(real_calendar)
+        if employee_id not in cost_overview.index:
+            return self.cached(('yearly_cost_income', employee_id, real_calendar),
+                               calculate_employee.yearly_cost_income, employee_id, real_calendar)
+        return (cost_overview.loc[[employee_id]], yearly_revenue[employee_id],
+                parameters.loc[[employee_id]])
+
+    def yearly_margin_ranking(self, real_calendar: bool = False) -> pd.DataFrame:
+        """Yearly cost, revenue and margin of all employees ranked by margin, see
+        calculate_employee.yearly_margin_ranking"""
+        cost_overview, yearly_revenue, parameters = self.yearly_simulation(real_calendar)
+        return self.cached(('yearly_margin_ranking', real_calendar), calculate_employee.yearly_margin_ranking,
+                           cost_overview, yearly_revenue)
+
+    def workhours(self, employee_id: int, start_date: datetime, end_date: datetime, billable: bool) -> float:
+        """Forecasted workhours of an employee in a period, see calculate_calendar.get_workhours"""
+        return self.cached(('workhours', employee_id, start_date, end_date, billable),
+                           calculate_calendar.get_workhours, employee_id, start_date, end_date, billable)
@@ -0,0 +1,166 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the dependency graph of the forecast of the year, used to recalculate only what changed. The
+# forecast is made of cells: the cost and revenue rows of an employee contract in a month, and the summary of the
+# freelancers in a month. The graph records on which inputs each cell depends, e.g. the projects, calendar and saldi of
+# the employee, the contract in that month and all HR values. Every input has a fingerprint (a hash of its data).
+# When the forecast is calculated again on new data, the fingerprints are compared with those of the previous graph and
+# only the cells depending on a changed input are recalculated, the others are taken over. The totals are then
+# aggregated again from all cells.
+#
+import hashlib
+import os
+from datetime import datetime
+import pandas as pd
+from src.utils import calculate_employee, calculate_freelance, config, data_context, db_supply
+
+# global dataframes of which each employee has its own rows, and the column or index level holding the employee id
+EMPLOYEE_INPUTS = {
+    'global_calendar': 'employee_id',
+    'global_multiyear_calendar': 'employee_id',
+    'global_saldi': 'employee_id',
+}
+
+# inputs on which the freelance summary of a month depends
+FREELANCE_INPUTS = [('global_freelance_contracts',), ('global_projects',), ('global_hr_values',),
+                    ('global_workdays',), ('freelance_workers',), ('context',)]
+
+
+def frame_fingerprint(frame: pd.DataFrame) -> int:
+    """Return the fingerprint of a whole dataframe"""
+    return int(pd.util.hash_pandas_object(frame, index=True).sum())
+
+
+def employee_fingerprints(frame: pd.DataFrame, employee_ids) -> dict:
+    """Return the fingerprint of the rows of each employee in a dataframe, given the employee id of every row"""
+    hashes = pd.util.hash_pandas_object(frame, index=True)
+    return {employee_id: int(value) for employee_id, value in hashes.groupby(employee_ids).sum().items()}
+
+
+def context_fingerprint() -> str:
+    """Return the fingerprint of the reference date, as-of date and parameters, on which all results depend"""
+    parameters = {option: config.g_config.get('PARAMETERS', option) for option in config.g_config.options('PARAMETERS')}
+    context = (config.g_ref_date, data_context.as_of_get(), sorted(parameters.items()))
+    return hashlib.sha1(repr(context).encode()).hexdigest()
+
+
+def input_fingerprints(worker_list: pd.DataFrame, freelance_workers: pd.DataFrame, contracts: dict) -> dict:
+    """Return the fingerprints of all inputs of the forecast, keyed by input: (dataframe name, employee id) for the
+    rows of an employee, ('contract', month date, contract id) for a contract valid in a month, or (name,) for a whole
+    input"""
+    fingerprints = {}
+    for name, employee_column in EMPLOYEE_INPUTS.items():
+        frame = data_context.data_get(name)
+        employee_ids = frame.index.get_level_values(employee_column)
+        for employee_id, fingerprint in employee_fingerprints(frame, employee_ids).items():
+            fingerprints[(name, employee_id)] = fingerprint
+    # an employee depends on the rows of the ids of its projects, the dayrate is looked up by project id
+    projects = db_supply.global_projects
+    id_fingerprints = pd.util.hash_pandas_object(projects, index=True).groupby(projects['id'].to_numpy()).sum()
+    employee_projects = projects[['employee_id', 'id']].drop_duplicates()
+    project_fingerprints = pd.Series(id_fingerprints.reindex(employee_projects['id']).to_numpy(),
+                                     index=employee_projects['employee_id'].to_numpy()).groupby(level=0).sum()
+    for employee_id, fingerprint in project_fingerprints.items():
+        fingerprints[('global_projects', employee_id)] = int(fingerprint)
+    for employee_id, fingerprint in employee_fingerprints(worker_list, worker_list.index).items():
+        fingerprints[('worker', employee_id)] = fingerprint
+    for month_date, empl_contracts in contracts.items():
+        for contract_id, fingerprint in employee_fingerprints(empl_contracts, empl_contracts.index).items():
+            fingerprints[('contract', month_date, contract_id)] = fingerprint
+    for name in ['global_freelance_contracts', 'global_projects', 'global_hr_values', 'global_workdays']:
+        fingerprints[(name,)] = frame_fingerprint(data_context.data_get(name))
+    fingerprints[('freelance_workers',)] = frame_fingerprint(freelance_workers)
+    fingerprints[('context',)] = context_fingerprint()
+    return fingerprints
+
+
+def employee_cell_inputs(month_date: datetime, contract_id: int, employee_id: int) -> list:
+    """Return the inputs on which the rows of an employee contract in a month depend"""
+    return [(name, employee_id) for name in EMPLOYEE_INPUTS] + [
+        ('global_projects', employee_id), ('worker', employee_id), ('contract', month_date, contract_id),
+        ('global_hr_values',), ('global_workdays',), ('context',)]
+
+
+def graph_build(previous: dict = None) -> dict:
+    """Calculate the monthly summaries of the employees and freelancers of the forecast of the year (see
+    main_functions.company_year_forecast) with the dependency graph of their cells. The cells of a previous graph of
+    which no input changed are taken over, only the other cells are calculated. The graph is a dictionary with the
+    fingerprints of the inputs, the cells, the cells depending on each input and the monthly summaries."""
+    ref_date = config.g_ref_date
+    month_dates = [datetime(ref_date.year, month, 1) for month in range(ref_date.month, 13)]
+    worker_list = db_supply.worker_list_get('intern')
+    freelance_workers = db_supply.worker_list_get('Freelance')
+    contracts = {month_date: db_supply.employee_contracts_get(month_date) for month_date in month_dates}
+    fingerprints = input_fingerprints(worker_list, freelance_workers, contracts)
+    if previous is None:
+        previous = {'fingerprints': {}, 'cells': {}, 'dependents': {}, 'freelance': {}}
+
+    # cells depending on an input which changed, was added or was removed
+    changed = [key for key in fingerprints.keys() | previous['fingerprints'].keys()
+               if fingerprints.get(key) != previous['fingerprints'].get(key)]
+    affected = set().union(*[previous['dependents'].get(key, set()) for key in changed])
+
+    # take over the unaffected cells of the contracts of each month, and collect the contracts to calculate
+    cells = {}
+    dependents = {}
+    to_calculate = {}
+    for month_date, empl_contracts in contracts.items():
+        for contract_id, employee_id in empl_contracts['employee_id'].items():
+            cell = (month_date, contract_id)
+            for key in employee_cell_inputs(month_date, contract_id, employee_id):
+                dependents.setdefault(key, set()).add(cell)
+            if cell in previous['cells'] and cell not in affected:
+                cells[cell] = previous['cells'][cell]
+            else:
+                to_calculate.setdefault(month_date, []).append(contract_id)
+    print(f"-- Calculating {sum(len(contract_ids) for contract_ids in to_calculate.values())} of "
+          f"{sum(len(empl_contracts) for empl_contracts in contracts.values())} employee months")
+
+    # calculate the cells, in parallel processes if configured (see parameter forecast_workers)
+    workers = config.g_config.getint('PARAMETERS', 'forecast_workers') or os.cpu_count()
+    if workers > 1 and to_calculate:
+        rows = calculate_employee.employee_month_rows_parallel(
+            {month_date: (contract_ids, contracts[month_date], worker_list)
+             for month_date, contract_ids in to_calculate.items()}, workers)
+    else:
+        rows = {month_date: calculate_employee.employee_month_rows(month_date, contract_ids, contracts[month_date],
+                                                                   worker_list)
+                for month_date, contract_ids in to_calculate.items()}
+    for month_date, (cost_list, revenue_list) in rows.items():
+        for contract_id, cost_row, revenue_row in zip(to_calculate[month_date], cost_list, revenue_list):
+            cells[(month_date, contract_id)] = (cost_row, revenue_row)
+
+    # aggregate the monthly summaries of the employees from the cells, in the order of the contracts
+    monthly_employee_data = {}
+    for month_date, empl_contracts in contracts.items():
+        month_cells = [cells[(month_date, contract_id)] for contract_id in empl_contracts.index]
+        monthly_employee_data[month_date.month] = calculate_employee.monthly_summary(
+            pd.DataFrame.from_records([cost_row for cost_row, revenue_row in month_cells]).set_index(['Medewerker']),
+            pd.DataFrame.from_records([revenue_row for cost_row, revenue_row in month_cells]).set_index(
+                ['Medewerker']))
+
+    # the freelance summaries are calculated at once for all freelancers, again if any of their inputs changed
+    freelance_changed = any(key in changed for key in FREELANCE_INPUTS)
+    freelance = {month_date: previous['freelance'][month_date]
+                 if month_date in previous['freelance'] and not freelance_changed
+                 else calculate_freelance.monthly_summary(month_date) for month_date in month_dates}
+
+    return {
+        'fingerprints': fingerprints,
+        'cells': cells,
+        'dependents': dependents,
+        'freelance': freelance,
+        'monthly_employee_data': monthly_employee_data,
+        'monthly_freelance_data': {month_date.month: frame for month_date, frame in freelance.items()},
+    }
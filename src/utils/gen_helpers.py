@@ -18,6 +18,13 @@ import mysql.connector
 import subprocess
 import configparser
 import os
+import gzip
+import hashlib
+import importlib.util
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from src.utils import config
 from dotenv import load_dotenv
 from datetime import datetime
@@ -31,7 +38,79 @@ def check_col_exists(data_frame: pd.DataFrame, col_list: list):
     return 1
 
 
+# parsed CSV files by file and read options, with the modification time, size and hash of the file, see csv_read
+csv_cache = {}
+csv_cache_lock = threading.Lock()
+
+
+def csv_cache_lock_reset():
+    """Replace the CSV cache lock in a forked process, as it may have been held by another thread of the parent"""
+    global csv_cache_lock
+    csv_cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=csv_cache_lock_reset)
+
+
+def csv_read(csvfile: str, dtype: dict, **kwargs) -> pd.DataFrame:
+    """Read a semicolon separated CSV file into a dataframe with the columns and types declared in dtype, raising an
+    error if a declared column does not exist. Other read_csv arguments can be given, e.g. decimal=','.
+    The file is parsed with the multithreaded pyarrow engine if pyarrow is installed. Parsed files are cached: a file
+    of which modification time and size, or otherwise the content hash, did not change is not parsed again. A copy is
+    returned, so the caller can change it."""
+    path = os.path.realpath(csvfile)
+    key = (path, tuple(sorted((column, str(column_type)) for column, column_type in dtype.items())),
+           tuple(sorted(kwargs.items())))
+    stat = os.stat(path)
+    with csv_cache_lock:
+        cached = csv_cache.get(key)
+    if cached is not None and (cached['mtime'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+        return cached['frame'].copy()
+    with open(path, 'rb') as file:
+        content_hash = hashlib.sha1(file.read()).hexdigest()
+    if cached is None or cached['hash'] != content_hash:
+        engine = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+        frame = pd.read_csv(path, dtype=dtype, sep=';', engine=engine, **kwargs)
+        check_col_exists(frame, list(dtype.keys()))
+    else:
+        frame = cached['frame']
+    with csv_cache_lock:
+        csv_cache[key] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': content_hash, 'frame': frame}
+    return frame.copy()
+
+
+# connection of the unit of work active in the current thread, see function unit_of_work
+global_unit_of_work = threading.local()
+
+
+class SharedConnection:
+    """Wrapper around the connection of a unit of work, handed out by get_db_connection while the unit of work is
+    active. Commit and close are left to the unit of work, all other calls are passed to the wrapped connection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
 def get_db_connection():
+    # inside a unit of work all database access goes through the connection of the unit of work
+    shared_connection = getattr(global_unit_of_work, 'connection', None)
+    if shared_connection is not None:
+        return shared_connection
     # load configuration parameters
     load_dotenv()
     try:
@@ -49,10 +128,37 @@ def get_db_connection():
         return None
 
 
+@contextmanager
+def unit_of_work():
+    """Context manager making all database access in the current thread go through one connection and one
+    transaction, which is committed at the end or rolled back on error. A nested unit of work joins the outer one."""
+    if getattr(global_unit_of_work, 'connection', None) is not None:
+        yield global_unit_of_work.connection
+        return
+    connection = get_db_connection()
+    if connection is None:
+        raise ValueError("No database connection available for unit of work")
+    connection.start_transaction()
+    global_unit_of_work.connection = SharedConnection(connection)
+    try:
+        yield global_unit_of_work.connection
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        global_unit_of_work.connection = None
+        connection.close()
+
+
 def truncate_table(table_name: str):
-    """Helper function emptying given table"""
+    """Helper function emptying given table
+    TRUNCATE commits implicitly in MySQL, so inside a unit of work the table is emptied with DELETE instead"""
     # SQL query to empty the table
-    delete_query = f"TRUNCATE TABLE {table_name}"
+    if getattr(global_unit_of_work, 'connection', None) is not None:
+        delete_query = f"DELETE FROM {table_name}"
+    else:
+        delete_query = f"TRUNCATE TABLE {table_name}"
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             # empty table
@@ -60,6 +166,39 @@ def truncate_table(table_name: str):
             conn.commit()
 
 
+@contextmanager
+def staging_reload(table_names: list):
+    """Context manager to reload given tables without readers ever seeing an empty or partial table. For every table
+    an empty staging copy is created, the mapping of table name to staging table name is yielded to be loaded by the
+    caller, and at the end all staging tables replace the live tables in one atomic RENAME TABLE. On error the staging
+    tables are dropped and the live tables are left untouched.
+    DDL commits implicitly in MySQL, so this cannot be used inside a unit of work, but a unit of work can be used
+    inside to load the staging tables."""
+    if getattr(global_unit_of_work, 'connection', None) is not None:
+        raise ValueError("Function staging_reload cannot be used inside a unit of work")
+    staging_tables = {table_name: f"{table_name}_staging" for table_name in table_names}
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            for table_name, staging_table in staging_tables.items():
+                cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+                cursor.execute(f"CREATE TABLE {staging_table} LIKE {table_name}")
+    try:
+        yield staging_tables
+    except Exception:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {', '.join(staging_tables.values())}")
+        raise
+    # swap all tables in one atomic statement, then drop the old data
+    renames = [f"{table_name} TO {table_name}_old, {staging_table} TO {table_name}"
+               for table_name, staging_table in staging_tables.items()]
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {', '.join(f'{table_name}_old' for table_name in table_names)}")
+            cursor.execute(f"RENAME TABLE {', '.join(renames)}")
+            cursor.execute(f"DROP TABLE {', '.join(f'{table_name}_old' for table_name in table_names)}")
+
+
 def get_month_name(month: int) -> str:
     """Return the name of the month as a string"""
     month_names = ['januari', 'februari', 'maart', 'april', 'mei', 'juni', 'juli', 'augustus', 'september',
@@ -76,7 +215,76 @@ def get_consultant_name(consultant_id: int) -> str:
     return name
 
 
+def dump_tables_get(database: str, changed_since: datetime = None) -> list:
+    """Return the tables of the database to dump, if changed_since is set only the tables updated after that moment.
+    Tables of which MySQL does not know the update time (e.g. after a restart) are always included. Staging copies of
+    tables are never included."""
+    query = """
+    SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, (database,))
+            rows = cursor.fetchall()
+    return [table_name for table_name, update_time in rows
+            if not table_name.endswith(('_staging', '_old'))
+            and (changed_since is None or update_time is None or update_time > changed_since)]
+
+
+def dump_table(user: str, password: str, database: str, table_name: str, dump_dir: str):
+    """Stream the mysqldump of one table through gzip compression into the dump directory"""
+    with gzip.open(f"{dump_dir}/{table_name}.sql.gz", 'wb') as f:
+        process = subprocess.Popen(['mysqldump', '--single-transaction', '-u', user, '-p' + password, database,
+                                    table_name], stdout=subprocess.PIPE)
+        shutil.copyfileobj(process.stdout, f)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, f"mysqldump {database} {table_name}")
+
+
+def dumps_list(dump_file_path: str, database: str) -> list:
+    """Return the names of all dumps of the database in the dump directory, oldest first"""
+    return sorted(name for name in os.listdir(dump_file_path) if name.startswith(f"dump_{database}_"))
+
+
+def dump_chains(dumps: list) -> list:
+    """Split a list of dumps, oldest first, in chains: a full dump followed by the dumps of changed tables made after
+    it, which can only be restored together with the dumps before them in the chain"""
+    chains = []
+    for name in dumps:
+        if not name.endswith('_changed') or not chains:
+            chains.append([])
+        chains[-1].append(name)
+    return chains
+
+
+def dump_retention_apply(dump_file_path: str, database: str, retention: int):
+    """Remove old dumps, keeping at most retention dumps. The chain of the newest full dump is always kept completely,
+    older chains are only kept as a whole while they fit in the retention, so every kept dump can be restored."""
+    chains = dump_chains(dumps_list(dump_file_path, database))
+    if not chains:
+        return
+    keep = list(chains[-1])
+    for chain in reversed(chains[:-1]):
+        if len(keep) + len(chain) > retention:
+            break
+        keep.extend(chain)
+    for name in [name for chain in chains for name in chain]:
+        if name in keep:
+            continue
+        path = f"{dump_file_path}/{name}"
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        print(f"SQL dump removed: {path}")
+
+
 def create_sql_dump():
+    """Create a dump of the database in a new directory, with one gzip compressed file per table. Tables are dumped in
+    parallel, and if configured only the tables changed since the previous dump are included. Afterwards old dumps are
+    removed according to the configured retention. An error is raised if the dump fails, the incomplete dump is
+    removed."""
     # Get the current date to append to the filename
     date = datetime.now().strftime("%Y%m%d_%H%M%S")
     # load configuration parameters from .env file
@@ -86,15 +294,43 @@ def create_sql_dump():
     database = os.getenv('db_name')
     # load other configuration parameters
     dump_file_path = config.g_config.get('FILES', 'database_dumps')
-    dump_file = f"{dump_file_path}/dump_{database}_{date}.sql"
+    changed_only = config.g_config.getboolean('BACKUP', 'changed_only')
+    # tables changed since the previous dump, which has its creation date in the name, or all tables
+    changed_since = None
+    previous_dumps = dumps_list(dump_file_path, database)
+    if changed_only and previous_dumps:
+        changed_since = datetime.strptime(previous_dumps[-1][len(f"dump_{database}_"):][:15], "%Y%m%d_%H%M%S")
+    dump_dir = f"{dump_file_path}/dump_{database}_{date}" + ("_changed" if changed_since else "")
 
     try:
-        # Call the mysqldump command to create an SQL dump
-        with open(dump_file, 'w') as f:
-            subprocess.run(['mysqldump', '-u', user, '-p'+password, database], stdout=f, check=True)
-        print(f"SQL dump created: {dump_file}")
-    except subprocess.CalledProcessError as e:
+        os.makedirs(dump_dir)
+        table_names = dump_tables_get(database, changed_since)
+        # Call the mysqldump command for all tables in parallel
+        with ThreadPoolExecutor(max_workers=config.g_config.getint('BACKUP', 'workers')) as executor:
+            list(executor.map(lambda table_name: dump_table(user, password, database, table_name, dump_dir),
+                              table_names))
+        print(f"SQL dump created: {dump_dir} ({len(table_names)} tables)")
+    except (subprocess.CalledProcessError, OSError) as e:
+        # remove incomplete dump, so it is not taken as reference for the next dump of changed tables
+        shutil.rmtree(dump_dir, ignore_errors=True)
         print(f"Error creating SQL dump: {str(e)}")
+        raise
+    dump_retention_apply(dump_file_path, database, config.g_config.getint('BACKUP', 'retention'))
+
+
+def data_version_set():
+    """Mark the data in the SQL database as changed, by writing a new data version (the current time) to file"""
+    with open(config.g_config.get('FILES', 'data_version'), 'w') as file:
+        file.write(datetime.now().strftime("%Y%m%d_%H%M%S"))
+
+
+def data_version_get() -> str:
+    """Return the version of the data in the SQL database, None if no version was written yet"""
+    version_file = config.g_config.get('FILES', 'data_version')
+    if not os.path.exists(version_file):
+        return None
+    with open(version_file, 'r') as file:
+        return file.read().strip()
 
 
 def logger(log_message: str, log_level: str = 'INFO'):
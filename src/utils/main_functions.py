@@ -15,51 +15,95 @@
 # later-on these functions can be called from a reporting tool or a web interface
 #
 from datetime import datetime
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from src.utils import calculate_freelance, calculate_calendar, calculate_employee, db_retrieve, db_supply, \
-    config, calculate_project, gen_helpers as gh
+    config, calculate_project, data_context, forecast_engine, refresh_pipeline, gen_helpers as gh
+from src.data import data_store
+
 
 def load_dataframes():
-    """Load all global dataframes with data from SQL database"""
+    """Load all global dataframes with data from SQL database, into the active forecast engine if any (see
+    ForecastEngine.load) or else into the process"""
     ref_date = config.g_ref_date
-    global global_calendar
-    global global_saldi
-    global global_projects
-    global global_freelance_contracts
-    global global_hr_values
-    global global_workdays
-    global global_multiyear_calendar
-    global_calendar = db_supply.calendar_get(ref_date.year)
-    global_multiyear_calendar = db_supply.calendar_multiyear_get(ref_date.year - 1, ref_date.year)
-    global_saldi = db_supply.saldi_get()
-    global_projects = db_supply.projects_get()
-    global_freelance_contracts = db_supply.freelance_contracts_get()
-    global_hr_values = db_supply.hr_values_get()
-    global_workdays = calculate_calendar.build_workday_calendar(ref_date.year)
-
-
-def refresh_from_officient():
+    load_year_dataframes(ref_date.year)
+    db_supply.saldi_get()
+    db_supply.projects_get()
+    db_supply.freelance_contracts_get()
+    db_supply.hr_values_get()
+
+
+def load_year_dataframes(year: int):
+    """Load the global dataframes which depend on the year: the calendar of the year, the calendar of the year and the
+    previous year and the workday calendar"""
+    db_supply.calendar_get(year)
+    db_supply.calendar_multiyear_get(year - 1, year)
+    calculate_calendar.build_workday_calendar(year)
+
+
+def year_engine_get(year: int) -> 'forecast_engine.ForecastEngine':
+    """Return the forecast engine of a year, with January of that year as reference date. The engine of the reference
+    year is the loaded data. The engines of other years are created on first use, loading only the data of that year
+    and sharing all other data with the loaded data. Only the most recently used years are kept, see parameter
+    cached_years, older years are loaded again when used.
+    Employees without calendar in the year (e.g. a future year) are scheduled from the workday calendar and the FTE of
+    their contracts, see calculate_calendar.complete_calendar. The saldi are those left in the reference year, so years
+    after it take the saldi of the whole year instead."""
+    engine = data_store.engine
+    if year == engine.ref_date.year:
+        return engine
+    key = (engine.version, year)
+    with data_store.year_lock:
+        if key in data_store.year_engines:
+            data_store.year_engines.move_to_end(key)
+            return data_store.year_engines[key]
+        print(f"-- Loading data of year {year}")
+        year_engine = engine.scenario(datetime(year, 1, 1))
+        with year_engine.activate():
+            load_year_dataframes(year)
+            calculate_calendar.complete_calendar(year)
+            if year > engine.ref_date.year:
+                data_context.data_set('global_saldi', db_retrieve.employee_saldi_yearly(
+                    engine.data['global_saldi'], engine.data['global_calendar']))
+        data_store.year_engines[key] = year_engine
+        while len(data_store.year_engines) > config.g_config.getint('PARAMETERS', 'cached_years'):
+            data_store.year_engines.popitem(last=False)
+    return year_engine
+
+
+def refresh_from_officient(resume: bool = False):
     """Refresh all data in SQL database from Officient API and input files"""
-    ref_date = config.g_ref_date
     # log main function execution
     print(f"-- Refreshing Officient data in SQL database")
-    # first create backup of the database
-    gh.create_sql_dump()
-    # update calendar and saldi for all employees in SQL
-    db_retrieve.employee_calendar_compose(ref_date.year)
-    db_retrieve.employee_saldi_compose(ref_date.year)
-    # compose a list of all employee contracts and insert into SQL
-    db_retrieve.employee_contract_compose()
+    # first create backup of the database, then update calendar, saldi and contracts of all employees in SQL
+    refresh_pipeline.run(['dump', 'calendar', 'saldi', 'contracts'], resume)
 
 
-def refresh_from_csv():
+def refresh_from_csv(resume: bool = False):
     """Refresh all data in SQL database from Officient API and input files"""
     # log main function execution
     print(f"-- Refreshing CSV data in SQL database")
-    # compose list of employees and freelancers, and input into SQL
-    db_retrieve.workers_list_compose(config.g_config.get('FILES', 'freelancers'))
-    # compose a list of freelance contracts and a list of projects into SQL
-    db_retrieve.project_list_compose(config.g_config.get('FILES', 'projects'))
+    # compose list of employees and freelancers, and a list of freelance contracts and projects into SQL
+    refresh_pipeline.run(['workers', 'projects'], resume)
+
+
+def refresh_all(resume: bool = False, stages: list = None, employee_ids: list = None, year: int = None,
+                months: list = None):
+    """Refresh all data in SQL database, running independent stages concurrently. Optional arguments limit the refresh
+    to some stages, employees, another year than the year of ref_date or a range of months, see refresh_pipeline.run"""
+    # log main function execution
+    print(f"-- Refreshing all data in SQL database")
+    refresh_pipeline.run(stages, resume, employee_ids=employee_ids, year=year, months=months)
+
+
+def backfill_calendar(first_year: int, last_year: int, employee_ids: list = None):
+    """Refresh the calendar in SQL database for a range of historical years"""
+    # log main function execution
+    print(f"-- Backfilling calendar data in SQL database for {first_year}-{last_year}")
+    refresh_pipeline.backfill(first_year, last_year, employee_ids)
 
 
 def load_temporary_projects() -> pd.DataFrame:
@@ -70,59 +114,30 @@ def load_temporary_projects() -> pd.DataFrame:
     return calculate_project.temporary_project_compose(config.g_config.get('FILES', 'temporary_projects'))
 
 
-def company_year_forecast() -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
-    """Calculate the forecast of the year for the whole company and generate a dataframe summarizing this."""
+def company_year_forecast(graph: dict = None) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """Calculate the forecast of the year for the whole company and generate a dataframe summarizing this.
+    The monthly summaries of employees and freelancers are taken from the dependency graph if given (see
+    forecast_graph.graph_build)."""
     ref_date = config.g_ref_date
     # log main function execution
     print(f"-- Calculating yearly forecast for company for {ref_date.year}")
-    # get global hr values and global freelance contracts
-    global_hr_values = db_supply.global_hr_values
-    # get monthly summaries of employee data
-    monthly_employee_data = calculate_employee.get_year_of_monthly_summaries()
-    # get monthly summaries of freelancer data
-    monthly_freelance_data = calculate_freelance.get_year_of_monthly_summaries()
+    if graph is not None:
+        monthly_employee_data = graph['monthly_employee_data']
+        monthly_freelance_data = graph['monthly_freelance_data']
+    else:
+        # get monthly summaries of employee data
+        monthly_employee_data = calculate_employee.get_year_of_monthly_summaries()
+        # get monthly summaries of freelancer data
+        monthly_freelance_data = calculate_freelance.get_year_of_monthly_summaries()
     # get list of temporary projects
     temporary_projects = load_temporary_projects()
+    temporary_projects_revenue_months = calculate_project.temporary_project_month_totals(temporary_projects)
     # define dictionary to store monthly summary data for the year overview
     year_data = {}
     # loop over monthly summaries and calculate company-wide forecast
     for month in range(ref_date.month, 13):
-        # calculate employee totals
-        employee_cost = monthly_employee_data[month]['Kostprijs'].sum()
-        employee_revenue = monthly_employee_data[month]['Omzet'].sum()
-        # calculate freelance totals
-        freelance_cost = monthly_freelance_data[month]['Kostprijs'].sum()
-        freelance_revenue = monthly_freelance_data[month]['Omzet'].sum()
-        # calculate revenue from temporary projects for the month
-        temporary_projects_revenue = 0
-        for x in temporary_projects.index:
-            if temporary_projects.loc[x, str(month)] > 0:
-                temporary_projects_revenue += temporary_projects.loc[x, str(month)]
-        # calculate general costs
-        management_cost = global_hr_values.loc['CS001', 'waarde'] / 12
-        general_cost = global_hr_values.loc['CS003', 'waarde'] / 12
-        testing_cost = global_hr_values.loc['CS004', 'waarde'] / 12
-        # calculating the totals
-        total_cost = employee_cost + freelance_cost + management_cost + general_cost + testing_cost
-        total_revenue = employee_revenue + freelance_revenue + temporary_projects_revenue
-        total_margin = total_revenue - total_cost
-
-        # add month summary data to year dataframe
-        summary = {
-            'Maand': gh.get_month_name(month),
-            'Personeelskost': round(employee_cost, 0),
-            'Freelance kost': round(freelance_cost, 0),
-            'Management tijd': round(management_cost, 0),
-            'Algemene kosten': round(general_cost, 0),
-            'Testing kosten': round(testing_cost, 0),
-            'Totaal kosten': round(total_cost, 0),
-            'Omzet internen': round(employee_revenue, 0),
-            'Omzet freelancers': round(freelance_revenue, 0),
-            'Omzet tijdelijke projecten': round(temporary_projects_revenue, 0),
-            'Omzet': round(total_revenue, 0),
-            'Bruto marge': round(total_margin, 0)
-        }
-        year_data[month] = summary
+        year_data[month] = company_month_summary(month, monthly_employee_data[month], monthly_freelance_data[month],
+                                                 temporary_projects_revenue_months[month])
 
     # assemble dataframe with full year overview
     overview_frame = pd.DataFrame.from_records(year_data)
@@ -136,6 +151,83 @@ def company_year_forecast() -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.Dat
     return overview_frame, monthly_employee_data, monthly_freelance_data, temporary_projects
 
 
+def company_month_summary(month: int, employee_data: pd.DataFrame, freelance_data: pd.DataFrame,
+                          temporary_projects_revenue: float) -> dict:
+    """Summarize the forecast of one month for the whole company, from the monthly summaries of the employees and
+    freelancers and the revenue of the temporary projects in that month"""
+    # get global hr values
+    global_hr_values = db_supply.global_hr_values
+    # calculate employee totals
+    employee_cost = employee_data['Kostprijs'].sum()
+    employee_revenue = employee_data['Omzet'].sum()
+    # calculate freelance totals
+    freelance_cost = freelance_data['Kostprijs'].sum()
+    freelance_revenue = freelance_data['Omzet'].sum()
+    # calculate general costs
+    management_cost = global_hr_values.loc['CS001', 'waarde'] / 12
+    general_cost = global_hr_values.loc['CS003', 'waarde'] / 12
+    testing_cost = global_hr_values.loc['CS004', 'waarde'] / 12
+    # calculating the totals
+    total_cost = employee_cost + freelance_cost + management_cost + general_cost + testing_cost
+    total_revenue = employee_revenue + freelance_revenue + temporary_projects_revenue
+    total_margin = total_revenue - total_cost
+
+    return {
+        'Maand': gh.get_month_name(month),
+        'Personeelskost': round(employee_cost, 0),
+        'Freelance kost': round(freelance_cost, 0),
+        'Management tijd': round(management_cost, 0),
+        'Algemene kosten': round(general_cost, 0),
+        'Testing kosten': round(testing_cost, 0),
+        'Totaal kosten': round(total_cost, 0),
+        'Omzet internen': round(employee_revenue, 0),
+        'Omzet freelancers': round(freelance_revenue, 0),
+        'Omzet tijdelijke projecten': round(temporary_projects_revenue, 0),
+        'Omzet': round(total_revenue, 0),
+        'Bruto marge': round(total_margin, 0)
+    }
+
+
+def company_month_forecast(month_date: datetime) -> dict:
+    """Calculate the forecast of one month for the whole company, summarized as in company_year_forecast. The temporary
+    projects are only counted in the year of parameter year, as their months have no year."""
+    # get summarized employee and freelancer data of the month
+    employee_data = calculate_employee.monthly_summary(*calculate_employee.get_monthly_summary_data(month_date))
+    freelance_data = calculate_freelance.monthly_summary(month_date)
+    temporary_projects_revenue = 0
+    if month_date.year == config.g_config.getint('PARAMETERS', 'year'):
+        temporary_projects = load_temporary_projects()
+        temporary_projects_revenue = calculate_project.temporary_project_month_totals(temporary_projects)[
+            month_date.month]
+    return company_month_summary(month_date.month, employee_data, freelance_data, temporary_projects_revenue)
+
+
+def rolling_forecast(start_date: datetime = None, months: int = 12) -> pd.DataFrame:
+    """Calculate the forecast of the whole company for a rolling horizon of months from start_date (default the
+    reference date), which may span several years. Each month is calculated by the forecast engine of its year (see
+    year_engine_get) and cached in that engine, so when the horizon moves forward only the new months are calculated,
+    and only the calendar of a new year is loaded. The months of the company forecast of the year (see
+    company_year_forecast) are taken from it."""
+    engine = data_store.engine
+    start_date = (engine.ref_date if start_date is None else start_date).replace(day=1)
+    year_overview = engine.company_year_forecast()[0]
+    # log main function execution
+    print(f"-- Calculating rolling forecast for company for {months} months from {start_date.strftime('%Y-%m')}")
+    rolling_data = []
+    for number in range(months):
+        month_date = (start_date + pd.DateOffset(months=number)).to_pydatetime()
+        if month_date.year == engine.ref_date.year and month_date.month >= engine.ref_date.month:
+            month_name = gh.get_month_name(month_date.month)
+            summary = {'Maand': month_name, **year_overview.loc[month_name].to_dict()}
+        else:
+            summary = year_engine_get(month_date.year).company_month_forecast(month_date)
+        rolling_data.append({**summary, 'Maand': f"{summary['Maand']} {month_date.year}"})
+    overview_frame = pd.DataFrame.from_records(rolling_data).set_index('Maand')
+    # calculate sum totals in final row
+    sum_series = pd.Series(overview_frame.sum(), name='Totaal')
+    return pd.concat([overview_frame, sum_series.to_frame().T])
+
+
 def employee_month_forecast(ref_date: datetime) -> pd.DataFrame:
     """Calculate the forecasted month for all employees based on the data in the SQL database
     This provides the most detailed view on the split of costs for the employees.
@@ -163,3 +255,104 @@ def employee_month_forecast(ref_date: datetime) -> pd.DataFrame:
     cost_frame.reset_index(inplace=True)
 
     return cost_frame
+
+
+def data_snapshot_build() -> dict:
+    """Load all global dataframes and calculate the company forecast, and return these as one dictionary. The data
+    is loaded in a new forecast engine, so the data in use by the process is not touched while building. Only the
+    results of which the inputs changed since the installed data are calculated again, see forecast_graph."""
+    version = gh.data_version_get()
+    engine = forecast_engine.ForecastEngine.load(version=version)
+    graph = engine.forecast_graph(data_store.forecast_graph)
+    company_forecast, monthly_employee_data, monthly_freelance_data, temporary_projects = \
+        engine.company_year_forecast(graph)
+    return {
+        'version': version,
+        'as_of': engine.as_of,
+        'globals': engine.data,
+        'company_forecast': company_forecast.reset_index(),
+        'monthly_employee_data': monthly_employee_data,
+        'monthly_freelance_data': monthly_freelance_data,
+        'temporary_projects': temporary_projects,
+        'forecast_graph': graph,
+    }
+
+
+def data_snapshot_install(snapshot: dict):
+    """Replace all global dataframes of the process and the data in the shared data_store module by a snapshot at
+    once, including the forecast engine with which the pages calculate"""
+    with data_store.lock:
+        data_context.process_data_install(snapshot['globals'], snapshot['version'])
+        data_store.engine = forecast_engine.ForecastEngine(config.process_ref_date, snapshot['globals'],
+                                                           snapshot['version'], snapshot['as_of'])
+        # the engine starts with the company forecast of the snapshot, so it is not calculated again
+        data_store.engine.cache[('company_year_forecast',)] = (
+            snapshot['company_forecast'].set_index('index').rename_axis(None), snapshot['monthly_employee_data'],
+            snapshot['monthly_freelance_data'], snapshot['temporary_projects'])
+        data_store.company_forecast = snapshot['company_forecast']
+        data_store.monthly_employee_data = snapshot['monthly_employee_data']
+        data_store.monthly_freelance_data = snapshot['monthly_freelance_data']
+        data_store.temporary_projects = snapshot['temporary_projects']
+        data_store.version = snapshot['version']
+        # a snapshot attached from the shared store has no dependency graph, the next build calculates everything
+        data_store.forecast_graph = snapshot.get('forecast_graph')
+
+
+def data_snapshot_build_forked() -> dict:
+    """Build a data snapshot in a separate process, so the data in use by this process is not touched while building
+    The process is forked, as a spawned process would execute app.py again"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+        return executor.submit(data_snapshot_build).result()
+
+
+def data_snapshot_get(forked: bool = False) -> dict:
+    """Return a data snapshot of the current data version and as-of date (today), built in this process or in a forked
+    process if forked is set. If a shared store is configured, the snapshot is attached from the shared store instead,
+    and only built and published when the store does not have the current version and as-of date yet. The lock on the
+    store makes sure only one worker process builds it while the others wait, and that no snapshot is removed while a
+    process attaches to it."""
+    store_dir = config.g_config.get('FILES', 'shared_store', fallback='')
+    if not store_dir:
+        return data_snapshot_build_forked() if forked else data_snapshot_build()
+    # the shared store needs pyarrow, which is only required when the store is used
+    from src.data import shared_store
+    with shared_store.publish_lock(store_dir):
+        manifest = shared_store.manifest_get(store_dir)
+        if (manifest is None or manifest['version'] != gh.data_version_get()
+                or manifest.get('as_of') != data_context.as_of_get().isoformat()):
+            snapshot = data_snapshot_build_forked() if forked else data_snapshot_build()
+            shared_store.publish(snapshot, store_dir)
+        return shared_store.attach(store_dir)
+
+
+def data_reload():
+    """Get a data snapshot of the new version and install it, recording the timing in data_store.reload_info"""
+    start = time.perf_counter()
+    snapshot = data_snapshot_get(forked=True)
+    built = time.perf_counter()
+    data_snapshot_install(snapshot)
+    data_store.reload_info = {
+        'version': snapshot['version'],
+        'loaded_at': datetime.now(),
+        'build_seconds': round(built - start, 2),
+        'install_seconds': round(time.perf_counter() - built, 4),
+    }
+    print(f"-- Data version {snapshot['version']} loaded in {data_store.reload_info['build_seconds']} s")
+
+
+def data_reloader_start(interval: int):
+    """Start a background thread checking every interval seconds for a new data version, which is then reloaded while
+    the app keeps serving the current data. The data is reloaded on a new day as well, as the forecast depends on the
+    as-of date."""
+    def reload_loop():
+        while True:
+            time.sleep(interval)
+            if (gh.data_version_get() == data_store.version
+                    and data_store.engine.as_of == data_context.as_of_get()):
+                continue
+            try:
+                data_reload()
+            except Exception as e:
+                print(f"Error reloading data, keeping version {data_store.version}: {str(e)}")
+
+    threading.Thread(target=reload_loop, name='data_reloader', daemon=True).start()
@@ -0,0 +1,202 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the Monte Carlo forecast of the company: instead of spreading the saldi left evenly over the
+# months, the absences of every employee are sampled from the history in the calendar, in thousands of trials. The
+# trials give the spread (P10, P50 and P90) of the monthly revenue and margin around the company forecast.
+# In each trial and forecasted month an employee
+# - is sick during the share of the scheduled time of a random employee month of the history
+# - takes part of the leave days left, spread over the months with the monthly profile of the leave in the history
+# - is on the bench without revenue with the chance of an employee month without project in the history
+# Only the billable hours differ between the trials, the costs are those of the company forecast. Only the employees
+# in the monthly summaries of the company forecast are sampled, in the months they are in it.
+#
+import calendar
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from src.utils import calculate_calendar, config, data_context, db_supply
+
+# saldo categories of which the timing is sampled, sickness is sampled from the history instead of the saldo, training
+# keeps its forecast
+LEAVE_ABSENCES = ('vacation', 'holiday', 'adv', 'extralegal_vacation')
+LEAVE_COLUMNS = ['vacation_time', 'holiday_time', 'adv_time', 'extralegal_vacation_time']
+# calendar columns of the time which is not billable, see calculate_calendar.get_workhours
+BILLABLE_LEAVE_COLUMNS = ['paid_leave_time_total', 'unpaid_leave_time_total', 'sick_time_total', 'training_time']
+
+PERCENTILES = (10, 50, 90)
+
+
+def forecasted_months(ref_date: datetime, as_of: datetime) -> np.ndarray:
+    """Return for the months from ref_date until december if their absences are forecasted, which are the months after
+    the as-of date, see calculate_calendar.get_absence_forecast"""
+    forecasted = []
+    for month in range(ref_date.month, 13):
+        month_end = datetime(ref_date.year, month, calendar.monthrange(ref_date.year, month)[1])
+        forecasted.append(month_end > as_of and not (month_end.year == as_of.year and month == as_of.month
+                                                      and month != 12))
+    return np.array(forecasted)
+
+
+def history_months() -> pd.DataFrame:
+    """Return the scheduled, sick and leave minutes per employee and month in the calendar of the previous and
+    current year, for the complete months before the as-of date in which the employee is scheduled"""
+    as_of = data_context.as_of_get()
+    history = db_supply.global_multiyear_calendar.reset_index()
+    history = history[history['date'] < as_of.replace(day=1)]
+    history['year'] = history['date'].dt.year
+    history['month'] = history['date'].dt.month
+    history['leave_time'] = history[LEAVE_COLUMNS].sum(axis=1)
+    months = (history.groupby(['employee_id', 'year', 'month'])[['scheduled_time', 'sick_time_total', 'leave_time']]
+              .sum().reset_index())
+    months = months[months['scheduled_time'] > 0]
+    if months.empty:
+        raise ValueError(f"No calendar months before {as_of.strftime('%Y-%m-%d')} to sample the absences from")
+    return months
+
+
+def history_bench_rate(months: pd.DataFrame) -> float:
+    """Return the share of the employee months in the history without project"""
+    projects = db_supply.global_projects[['employee_id', 'start_date', 'end_date']]
+    month_start = pd.to_datetime(dict(year=months['year'], month=months['month'], day=1))
+    periods = months[['employee_id']].assign(month_start=month_start,
+                                             month_end=month_start + pd.offsets.MonthEnd(0))
+    periods = periods.reset_index().merge(projects, on='employee_id', how='left')
+    periods['on_project'] = ((periods['start_date'] <= periods['month_end']) &
+                             (periods['end_date'] >= periods['month_start']))
+    return 1 - periods.groupby('index')['on_project'].any().mean()
+
+
+def monthly_project_rates(employee_ids: pd.Index, ref_date: datetime) -> np.ndarray:
+    """Return the revenue per billable hour after MSP fee of the employees in the months from ref_date until december,
+    from the first project of each employee running in the month (see calculate_project.get_consultant_project)"""
+    global_projects = db_supply.global_projects
+    rates = []
+    for month in range(ref_date.month, 13):
+        month_start = datetime(ref_date.year, month, 1)
+        month_end = datetime(ref_date.year, month, calendar.monthrange(ref_date.year, month)[1])
+        projects = (global_projects[(global_projects['start_date'] <= month_end) &
+                                    (global_projects['end_date'] >= month_start)]
+                    .drop_duplicates('employee_id').set_index('employee_id'))
+        rate = projects['hourly_rate'] * (1 - projects['msp_percentage'])
+        rates.append(rate.reindex(employee_ids, fill_value=0.0).to_numpy(dtype=float))
+    return np.column_stack(rates)
+
+
+def monte_carlo_inputs(overview: pd.DataFrame, monthly_employee_data: dict) -> dict:
+    """Collect the inputs of the trials from the global dataframes and the company forecast overview and monthly
+    summaries of the employees (see main_functions.company_year_forecast), as arrays of employee x month for the
+    months from ref_date until december"""
+    ref_date = config.g_ref_date
+    as_of = data_context.as_of_get()
+    forecasted = forecasted_months(ref_date, as_of)
+    months = list(range(ref_date.month, 13))
+
+    # scheduled and not billable minutes per employee and month in the calendar of the year
+    year_calendar = db_supply.global_calendar.reset_index()
+    year_calendar['month'] = year_calendar['date'].dt.month
+    totals = year_calendar.groupby(['employee_id', 'month'])[['scheduled_time'] + BILLABLE_LEAVE_COLUMNS].sum()
+    # employees in the monthly summaries per month, those left out of the forecast (e.g. ignore_list) are not sampled
+    names = db_supply.worker_list_get('intern')['name'].reindex(totals.index.unique(level='employee_id'))
+    included = np.column_stack([names.isin(monthly_employee_data[month].index).to_numpy() for month in months])
+    employee_ids = names.index[included.any(axis=1)]
+    included = included[included.any(axis=1)]
+    totals = totals[totals.index.get_level_values('employee_id').isin(employee_ids)]
+    scheduled = totals['scheduled_time'].unstack(fill_value=0).reindex(columns=months, fill_value=0)
+    leave_time = totals[BILLABLE_LEAVE_COLUMNS].sum(axis=1).unstack(fill_value=0).reindex(columns=months,
+                                                                                          fill_value=0)
+
+    # forecasted absence minutes per employee and month, in total and of the categories which are sampled
+    schedule = calculate_calendar.absence_forecast_schedule()
+    schedule_year = as_of.year if ref_date.year == as_of.year else as_of.year + 1
+
+    def forecast(categories: list) -> np.ndarray:
+        minutes = (schedule[categories].T.groupby(level=['year', 'month']).sum().T[schedule_year][months]
+                   .reindex(employee_ids, fill_value=0).to_numpy(dtype=float).round(0))
+        return minutes * forecasted
+    absence = forecast(list(calculate_calendar.BILLABLE_ABSENCES))
+    leave_forecast = forecast(list(LEAVE_ABSENCES))
+    sick_forecast = forecast(['sickness'])
+    hours = np.maximum((scheduled.to_numpy(dtype=float) - leave_time.to_numpy(dtype=float) - absence) / 60, 0)
+
+    # history of sickness, leave and bench
+    history = history_months()
+    leave_profile = history.groupby('month')['leave_time'].sum().reindex(months, fill_value=0).to_numpy(dtype=float)
+    leave_profile = leave_profile * forecasted
+    if leave_profile.sum() == 0:
+        leave_profile = forecasted.astype(float)
+    if leave_profile.sum():
+        leave_profile = leave_profile / leave_profile.sum()
+    bench_rate = history_bench_rate(history)
+
+    return {
+        'revenue': overview['Omzet'].iloc[:-1].to_numpy(dtype=float),
+        'margin': overview['Bruto marge'].iloc[:-1].to_numpy(dtype=float),
+        'hours': hours,
+        'rate': monthly_project_rates(employee_ids, ref_date) * included,
+        'scheduled': scheduled.to_numpy(dtype=float) * forecasted,
+        'absence': leave_forecast + sick_forecast,
+        'leave_days': np.round(leave_forecast.sum(axis=1) / (8 * 60)).astype(int),
+        'leave_profile': leave_profile,
+        'sick_ratios': (history['sick_time_total'] / history['scheduled_time']).clip(0, 1).to_numpy(dtype=float),
+        'bench_rate': bench_rate * forecasted,
+    }
+
+
+def monte_carlo_trials(inputs: dict, trials: int, seed) -> (np.ndarray, np.ndarray):
+    """Run trials on the inputs of monte_carlo_inputs and return the revenue and margin of the company per trial
+    and month, as arrays of trial x month"""
+    rng = np.random.default_rng(seed)
+    employees, months = inputs['hours'].shape
+    sick = inputs['scheduled'] * rng.choice(inputs['sick_ratios'], size=(trials, employees, months))
+    if inputs['leave_profile'].sum():
+        leave = rng.multinomial(inputs['leave_days'], inputs['leave_profile'], size=(trials, employees)) * 8 * 60
+    else:
+        leave = np.zeros((trials, employees, months))
+    bench = rng.random((trials, employees, months)) < inputs['bench_rate']
+    # billable hours change by the difference between the sampled and forecasted absences, none when on the bench
+    hours = np.where(bench, 0, np.maximum(inputs['hours'] + (inputs['absence'] - sick - leave) / 60, 0))
+    revenue_change = ((hours - inputs['hours']) * inputs['rate']).sum(axis=1)
+    return inputs['revenue'] + revenue_change, inputs['margin'] + revenue_change
+
+
+def monte_carlo_forecast(overview: pd.DataFrame, monthly_employee_data: dict, trials: int = None, seed: int = None,
+                         max_workers: int = None) -> pd.DataFrame:
+    """Calculate the spread of the company forecast overview with its monthly summaries of the employees (see
+    main_functions.company_year_forecast) with trials sampling the absences and bench of the employees (default
+    parameter monte_carlo_trials). The trials are divided over parallel processes (default parameter scenario_workers).
+    Returns per month and for the total the forecasted revenue and margin, and their percentiles P10, P50 and P90 over
+    the trials."""
+    if trials is None:
+        trials = config.g_config.getint('PARAMETERS', 'monte_carlo_trials')
+    if max_workers is None:
+        max_workers = config.g_config.getint('PARAMETERS', 'scenario_workers')
+    inputs = monte_carlo_inputs(overview, monthly_employee_data)
+    # every process runs its share of the trials with its own random numbers
+    seeds = np.random.SeedSequence(seed).spawn(max_workers)
+    shares = [len(share) for share in np.array_split(np.arange(trials), max_workers)]
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        results = list(executor.map(monte_carlo_trials, [inputs] * max_workers, shares, seeds))
+    revenue = np.concatenate([result[0] for result in results])
+    margin = np.concatenate([result[1] for result in results])
+
+    table = pd.DataFrame(index=pd.Index(list(overview.index[:-1]) + ['Totaal'], name='Maand'))
+    for label, values in [('Omzet', revenue), ('Bruto marge', margin)]:
+        table[label] = overview[label].to_numpy(dtype=float)
+        # the percentiles of the total are taken over the yearly totals of the trials
+        values = np.column_stack([values, values.sum(axis=1)])
+        for percentile in PERCENTILES:
+            table[f"{label} P{percentile}"] = np.percentile(values, percentile, axis=0).round(0)
+    return table
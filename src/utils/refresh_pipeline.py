@@ -0,0 +1,242 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This function file contains the orchestration of the data refresh: the stages of the refresh, their dependencies,
+# concurrent execution of independent stages and the checkpoint used to resume an interrupted refresh. A refresh can
+# be limited to a slice of the data: specific employees, a year other than the reference year and a range of months.
+#
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.utils import db_retrieve, db_supply, config, gen_helpers as gh
+
+# number of employees of which the calendar is refreshed and committed before the checkpoint is updated
+CHECKPOINT_CHUNK_SIZE = 10
+
+# lock protecting the checkpoint, which is updated from the threads running the stages
+checkpoint_lock = threading.Lock()
+
+# set when the backup of the database is done, stages retrieve their data meanwhile but wait for it before writing
+backup_done = threading.Event()
+backup_failed = threading.Event()
+
+
+def checkpoint_new(year: int, employee_ids: list = None, months: list = None) -> dict:
+    """Return an empty checkpoint for a refresh of the given year, employees (None is all) and months (None is all)"""
+    return {'year': year, 'employees': employee_ids, 'months': months, 'stages': [], 'calendar': []}
+
+
+def checkpoint_load(year: int, employee_ids: list = None, months: list = None) -> dict:
+    """Load the checkpoint of an interrupted refresh, an empty checkpoint is returned if there is none for this year,
+    employees and months"""
+    checkpoint_file = config.g_config.get('FILES', 'refresh_checkpoint')
+    if not os.path.exists(checkpoint_file):
+        return checkpoint_new(year, employee_ids, months)
+    with open(checkpoint_file, 'r') as file:
+        checkpoint = json.load(file)
+    if (checkpoint['year'], checkpoint['employees'], checkpoint['months']) != (year, employee_ids, months):
+        print(f"Checkpoint is for another year, employees or months, starting refresh from scratch")
+        return checkpoint_new(year, employee_ids, months)
+    return checkpoint
+
+
+def checkpoint_register(checkpoint: dict, key: str, items: list):
+    """Add completed stages or employees to the checkpoint and write it to file, the file is replaced at once so an
+    interruption never leaves it half written"""
+    checkpoint_file = config.g_config.get('FILES', 'refresh_checkpoint')
+    with checkpoint_lock:
+        checkpoint[key].extend(items)
+        with open(checkpoint_file + '.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def checkpoint_remove():
+    """Remove the checkpoint file after a completed refresh"""
+    checkpoint_file = config.g_config.get('FILES', 'refresh_checkpoint')
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+def wait_for_backup():
+    """Block until the backup of the database is done, raise an error if the backup failed"""
+    backup_done.wait()
+    if backup_failed.is_set():
+        raise ValueError("Backup of the database failed, data is not written")
+
+
+def employee_ids_get(checkpoint: dict) -> list:
+    """Return the employees to refresh, by default all active employees in Officient, which are the non-freelance
+    workers after the refresh of the workers"""
+    if checkpoint['employees'] is not None:
+        return checkpoint['employees']
+    return db_retrieve.employee_list_get()['Id'].tolist()
+
+
+def stage_dump(checkpoint: dict):
+    """Create backup of the database"""
+    try:
+        gh.create_sql_dump()
+    except Exception:
+        backup_failed.set()
+        raise
+    finally:
+        backup_done.set()
+
+
+def stage_workers(checkpoint: dict):
+    """Compose list of employees and freelancers, and input into SQL"""
+    wait_for_backup()
+    with gh.staging_reload(['people_workers']) as staging_tables, gh.unit_of_work():
+        db_retrieve.workers_list_compose(config.g_config.get('FILES', 'freelancers'),
+                                         staging_tables['people_workers'])
+
+
+def stage_projects(checkpoint: dict):
+    """Compose a list of freelance contracts and a list of projects into SQL"""
+    wait_for_backup()
+    with gh.staging_reload(['projects', 'people_freelance_contracts']) as staging_tables, gh.unit_of_work():
+        db_retrieve.project_list_compose(config.g_config.get('FILES', 'projects'), staging_tables['projects'],
+                                         staging_tables['people_freelance_contracts'])
+
+
+def stage_calendar(checkpoint: dict):
+    """Update calendar for all employees in SQL, committing and checkpointing per chunk of employees so an interrupted
+    refresh resumes with the employees not done yet"""
+    employee_ids = [i for i in employee_ids_get(checkpoint) if i not in checkpoint['calendar']]
+    for chunk_start in range(0, len(employee_ids), CHECKPOINT_CHUNK_SIZE):
+        chunk = employee_ids[chunk_start:chunk_start + CHECKPOINT_CHUNK_SIZE]
+        workdays = db_retrieve.employee_calendar_fetch(checkpoint['year'], chunk, checkpoint['months'])
+        wait_for_backup()
+        with gh.unit_of_work():
+            db_retrieve.employee_calendar_db_exec(workdays)
+        checkpoint_register(checkpoint, 'calendar', chunk)
+
+
+def stage_saldi(checkpoint: dict):
+    """Update saldi for all employees in SQL"""
+    wait_for_backup()
+    with gh.unit_of_work():
+        db_retrieve.employee_saldi_compose(checkpoint['year'], employee_ids_get(checkpoint))
+
+
+def stage_contracts(checkpoint: dict):
+    """Compose a list of all employee contracts and insert into SQL, when the refresh is limited to some employees
+    only their contracts are replaced"""
+    contract_data = {employee_id: db_retrieve.employee_contract_get(employee_id)
+                     for employee_id in employee_ids_get(checkpoint)}
+    wait_for_backup()
+    if checkpoint['employees'] is not None:
+        with gh.unit_of_work():
+            db_retrieve.employee_contract_compose(employee_ids=checkpoint['employees'], contract_data=contract_data)
+        return
+    with gh.staging_reload(['people_employee_contracts']) as staging_tables, gh.unit_of_work():
+        db_retrieve.employee_contract_compose(staging_tables['people_employee_contracts'], contract_data=contract_data)
+
+
+# stages of the refresh with the function executing them and the stages they depend on, the backup runs concurrently
+# with the other stages which only wait for it before they change data, see function wait_for_backup
+REFRESH_STAGES = {
+    'dump': (stage_dump, []),
+    'workers': (stage_workers, []),
+    'projects': (stage_projects, []),
+    'calendar': (stage_calendar, []),
+    'saldi': (stage_saldi, ['calendar']),
+    'contracts': (stage_contracts, []),
+}
+
+
+def run(stages: list = None, resume: bool = False, max_workers: int = 4, employee_ids: list = None, year: int = None,
+        months: list = None):
+    """Run the given stages of the refresh (default all stages), independent stages are executed concurrently. Stages
+    on which a given stage depends but which are not given themselves are considered done.
+    If resume is set, the stages and employees completed by an interrupted refresh are skipped.
+    Optional arguments limit the refresh of calendar, saldi and contracts to the given employees, the calendar to the
+    given year (default year of ref_date) and the calendar to the months [first month, last month]. The saldi are only
+    kept for the year of ref_date, for another year they are skipped by default and an error is raised if given. The
+    stages dump, workers and projects always refresh all data."""
+    year = config.g_ref_date.year if year is None else year
+    # the saldi in SQL have no year, they are always those of the year of ref_date used by the forecast
+    if stages is None:
+        stages = [stage for stage in REFRESH_STAGES if stage != 'saldi' or year == config.g_ref_date.year]
+    for stage in stages:
+        if stage not in REFRESH_STAGES:
+            raise ValueError(f"Unknown refresh stage {stage}, must be one of {list(REFRESH_STAGES)}")
+    if 'saldi' in stages and year != config.g_ref_date.year:
+        raise ValueError(f"Saldi can only be refreshed for {config.g_ref_date.year}, not for {year}, as they are only "
+                         f"kept for the year of the forecast")
+    if months is not None and not 1 <= months[0] <= months[1] <= 12:
+        raise ValueError(f"Impossible range of months {months}")
+    months = None if months is None else list(months)
+    checkpoint = (checkpoint_load(year, employee_ids, months) if resume
+                  else checkpoint_new(year, employee_ids, months))
+    # stages are started in the order of REFRESH_STAGES, so the dump is started before the stages waiting for it
+    pending = [stage for stage in REFRESH_STAGES if stage in stages and stage not in checkpoint['stages']]
+    # without a backup in this run the stages can write immediately
+    backup_failed.clear()
+    if 'dump' in pending:
+        backup_done.clear()
+    else:
+        backup_done.set()
+    running = {}
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while (pending and not failed) or running:
+            # start all stages of which the dependencies are done
+            for stage in list(pending):
+                dependencies = REFRESH_STAGES[stage][1]
+                if failed or any(dependency in pending or dependency in running.values()
+                                 for dependency in dependencies):
+                    continue
+                print(f"-- Starting refresh stage {stage}")
+                running[executor.submit(REFRESH_STAGES[stage][0], checkpoint)] = stage
+                pending.remove(stage)
+            # wait for a stage to finish and register it in the checkpoint
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                if future.exception() is not None:
+                    print(f"Refresh stage {stage} failed: {str(future.exception())}")
+                    failed.append(future.exception())
+                    continue
+                print(f"-- Finished refresh stage {stage}")
+                checkpoint_register(checkpoint, 'stages', [stage])
+
+    if failed:
+        raise failed[0]
+    checkpoint_remove()
+    # signal running apps that new data is available
+    gh.data_version_set()
+
+
+def backfill(first_year: int, last_year: int, employee_ids: list = None, max_workers: int = 4):
+    """Refresh the calendar of all employees (or the given employees) for a range of historical years. The years are
+    retrieved in parallel, each year in chunks of employees which are committed separately."""
+    if first_year > last_year:
+        raise ValueError(f"Impossible range of years {first_year}-{last_year}")
+    if employee_ids is None:
+        employee_ids = db_supply.worker_list_get('intern').index.tolist()
+
+    def backfill_year(year: int):
+        for chunk_start in range(0, len(employee_ids), CHECKPOINT_CHUNK_SIZE):
+            with gh.unit_of_work():
+                db_retrieve.employee_calendar_compose(year, employee_ids[chunk_start:chunk_start
+                                                                         + CHECKPOINT_CHUNK_SIZE])
+        print(f"-- Finished calendar backfill of {year}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list forces the results, so a failing year raises its exception here
+        list(executor.map(backfill_year, range(first_year, last_year + 1)))
+    gh.data_version_set()
@@ -0,0 +1,121 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This file contains the what-if scenario sweep: the company forecast is calculated for every combination of a grid of
+# parameter values (e.g. inflator 1.00 and 1.03, dayrates +5%, 6 sick days) and the results are compared in one table.
+# Each scenario is a forecast engine on the loaded data with the parameters overridden, the scenarios are calculated
+# in parallel by forked processes which inherit the loaded data.
+#
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from src.utils import config, forecast_engine
+from src.data import data_store
+
+# parameters which can be varied, the parameters of config.ini and the factor applied to the dayrates of all projects
+SWEEP_PARAMETERS = ['inflator', 'yearly_sick_days', 'yearly_training_days', 'yearly_workdays', 'dayrate_factor']
+# parameters which are read as int, and must be whole numbers
+WHOLE_PARAMETERS = ['yearly_sick_days', 'yearly_training_days', 'yearly_workdays']
+
+# engine of which the scenarios are derived, set while a sweep runs so the forked processes inherit it. The lock makes
+# concurrent sweeps wait for each other.
+sweep_engine = None
+sweep_lock = threading.Lock()
+
+
+def scenario_grid(grid: dict) -> list:
+    """Return all combinations of a grid of parameter values, given as a dict of parameter name to list of values, as a
+    list of scenarios (dicts of parameter name to value). Whole numbers are given as int, as some parameters are read
+    as int. An error is raised for unknown parameters, negative values and fractions of parameters read as int."""
+    unknown = [name for name in grid if name not in SWEEP_PARAMETERS]
+    if unknown:
+        raise ValueError(f"Unknown scenario parameters {unknown}, use one of {SWEEP_PARAMETERS}")
+    for name, values in grid.items():
+        if any(value < 0 for value in values):
+            raise ValueError(f"Negative value for scenario parameter {name}")
+        if name in WHOLE_PARAMETERS and not all(float(value).is_integer() for value in values):
+            raise ValueError(f"Scenario parameter {name} must be a whole number")
+    values = [[int(value) if float(value).is_integer() else value for value in grid[name]] for name in grid]
+    return [dict(zip(grid.keys(), combination)) for combination in itertools.product(*values)]
+
+
+def scenario_engine(engine: 'forecast_engine.ForecastEngine', scenario: dict) -> 'forecast_engine.ForecastEngine':
+    """Return the engine of a scenario derived from engine. The parameters of config.ini are overridden, the dayrate
+    factor is applied to the hourly rates of the projects. The remaining sickness and training saldi were calculated
+    with the yearly days of config.ini, they are shifted by the change in yearly days."""
+    parameters = {name: value for name, value in scenario.items() if name != 'dayrate_factor'}
+    data = {}
+    if scenario.get('dayrate_factor', 1) != 1:
+        projects = engine.data['global_projects'].copy()
+        projects['hourly_rate'] = projects['hourly_rate'] * scenario['dayrate_factor']
+        data['global_projects'] = projects
+    shifts = {}
+    with engine.activate():
+        for parameter, saldi_column in [('yearly_sick_days', 'sickness'), ('yearly_training_days', 'training')]:
+            if parameter in scenario:
+                shifts[saldi_column] = (scenario[parameter] -
+                                        config.g_config.getfloat('PARAMETERS', parameter)) * 8 * 60
+    if any(shifts.values()):
+        saldi = engine.data['global_saldi'].copy()
+        for saldi_column, shift in shifts.items():
+            saldi[saldi_column] = (saldi[saldi_column] + shift).clip(lower=0)
+        data['global_saldi'] = saldi
+    return engine.scenario(parameters=parameters, **data)
+
+
+def scenario_evaluate(scenario: dict) -> dict:
+    """Calculate the company forecast and the yearly simulation of all employees of a scenario of sweep_engine, and
+    return their totals"""
+    engine = scenario_engine(sweep_engine, scenario)
+    total = engine.company_year_forecast()[0].loc['Totaal']
+    ranking = engine.yearly_margin_ranking()
+    return {
+        'Totaal kosten': total['Totaal kosten'],
+        'Omzet': total['Omzet'],
+        'Bruto marge': total['Bruto marge'],
+        'Brutowinstpercentage': round(total['Bruto marge'] / total['Omzet'] * 100, 2) if total['Omzet'] else None,
+        'Bruto marge simulatie': round(ranking['Bruto marge'].sum(), 0),
+    }
+
+
+def scenario_sweep(grid: dict, engine: 'forecast_engine.ForecastEngine' = None, max_workers: int = None) \
+        -> pd.DataFrame:
+    """Calculate all scenarios of a grid of parameter values (see scenario_grid) on engine (default the loaded data)
+    in parallel processes, and return a table comparing them to the base scenario without changes. The table has one
+    row per scenario, the first being the base scenario, with the parameter values, the totals of the company forecast
+    of the remaining months, the margin of the yearly simulation of all employees and the change in margin. An empty
+    grid gives the base scenario only."""
+    global sweep_engine
+    engine = data_store.engine if engine is None else engine
+    if max_workers is None:
+        max_workers = config.g_config.getint('PARAMETERS', 'scenario_workers')
+    scenarios = [{}] + (scenario_grid(grid) if grid else [])
+    with sweep_lock:
+        sweep_engine = engine
+        try:
+            # forked processes inherit the engine, as a spawned process would execute app.py again
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(scenario_evaluate, scenarios))
+        finally:
+            sweep_engine = None
+    # show the value of every varied parameter, for the base scenario these are the values of config.ini
+    with engine.activate():
+        base = {name: 1 if name == 'dayrate_factor' else config.g_config.getfloat('PARAMETERS', name)
+                for name in grid}
+    comparison = pd.DataFrame([{**base, **scenario, **result} for scenario, result in zip(scenarios, results)])
+    comparison['Verschil marge'] = comparison['Bruto marge'] - comparison.loc[0, 'Bruto marge']
+    comparison.insert(0, 'Scenario', ['Basis'] + [str(number) for number in range(1, len(scenarios))])
+    return comparison
@@ -0,0 +1,87 @@
+# Copyright (C) 2024 Joachim Nuyttens
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+#
+# This function file contains the sanity checks of data before it is inserted in SQL. The checks are rules on whole
+# columns, all rows are checked at once and all violations are reported together.
+#
+import pandas as pd
+
+# rules per kind of data, each rule is a column with lower and upper bound (None for no bound), the severity (an error
+# stops the insert, a warning is only reported) and a description of the violation. Missing values violate the rule.
+CONTRACT_RULES = {
+    'mobility_missing': ('monthly_mobility', 1, None, 'error', "Mobility cost missing"),
+    'mobility_high': ('monthly_mobility', None, 2000, 'warning', "Mobility cost suspiciously high"),
+    'salary_missing': ('monthly_salary', 1, None, 'error', "Monthly salary missing"),
+    'salary_high': ('monthly_salary', None, 10000, 'error', "Monthly salary impossibly high"),
+    'fte': ('fte', 0, 1, 'error', "Impossible FTE value"),
+    'contract_id': ('id', 1, 9999999999, 'error', "Impossible contract id value"),
+}
+
+PROJECT_RULES = {
+    'consultant_id': ('Consultant id', 1, 9999999999, 'error', "Impossible consultant id value"),
+    'msp_fee': ('MSP Fee', 0, 1, 'error', "Impossible MSP fee"),
+    'percentage': ('Percentage', 0, 1, 'warning', "Project percentage outside 0 to 1"),
+    'hourly_rate': ('Uurtarief', 0, None, 'error', "Hourly rate missing or negative"),
+    'start_date': ('start_date', None, None, 'error', "Start date missing or not a date"),
+    'duration': ('duration_days', 0, None, 'error', "End date before start date"),
+}
+
+CALENDAR_RULES = {
+    'scheduled_time': ('scheduled_time', 0, 1440, 'error', "Impossible scheduled minutes in a day"),
+    'leave_time': ('leave_time', 0, 1440, 'error', "Impossible leave minutes in a day"),
+    'unscheduled_leave': ('unscheduled_leave', None, 0, 'warning', "Leave exceeding scheduled minutes"),
+}
+
+# number of violating rows printed per rule, all are in the report
+REPORT_EXAMPLES = 5
+
+
+def validation_report(data_frame: pd.DataFrame, rules: dict, key_columns: list) -> pd.DataFrame:
+    """Check all rows of a dataframe against the rules and return a report with one row per violation, holding the
+    key columns identifying the row, the rule, the column and its value, the severity and the description"""
+    reports = []
+    for rule, (column, lower, upper, severity, description) in rules.items():
+        values = data_frame[column]
+        valid = values.notna()
+        if lower is not None:
+            valid &= values >= lower
+        if upper is not None:
+            valid &= values <= upper
+        violations = data_frame.loc[~valid, key_columns].copy()
+        if violations.empty:
+            continue
+        violations['rule'] = rule
+        violations['column'] = column
+        violations['value'] = values[~valid].astype(object)
+        violations['severity'] = severity
+        violations['description'] = description
+        reports.append(violations)
+    if not reports:
+        return pd.DataFrame(columns=key_columns + ['rule', 'column', 'value', 'severity', 'description'])
+    return pd.concat(reports, ignore_index=True)
+
+
+def validation_check(data_frame: pd.DataFrame, rules: dict, key_columns: list, name: str) -> pd.DataFrame:
+    """Check all rows of a dataframe against the rules, print a summary of the violations per rule and raise an error
+    listing all rules with errors if there are any. The report of validation_report is returned."""
+    report = validation_report(data_frame, rules, key_columns)
+    errors = []
+    for (rule, severity, description), violations in report.groupby(['rule', 'severity', 'description'], sort=False):
+        examples = violations[key_columns + ['value']].head(REPORT_EXAMPLES).to_dict('records')
+        message = f"{description} in {len(violations)} {name} rows, e.g. {examples}"
+        print(f"Validation {severity}: {message}")
+        if severity == 'error':
+            errors.append(message)
+    if errors:
+        raise ValueError(f"Validation of {name} failed with {len(errors)} errors: " + "; ".join(errors))
+    return report